@@ -57,6 +57,8 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 ROOT_URLCONF = "config.urls"
 # https://docs.djangoproject.com/en/dev/ref/settings/#wsgi-application
 WSGI_APPLICATION = "config.wsgi.application"
+# https://docs.djangoproject.com/en/dev/ref/settings/#asgi-application
+ASGI_APPLICATION = "config.asgi.application"
 
 # APPS
 # ------------------------------------------------------------------------------
@@ -100,7 +102,8 @@ MIGRATION_MODULES = {"sites": "keycloak_with_multiple_roles.contrib.sites.migrat
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#authentication-backends
 AUTHENTICATION_BACKENDS = [
-    "django.contrib.auth.backends.ModelBackend",
+    # ModelBackend with permission sets cached under a global version
+    "keycloak_with_multiple_roles.users.backends.CachedModelBackend",
     "allauth.account.auth_backends.AuthenticationBackend",
 ]
 # https://docs.djangoproject.com/en/dev/ref/settings/#auth-user-model
@@ -115,7 +118,8 @@ LOGIN_URL = "account_login"
 # https://docs.djangoproject.com/en/dev/ref/settings/#password-hashers
 PASSWORD_HASHERS = [
     # https://docs.djangoproject.com/en/dev/topics/auth/passwords/#using-argon2-with-django
-    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    # Django's Argon2 hasher with the PASSWORD_ARGON2_* costs below
+    "keycloak_with_multiple_roles.users.hashers.Argon2PasswordHasher",
     "django.contrib.auth.hashers.PBKDF2PasswordHasher",
     "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
     "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
@@ -134,7 +138,12 @@ AUTH_PASSWORD_VALIDATORS = [
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#middleware
 MIDDLEWARE = [
+    "keycloak_with_multiple_roles.users.timing.ServerTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    # Before sessions and auth, so rate-limited requests cost no DB query
+    "keycloak_with_multiple_roles.users.ratelimit.RateLimitMiddleware",
+    # 503 instead of a 500 when password hashing sheds load (admin, allauth)
+    "keycloak_with_multiple_roles.users.hashing.PasswordHashingUnavailableMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.locale.LocaleMiddleware",
@@ -206,6 +215,24 @@ CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 # https://docs.djangoproject.com/en/dev/ref/settings/#fixture-dirs
 FIXTURE_DIRS = (str(APPS_DIR / "fixtures"),)
 
+# SESSIONS
+# ------------------------------------------------------------------------------
+# https://docs.djangoproject.com/en/dev/topics/http/sessions/#configuring-the-session-engine
+# "db": one row per session, read and written on every use.
+# "cached_db": the same rows, read through the default cache (Redis in production).
+# "cache": the default cache only, no rows; sessions go when Redis evicts them.
+# "signed_cookies": the session lives in the cookie; logout cannot revoke copies.
+# After moving off "db"/"cached_db", drop the old rows with `manage.py prune_sessions --all`.
+SESSION_ENGINE = {
+    "db": "django.contrib.sessions.backends.db",
+    "cached_db": "django.contrib.sessions.backends.cached_db",
+    "cache": "django.contrib.sessions.backends.cache",
+    "signed_cookies": "django.contrib.sessions.backends.signed_cookies",
+}[env("DJANGO_SESSION_STRATEGY", default="cached_db")]
+# Whether LoginView also logs the user into a session. Clients that only use the
+# returned token can send {"session": false}; False here disables API sessions.
+API_LOGIN_SESSION = env.bool("DJANGO_API_LOGIN_SESSION", default=True)
+
 # SECURITY
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#session-cookie-httponly
@@ -287,11 +314,19 @@ SOCIALACCOUNT_FORMS = {"signup": "keycloak_with_multiple_roles.users.forms.UserS
 # django-rest-framework - https://www.django-rest-framework.org/api-guide/settings/
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework.authentication.SessionAuthentication",
-        "rest_framework.authentication.TokenAuthentication",
+        "keycloak_with_multiple_roles.users.api.authentication.SessionAuthentication",
+        "keycloak_with_multiple_roles.users.api.authentication.CachedTokenAuthentication",
+        "keycloak_with_multiple_roles.users.api.authentication.KeycloakJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
+    # 503 for shed password hashes, see users.hashing
+    "EXCEPTION_HANDLER": "keycloak_with_multiple_roles.users.api.exceptions.exception_handler",
+    # Reverse proxies in front of Django. Throttles and users.ratelimit key
+    # on REMOTE_ADDR when 0, or on the address the outermost trusted proxy
+    # appended to X-Forwarded-For; left unset, DRF would trust the whole
+    # client-supplied header.
+    "NUM_PROXIES": env.int("DJANGO_NUM_PROXIES", default=0),
 }
 
 # django-cors-headers - https://github.com/adamchainz/django-cors-headers#setup
@@ -308,3 +343,91 @@ SPECTACULAR_SETTINGS = {
 }
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Secret keying the permutation family and student codes are drawn from
+# (users.codes), so codes cannot be enumerated; defaults to SECRET_KEY
+CODE_PERMUTATION_KEY = env("DJANGO_CODE_PERMUTATION_KEY", default="")
+# Seconds LoginView/MeView profile summaries stay cached
+PROFILE_CACHE_TIMEOUT = env.int("DJANGO_PROFILE_CACHE_TIMEOUT", default=300)
+# API tokens (users.AuthToken) expire API_TOKEN_TTL seconds after their last
+# renewal; tokens in use are renewed at most once per API_TOKEN_RENEW_INTERVAL.
+# Run `manage.py prune_tokens` periodically to delete expired ones.
+API_TOKEN_TTL = env.int("DJANGO_API_TOKEN_TTL", default=14 * 24 * 3600)
+API_TOKEN_RENEW_INTERVAL = env.int("DJANGO_API_TOKEN_RENEW_INTERVAL", default=3600)
+# Token lookups: shared cache timeout, and per-process LRU TTL/size. Revoked
+# tokens stay usable on other workers for at most TOKEN_CACHE_LOCAL_TTL seconds.
+TOKEN_CACHE_TIMEOUT = env.int("DJANGO_TOKEN_CACHE_TIMEOUT", default=300)
+TOKEN_CACHE_LOCAL_TTL = env.int("DJANGO_TOKEN_CACHE_LOCAL_TTL", default=5)
+TOKEN_CACHE_LOCAL_SIZE = env.int("DJANGO_TOKEN_CACHE_LOCAL_SIZE", default=1024)
+# Seconds CachedModelBackend keeps a user's permission sets; changes to groups
+# or permissions retire them immediately
+PERMISSION_CACHE_TIMEOUT = env.int("DJANGO_PERMISSION_CACHE_TIMEOUT", default=3600)
+# ServerTimingMiddleware: fraction of requests whose DB/cache/serializer time is
+# measured, and whether to return it as a Server-Timing header and/or log it.
+# The header exposes backend timings to every client, so it is off unless
+# enabled (local.py does). Cache calls are only counted with the backends in
+# users.cache_backends.
+SERVER_TIMING_SAMPLE_RATE = env.float("DJANGO_SERVER_TIMING_SAMPLE_RATE", default=1.0)
+SERVER_TIMING_HEADER = env.bool("DJANGO_SERVER_TIMING_HEADER", default=False)
+SERVER_TIMING_LOG = env.bool("DJANGO_SERVER_TIMING_LOG", default=True)
+# Family events for websocket clients are fanned out over Redis pub/sub;
+# leave the URL empty to stop publishing them.
+FAMILY_EVENTS_REDIS_URL = env("DJANGO_FAMILY_EVENTS_REDIS_URL", default=REDIS_URL)
+FAMILY_EVENTS_CHANNEL_PREFIX = env("DJANGO_FAMILY_EVENTS_CHANNEL_PREFIX", default="events:")
+# Events buffered per websocket connection before a slow client starts losing them
+FAMILY_EVENTS_QUEUE_SIZE = env.int("DJANGO_FAMILY_EVENTS_QUEUE_SIZE", default=100)
+
+# Password hashing runs on a bounded pool (users.hashing): hashes at once,
+# hashes waiting for a worker, and seconds one may wait before the request is
+# shed with a 503. Each running Argon2 hash holds its memory cost, 100 MiB by default.
+PASSWORD_HASHING_WORKERS = env.int("DJANGO_PASSWORD_HASHING_WORKERS", default=2)
+PASSWORD_HASHING_QUEUE_SIZE = env.int("DJANGO_PASSWORD_HASHING_QUEUE_SIZE", default=32)
+PASSWORD_HASHING_QUEUE_TIMEOUT = env.float("DJANGO_PASSWORD_HASHING_QUEUE_TIMEOUT", default=2.0)
+# Argon2 costs, unset to keep Django's (time 2, memory 102400 KiB, parallelism 8).
+# Every existing hash is upgraded on its next login after a change.
+PASSWORD_ARGON2_TIME_COST = env.int("DJANGO_PASSWORD_ARGON2_TIME_COST", default=None)
+PASSWORD_ARGON2_MEMORY_COST = env.int("DJANGO_PASSWORD_ARGON2_MEMORY_COST", default=None)
+PASSWORD_ARGON2_PARALLELISM = env.int("DJANGO_PASSWORD_ARGON2_PARALLELISM", default=None)
+
+# Token-bucket rate limits (users.ratelimit): "<burst>/<period>" per identity,
+# refilled evenly over the period. Buckets live in RATE_LIMIT_REDIS_URL, or in
+# each process while Redis is unreachable or the URL is empty.
+RATE_LIMIT_ENABLED = env.bool("DJANGO_RATE_LIMIT_ENABLED", default=True)
+RATE_LIMIT_REDIS_URL = env("DJANGO_RATE_LIMIT_REDIS_URL", default=REDIS_URL)
+RATE_LIMIT_REDIS_TIMEOUT = env.float("DJANGO_RATE_LIMIT_REDIS_TIMEOUT", default=0.1)
+RATE_LIMITS = {
+    # Requests per client IP to the views in RATE_LIMIT_VIEWS
+    "auth:ip": env("DJANGO_RATE_LIMIT_AUTH_IP", default="30/m"),
+    # Login attempts per username
+    "login:username": env("DJANGO_RATE_LIMIT_LOGIN_USERNAME", default="10/m"),
+    # Family code lookups per client IP and per code
+    "family_code:ip": env("DJANGO_RATE_LIMIT_FAMILY_CODE_IP", default="60/m"),
+    "family_code:code": env("DJANGO_RATE_LIMIT_FAMILY_CODE", default="20/m"),
+}
+# URL name -> per-IP rule checked by RateLimitMiddleware
+RATE_LIMIT_VIEWS = {
+    "users:login": "auth:ip",
+}
+
+# Keycloak
+# ------------------------------------------------------------------------------
+# Access tokens are verified locally against the realm JWKS. KEYCLOAK_JWKS_URL
+# may also be a path to a JWKS file; leave it empty to disable Keycloak auth.
+KEYCLOAK_SERVER_URL = env("KEYCLOAK_SERVER_URL", default="")
+KEYCLOAK_REALM = env("KEYCLOAK_REALM", default="")
+KEYCLOAK_CLIENT_ID = env("KEYCLOAK_CLIENT_ID", default="")
+KEYCLOAK_ISSUER = env(
+    "KEYCLOAK_ISSUER",
+    default=f"{KEYCLOAK_SERVER_URL}/realms/{KEYCLOAK_REALM}" if KEYCLOAK_SERVER_URL else "",
+)
+KEYCLOAK_JWKS_URL = env(
+    "KEYCLOAK_JWKS_URL",
+    default=f"{KEYCLOAK_ISSUER}/protocol/openid-connect/certs" if KEYCLOAK_ISSUER else "",
+)
+KEYCLOAK_AUDIENCE = env("KEYCLOAK_AUDIENCE", default=KEYCLOAK_CLIENT_ID)
+KEYCLOAK_JWKS_CACHE_TTL = env.int("KEYCLOAK_JWKS_CACHE_TTL", default=3600)
+# Keycloak realm/client role -> User.user_type, first match wins
+KEYCLOAK_ROLE_MAP = {
+    "admin": "admin",
+    "parent": "parent",
+    "student": "student",
+}
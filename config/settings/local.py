@@ -20,7 +20,7 @@ ALLOWED_HOSTS = ["localhost", "0.0.0.0", "127.0.0.1"]  # noqa: S104
 # https://docs.djangoproject.com/en/dev/ref/settings/#caches
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "BACKEND": "keycloak_with_multiple_roles.users.cache_backends.TimedLocMemCache",
         "LOCATION": "",
     },
 }
@@ -32,6 +32,11 @@ EMAIL_BACKEND = env(
     "DJANGO_EMAIL_BACKEND", default="django.core.mail.backends.console.EmailBackend",
 )
 
+# ServerTimingMiddleware
+# ------------------------------------------------------------------------------
+# Timings in the Server-Timing header, for the browser's network panel
+SERVER_TIMING_HEADER = env.bool("DJANGO_SERVER_TIMING_HEADER", default=True)
+
 # django-debug-toolbar
 # ------------------------------------------------------------------------------
 # https://django-debug-toolbar.readthedocs.io/en/latest/installation.html#prerequisites
@@ -36,3 +36,7 @@ TEMPLATES[0]["OPTIONS"]["debug"] = True  # type: ignore[index]
 MEDIA_URL = "http://media.testserver/"
 # Your stuff...
 # ------------------------------------------------------------------------------
+# No Redis for family events in tests
+FAMILY_EVENTS_REDIS_URL = ""
+# Rate limit buckets in process memory
+RATE_LIMIT_REDIS_URL = ""
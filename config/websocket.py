@@ -1,13 +1,64 @@
-async def websocket_application(scope, receive, send):
+import asyncio
+import json
+import logging
+
+import redis
+
+from keycloak_with_multiple_roles.users.api.authentication import authenticate_websocket
+from keycloak_with_multiple_roles.users.events import FamilySubscription
+from keycloak_with_multiple_roles.users.events import events_enabled
+
+# Close code for a rejected handshake (4000-4999 are application defined)
+UNAUTHORIZED_CLOSE_CODE = 4401
+# Server error, e.g. the family event subscription could not be opened
+INTERNAL_ERROR_CLOSE_CODE = 1011
+
+logger = logging.getLogger(__name__)
+
+
+async def forward_events(subscription, send):
     while True:
-        event = await receive()
+        event = await subscription.next_event()
+        await send({"type": "websocket.send", "text": json.dumps(event)})
+
+
+async def websocket_application(scope, receive, send):
+    """
+    Push family events (student linked/unlinked, profile updates) to an
+    authenticated client; "ping" is still answered with "pong!".
+    """
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+
+    user = await authenticate_websocket(scope)
+    if user is None:
+        await send({"type": "websocket.close", "code": UNAUTHORIZED_CLOSE_CODE})
+        return
+    await send({"type": "websocket.accept"})
+
+    subscription = forwarder = None
+    if events_enabled():
+        subscription = FamilySubscription(user)
+        try:
+            await subscription.open()
+        except redis.RedisError:
+            logger.warning("Could not subscribe user %s to family events", user.pk, exc_info=True)
+            await subscription.close()
+            await send({"type": "websocket.close", "code": INTERNAL_ERROR_CLOSE_CODE})
+            return
+        forwarder = asyncio.create_task(forward_events(subscription, send))
 
-        if event["type"] == "websocket.connect":
-            await send({"type": "websocket.accept"})
+    try:
+        while True:
+            event = await receive()
 
-        if event["type"] == "websocket.disconnect":
-            break
+            if event["type"] == "websocket.disconnect":
+                break
 
-        if event["type"] == "websocket.receive":
-            if event["text"] == "ping":
+            if event["type"] == "websocket.receive" and event.get("text") == "ping":
                 await send({"type": "websocket.send", "text": "pong!"})
+    finally:
+        if forwarder is not None:
+            forwarder.cancel()
+            await subscription.close()
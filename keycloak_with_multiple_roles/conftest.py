@@ -1,4 +1,5 @@
 import pytest
+from django.core.cache import cache
 
 from keycloak_with_multiple_roles.users.models import User
 from keycloak_with_multiple_roles.users.tests.factories import UserFactory
@@ -9,6 +10,14 @@ def _media_storage(settings, tmpdir) -> None:
     settings.MEDIA_ROOT = tmpdir.strpath
 
 
+@pytest.fixture(autouse=True)
+def _clear_cache():
+    # Database rows are rolled back between tests, cached entries are not
+    cache.clear()
+    yield
+    cache.clear()
+
+
 @pytest.fixture
 def user(db) -> User:
     return UserFactory()
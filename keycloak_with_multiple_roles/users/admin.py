@@ -2,18 +2,84 @@ from allauth.account.decorators import secure_admin_login
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth import admin as auth_admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
+from .api.pagination import estimated_count
 from .forms import UserAdminChangeForm, UserAdminCreationForm
-from .models import User, Parent, Student
+from .models import AuthToken, User, UserRole, Parent, Student
 
 if settings.DJANGO_ADMIN_FORCE_ALLAUTH:
   admin.autodiscover()
   admin.site.login = secure_admin_login(admin.site.login)  # type: ignore[method-assign]
 
 
+class EstimatedCountPaginator(Paginator):
+  """
+    Paginator that takes large totals from planner statistics.
+
+    Counts below ``exact_count_limit`` estimated rows are exact, so
+    filtered and small changelists still show true totals.
+  """
+
+  exact_count_limit = 10000
+
+  @cached_property
+  def count(self):
+    queryset = self.object_list
+    if connections[queryset.db].vendor != "postgresql":
+      return queryset.count()
+    estimate = estimated_count(queryset)
+    return queryset.count() if estimate < self.exact_count_limit else estimate
+
+
+class ScalableChangeListMixin:
+  """
+    Changelist settings for tables too large to count or scan per page view.
+
+    ``search_fields`` are matched like the admin does, except that fields
+    of the related user (``<user_field>__...``) are searched in a subquery
+    on users_user, where the trigram indexes apply, and ``=`` fields are
+    compared to the upper-cased term so the code indexes apply.
+  """
+
+  paginator = EstimatedCountPaginator
+  show_full_result_count = False
+  user_field = None
+
+  def get_search_results(self, request, queryset, search_term):
+    terms = search_term.split()
+    if not terms:
+      return queryset, False
+    user_prefix = f"{self.user_field}__"
+    for term in terms:
+      match = Q()
+      users = Q()
+      for field in self.get_search_fields(request):
+        if field.startswith("="):
+          match |= Q(**{field[1:]: term.upper()})
+        elif self.user_field and field.startswith(user_prefix):
+          users |= Q(**{f"{field.removeprefix(user_prefix)}__icontains": term})
+        else:
+          match |= Q(**{f"{field}__icontains": term})
+      if users:
+        match |= Q(**{f"{self.user_field}__in": User.objects.filter(users).values("pk")})
+      queryset = queryset.filter(match)
+    return queryset, False
+
+
+class UserRoleInline(admin.TabularInline):
+  model = UserRole
+  extra = 0
+  fields = ["role", "created_at"]
+  readonly_fields = ["created_at"]
+
+
 @admin.register(User)
-class UserAdmin(auth_admin.UserAdmin):
+class UserAdmin(ScalableChangeListMixin, auth_admin.UserAdmin):
   form = UserAdminChangeForm
   add_form = UserAdminCreationForm
   fieldsets = (
@@ -34,69 +100,89 @@ class UserAdmin(auth_admin.UserAdmin):
     ),
     (_("Important dates"), {"fields": ("last_login", "date_joined")}),
   )
-  list_display = ["email", "username", "name", "user_type",  "is_superuser"]
+  list_display = ["email", "username", "name", "user_type", "roles", "is_superuser"]
   list_filter = ["user_type",  "is_staff", "is_superuser", "is_active"]
   search_fields = ["name", "email", "username"]
   ordering = ["-date_joined"]
+  inlines = [UserRoleInline]
+
+  @admin.display(description=_("Roles"))
+  def roles(self, obj):
+    return ", ".join(obj.role_names)
 
 
 @admin.register(Parent)
-class ParentAdmin(admin.ModelAdmin):
+class ParentAdmin(ScalableChangeListMixin, admin.ModelAdmin):
   list_display = [
     "user",
     "family_code",
     "phone_number",
-    "get_students_count",
+    "student_count",
     "created_at"
   ]
   list_filter = [    "created_at"]
-  search_fields = ["parent_link__email", "parent_link__username", "family_code", "phone_number"]
+  list_select_related = ["user"]
+  user_field = "user"
+  search_fields = ["user__email", "user__username", "user__name", "=family_code", "phone_number"]
+  raw_id_fields = ["user"]
   readonly_fields = ["uuid", "family_code", "created_at", "updated_at"]
 
   fieldsets = (
-    (_("User Link"), {"fields": ("parent_link", "uuid", "family_code")}),
-    (_("Contact Information"), {"fields": ("phone_number", "address",  "state")}),
+    (_("User Link"), {"fields": ("user", "uuid", "family_code")}),
+    (_("Contact Information"), {"fields": ("phone_number", "address")}),
     (_("Email Preferences"), {"fields": (  )}),
     (_("Timestamps"), {"fields": ("created_at", "updated_at")}),
   )
 
-  def get_students_count(self, obj):
-    return obj.get_students_count()
-
-  get_students_count.short_description = _("Students Count")
-
 
 @admin.register(Student)
-class StudentAdmin(admin.ModelAdmin):
+class StudentAdmin(ScalableChangeListMixin, admin.ModelAdmin):
   list_display = [
     "student_link",
     "student_code",
     "grade",
     "class_name",
-    "parent_family_code",
+    "parent_id",
     "is_linked",
     "created_at"
   ]
   list_filter = ["grade", "class_name", "created_at"]
+  list_select_related = ["student_link"]
+  user_field = "student_link"
   search_fields = [
     "student_link__email",
     "student_link__username",
-    "student_code",
-    "parent_family_code"
+    "student_link__name",
+    "=student_code",
+    "=parent__family_code"
   ]
+  raw_id_fields = ["student_link", "parent"]
   readonly_fields = ["uuid", "student_code",  "created_at", "updated_at"]
 
   fieldsets = (
     (_("User Link"), {"fields": ("student_link", "uuid", "student_code")}),
-    (_("Parent Link"), {"fields": ("parent_family_code",)}),
+    (_("Parent Link"), {"fields": ("parent",)}),
     (_("Academic Information"), {"fields": ("grade", "class_name")}),
     (_("Media"), {"fields": ( )}),
     (_("Timestamps"), {"fields": ("created_at", "updated_at")}),
   )
 
+  @admin.display(boolean=True, description=_("Linked to Parent"), ordering="parent")
   def is_linked(self, obj):
     return obj.is_linked_to_parent()
 
-  is_linked.boolean = True
-  is_linked.short_description = _("Linked to Parent")
 
+
+@admin.register(AuthToken)
+class AuthTokenAdmin(ScalableChangeListMixin, admin.ModelAdmin):
+  list_display = ["user", "issued_at", "expires_at"]
+  list_select_related = ["user"]
+  user_field = "user"
+  search_fields = ["user__email", "user__username"]
+  raw_id_fields = ["user"]
+  readonly_fields = ["key", "issued_at"]
+  ordering = ["-expires_at"]
+
+  def has_add_permission(self, request):
+    # Tokens are issued by logging in
+    return False
@@ -0,0 +1,107 @@
+"""
+Minimal async counterpart of DRF's APIView.
+
+DRF views are sync only, so under ASGI every request to them is handed to a
+worker thread. ``AsyncAPIView`` covers what the small auth endpoints need
+(authentication, an authenticated-only switch, JSON in and out) natively on
+the event loop, using the async ORM and the ``aauthenticate`` methods of the
+configured authentication classes. Throttles are checked like DRF's,
+after authentication and parsing.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.utils.translation import gettext_lazy as _
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework import status
+from rest_framework.settings import api_settings
+
+from keycloak_with_multiple_roles.users.hashing import PasswordHashingUnavailable
+
+from .exceptions import as_api_exception
+
+
+# ATOMIC_REQUESTS cannot wrap async views; writes here are single statements
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+# Like APIView, CSRF is enforced by SessionAuthentication for session users only
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncAPIView(View):
+  """
+    Async view authenticating with REST_FRAMEWORK's authentication classes.
+
+    Handlers receive ``request.user``, ``request.auth`` and the parsed body
+    as ``request.data``, and return a JsonResponse. APIExceptions they
+    raise are rendered like DRF does.
+  """
+
+  authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
+  throttle_classes = ()
+  # Reject anonymous requests with 401, like IsAuthenticated
+  require_authentication = False
+
+  async def dispatch(self, request, *args, **kwargs):
+    try:
+      request.user, request.auth = await self.perform_authentication(request)
+      if self.require_authentication and not request.user.is_authenticated:
+        raise exceptions.NotAuthenticated
+      request.data = self.parse_body(request)
+      await self.check_throttles(request)
+      return await super().dispatch(request, *args, **kwargs)
+    except (exceptions.APIException, PasswordHashingUnavailable) as exc:
+      return self.handle_exception(as_api_exception(exc))
+
+  async def perform_authentication(self, request):
+    """ First (user, auth) pair returned by the authentication classes """
+    for authentication_class in self.authentication_classes:
+      authenticator = authentication_class()
+      if hasattr(authenticator, "aauthenticate"):
+        result = await authenticator.aauthenticate(request)
+      else:
+        result = await sync_to_async(authenticator.authenticate, thread_sensitive=False)(request)
+      if result is not None:
+        return result
+    return await request.auser(), None
+
+  async def check_throttles(self, request):
+    """ Raise Throttled with the longest wait of the throttles refusing the request """
+    waits = []
+    for throttle_class in self.throttle_classes:
+      throttle = throttle_class()
+      # Throttles wait on cache round trips; keep them off the shared sync thread
+      if not await sync_to_async(throttle.allow_request, thread_sensitive=False)(request, self):
+        waits.append(throttle.wait())
+    if waits:
+      raise exceptions.Throttled(wait=max((wait for wait in waits if wait is not None), default=None))
+
+  def parse_body(self, request):
+    if request.method in ("GET", "HEAD", "OPTIONS", "DELETE"):
+      return {}
+    if request.content_type == "application/json":
+      try:
+        return json.loads(request.body or b"{}")
+      except ValueError:
+        raise exceptions.ParseError(_("JSON parse error.")) from None
+    return request.POST
+
+  def authenticate_header(self):
+    if self.authentication_classes:
+      return self.authentication_classes[0]().authenticate_header(None)
+    return None
+
+  def handle_exception(self, exc):
+    response = JsonResponse({"detail": exc.detail}, status=exc.status_code)
+    if getattr(exc, "wait", None):
+      # Like DRF's exception handler, e.g. for users.hashing load shedding
+      response["Retry-After"] = str(int(exc.wait))
+    if isinstance(exc, exceptions.NotAuthenticated | exceptions.AuthenticationFailed):
+      header = self.authenticate_header()
+      if header:
+        response["WWW-Authenticate"] = header
+      else:
+        response.status_code = status.HTTP_403_FORBIDDEN
+    return response
@@ -0,0 +1,389 @@
+"""
+Token authentication resolved through an in-process LRU, the shared cache
+and finally the database.
+
+Tokens are ``users.models.AuthToken`` rows and expire. Every tier holds
+``(user, expires_at)``, so an expired token is refused without a query,
+and no entry is cached past its token's expiry. Tokens in use slide their
+expiry forward at most once per API_TOKEN_RENEW_INTERVAL. The tier that
+answered and the lookup time are reported per request as the ``token``
+metric of users.timing.
+"""
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import aget_user
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpRequest
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext_lazy as _
+from rest_framework import authentication
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authentication import get_authorization_header
+
+from keycloak_with_multiple_roles.users import timing
+from keycloak_with_multiple_roles.users.keycloak import KeycloakTokenError
+from keycloak_with_multiple_roles.users.keycloak import adecode_access_token
+from keycloak_with_multiple_roles.users.keycloak import aget_or_create_user
+from keycloak_with_multiple_roles.users.keycloak import decode_access_token
+from keycloak_with_multiple_roles.users.keycloak import get_or_create_user
+from keycloak_with_multiple_roles.users.models import AuthToken
+
+DEFAULT_TOKEN_CACHE_TIMEOUT = 300
+DEFAULT_LOCAL_TTL = 5
+DEFAULT_LOCAL_SIZE = 1024
+
+# Lookup tiers, fastest first
+LOCAL_TIER = "local"
+CACHE_TIER = "cache"
+DB_TIER = "db"
+TOKEN_METRIC = "token"
+
+
+class LocalTTLCache:
+  """ Thread-safe LRU whose entries also expire ``ttl`` seconds after being set """
+
+  def __init__(self, maxsize, ttl):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._data = OrderedDict()
+
+  def get(self, key):
+    with self._lock:
+      item = self._data.get(key)
+      if item is None:
+        return None
+      expires, value = item
+      if expires <= time.monotonic():
+        del self._data[key]
+        return None
+      self._data.move_to_end(key)
+      return value
+
+  def set(self, key, value):
+    with self._lock:
+      self._data[key] = (time.monotonic() + self.ttl, value)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+  def delete(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+
+local_tokens = LocalTTLCache(
+  getattr(settings, "TOKEN_CACHE_LOCAL_SIZE", DEFAULT_LOCAL_SIZE),
+  getattr(settings, "TOKEN_CACHE_LOCAL_TTL", DEFAULT_LOCAL_TTL),
+)
+
+
+def token_cache_key(key):
+  """ Cache key for a token; the raw token never appears in the cache """
+  return "authtoken:v2:" + hashlib.sha256(key.encode()).hexdigest()
+
+
+def invalidate_tokens(*keys):
+  """
+    Forget cached lookups for the given token keys.
+
+    The shared cache entry is dropped once the transaction commits. Other
+    processes may keep serving their local copy for at most
+    TOKEN_CACHE_LOCAL_TTL seconds.
+  """
+  cache_keys = [token_cache_key(key) for key in keys]
+  for cache_key in cache_keys:
+    local_tokens.delete(cache_key)
+  if cache_keys:
+    transaction.on_commit(lambda: cache.delete_many(cache_keys))
+
+
+class SessionAuthentication(authentication.SessionAuthentication):
+  """ DRF's SessionAuthentication, usable from the async views too """
+
+  async def aauthenticate(self, request):
+    user = await request.auser()
+    if not user or not user.is_active:
+      return None
+    self.enforce_csrf(request)
+    return (user, None)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+  """
+    Drop-in replacement for DRF's TokenAuthentication.
+
+    Token -> user lookups are answered from a short-lived in-process LRU,
+    then the shared (Redis) cache, and only then the database.
+  """
+
+  model = AuthToken
+
+  def get_key(self, request):
+    """ Token key from the Authorization header, or None for other schemes """
+    auth = get_authorization_header(request).split()
+    if not auth or auth[0].lower() != self.keyword.lower().encode():
+      return None
+    if len(auth) == 1:
+      raise exceptions.AuthenticationFailed(_("Invalid token header. No credentials provided."))
+    if len(auth) > 2:  # noqa: PLR2004
+      raise exceptions.AuthenticationFailed(_("Invalid token header. Token string should not contain spaces."))
+    try:
+      return auth[1].decode()
+    except UnicodeError:
+      msg = _("Invalid token header. Token string should not contain invalid characters.")
+      raise exceptions.AuthenticationFailed(msg) from None
+
+  def authenticate(self, request):
+    key = self.get_key(request)
+    return None if key is None else self.authenticate_credentials(key)
+
+  async def aauthenticate(self, request):
+    key = self.get_key(request)
+    return None if key is None else await self.aauthenticate_credentials(key)
+
+  def authenticate_credentials(self, key):
+    cache_key = token_cache_key(key)
+    started = time.perf_counter()
+    tier = LOCAL_TIER
+    try:
+      entry = local_tokens.get(cache_key)
+      if entry is None:
+        tier = CACHE_TIER
+        entry = cache.get(cache_key)
+        if entry is None:
+          tier = DB_TIER
+          entry = self.get_user_from_db(key)
+          cache.set(cache_key, entry, self.entry_timeout(entry))
+        local_tokens.set(cache_key, entry)
+    finally:
+      timing.mark(TOKEN_METRIC, time.perf_counter() - started, tier)
+
+    user, expires_at = entry
+    now = timezone.now()
+    self._check_expiry(expires_at, now)
+    if self.model.objects.renewal_due(expires_at, now):
+      renewed = self.model.objects.renew(key, now)
+      if renewed is None:
+        # Deleted (e.g. by LogoutView) or renewed elsewhere: never re-cache
+        # the entry as is; reload it, which fails for a deleted token
+        local_tokens.delete(cache_key)
+        cache.delete(cache_key)
+        entry = self.get_user_from_db(key)
+        self._check_expiry(entry[1], now)
+      else:
+        entry = (user, renewed)
+      cache.set(cache_key, entry, self.entry_timeout(entry))
+      local_tokens.set(cache_key, entry)
+    return self._credentials(entry, key)
+
+  async def aauthenticate_credentials(self, key):
+    cache_key = token_cache_key(key)
+    started = time.perf_counter()
+    tier = LOCAL_TIER
+    try:
+      entry = local_tokens.get(cache_key)
+      if entry is None:
+        tier = CACHE_TIER
+        entry = await cache.aget(cache_key)
+        if entry is None:
+          tier = DB_TIER
+          entry = await self.aget_user_from_db(key)
+          await cache.aset(cache_key, entry, self.entry_timeout(entry))
+        local_tokens.set(cache_key, entry)
+    finally:
+      timing.mark(TOKEN_METRIC, time.perf_counter() - started, tier)
+
+    user, expires_at = entry
+    now = timezone.now()
+    self._check_expiry(expires_at, now)
+    if self.model.objects.renewal_due(expires_at, now):
+      renewed = await self.model.objects.arenew(key, now)
+      if renewed is None:
+        local_tokens.delete(cache_key)
+        await cache.adelete(cache_key)
+        entry = await self.aget_user_from_db(key)
+        self._check_expiry(entry[1], now)
+      else:
+        entry = (user, renewed)
+      await cache.aset(cache_key, entry, self.entry_timeout(entry))
+      local_tokens.set(cache_key, entry)
+    return self._credentials(entry, key)
+
+  @property
+  def cache_timeout(self):
+    return getattr(settings, "TOKEN_CACHE_TIMEOUT", DEFAULT_TOKEN_CACHE_TIMEOUT)
+
+  def entry_timeout(self, entry):
+    """ Cache timeout for ``(user, expires_at)``: never past the token's expiry """
+    remaining = (entry[1] - timezone.now()).total_seconds()
+    return max(1, min(self.cache_timeout, int(remaining)))
+
+  def _check_expiry(self, expires_at, now):
+    if expires_at <= now:
+      raise exceptions.AuthenticationFailed(_("Token has expired."))
+
+  def _credentials(self, entry, key):
+    user, expires_at = entry
+    if not user.is_active:
+      raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+
+    # Hand out copies so a request never mutates the shared cached instance
+    user = copy.copy(user)
+    token = self.get_model()(key=key, user=user, expires_at=expires_at)
+    return (user, token)
+
+  def get_user_from_db(self, key):
+    """ ``(user, expires_at)`` of a token """
+    model = self.get_model()
+    try:
+      token = model.objects.select_related("user").get(key=key)
+    except model.DoesNotExist:
+      raise exceptions.AuthenticationFailed(_("Invalid token."))
+    return (token.user, token.expires_at)
+
+  async def aget_user_from_db(self, key):
+    model = self.get_model()
+    try:
+      token = await model.objects.select_related("user").aget(key=key)
+    except model.DoesNotExist:
+      raise exceptions.AuthenticationFailed(_("Invalid token."))
+    return (token.user, token.expires_at)
+
+
+class KeycloakJWTAuthentication(BaseAuthentication):
+  """
+    Authenticate ``Authorization: Bearer <jwt>`` Keycloak access tokens.
+
+    The token is verified locally against the cached realm JWKS and the user
+    is created or updated from its claims. Disabled while KEYCLOAK_JWKS_URL
+    is unset.
+  """
+
+  keyword = "Bearer"
+
+  def get_token(self, request):
+    """ The bearer token, or None for other schemes """
+    if not getattr(settings, "KEYCLOAK_JWKS_URL", None):
+      return None
+
+    auth = get_authorization_header(request).split()
+    if not auth or auth[0].lower() != self.keyword.lower().encode():
+      return None
+    if len(auth) != 2:  # noqa: PLR2004
+      raise exceptions.AuthenticationFailed(_("Invalid bearer header."))
+    try:
+      return auth[1].decode()
+    except UnicodeError as exc:
+      raise exceptions.AuthenticationFailed(_("Invalid access token.")) from exc
+
+  def get_claims(self, request):
+    """ Verified claims of the bearer token, or None for other schemes """
+    token = self.get_token(request)
+    if token is None:
+      return None
+    try:
+      return decode_access_token(token)
+    except KeycloakTokenError as exc:
+      raise exceptions.AuthenticationFailed(_("Invalid access token.")) from exc
+
+  async def aget_claims(self, request):
+    """ get_claims without blocking the event loop on a JWKS fetch """
+    token = self.get_token(request)
+    if token is None:
+      return None
+    try:
+      return await adecode_access_token(token)
+    except KeycloakTokenError as exc:
+      raise exceptions.AuthenticationFailed(_("Invalid access token.")) from exc
+
+  def authenticate(self, request):
+    claims = self.get_claims(request)
+    if claims is None:
+      return None
+    try:
+      user = get_or_create_user(claims)
+    except KeycloakTokenError as exc:
+      raise exceptions.AuthenticationFailed(_("Invalid access token.")) from exc
+    return self._credentials(user, claims)
+
+  async def aauthenticate(self, request):
+    claims = await self.aget_claims(request)
+    if claims is None:
+      return None
+    try:
+      user = await aget_or_create_user(claims)
+    except KeycloakTokenError as exc:
+      raise exceptions.AuthenticationFailed(_("Invalid access token.")) from exc
+    return self._credentials(user, claims)
+
+  def _credentials(self, user, claims):
+    if not user.is_active:
+      raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+    return (user, claims)
+
+  def authenticate_header(self, request):
+    return self.keyword
+
+
+def _is_same_origin(headers):
+  origin = headers.get("origin")
+  if not origin:
+    return False
+  trusted = getattr(settings, "CSRF_TRUSTED_ORIGINS", [])
+  return urlsplit(origin).netloc == headers.get("host") or origin in trusted
+
+
+async def authenticate_websocket(scope):
+  """
+    User for a websocket handshake, or None.
+
+    Browsers cannot set headers on websockets, so besides an Authorization
+    header the API token may come as ``?token=`` and a Keycloak access token
+    as ``?access_token=``. The session cookie is only honoured for
+    same-origin pages, as cross-site websockets are not covered by CSRF.
+  """
+  headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers", [])}
+  params = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+
+  request = HttpRequest()
+  if "authorization" in headers:
+    request.META["HTTP_AUTHORIZATION"] = headers["authorization"]
+  elif "token" in params:
+    request.META["HTTP_AUTHORIZATION"] = f"{CachedTokenAuthentication.keyword} {params['token'][0]}"
+  elif "access_token" in params:
+    request.META["HTTP_AUTHORIZATION"] = f"{KeycloakJWTAuthentication.keyword} {params['access_token'][0]}"
+
+  try:
+    for authentication_class in (CachedTokenAuthentication, KeycloakJWTAuthentication):
+      result = await authentication_class().aauthenticate(request)
+      if result is not None:
+        return result[0]
+  except exceptions.AuthenticationFailed:
+    return None
+
+  if "HTTP_AUTHORIZATION" in request.META or not _is_same_origin(headers):
+    return None
+  cookies = SimpleCookie(headers.get("cookie", ""))
+  session_cookie = cookies.get(settings.SESSION_COOKIE_NAME)
+  if session_cookie is None:
+    return None
+  request.session = import_string(f"{settings.SESSION_ENGINE}.SessionStore")(session_cookie.value)
+  user = await aget_user(request)
+  return user if user.is_authenticated and user.is_active else None
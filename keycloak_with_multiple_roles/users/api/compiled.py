@@ -0,0 +1,201 @@
+"""
+Compiled fast path for rendering read-only model serializers.
+
+DRF renders every row through the generic field machinery: attribute
+lookup per field, ``to_representation`` per field and a ``reverse()`` per
+hyperlink. ``compile_serializer`` turns a serializer whose fields are plain
+model columns into a ``values()`` query and a list of (name, column,
+converter) steps, so a row becomes a dict with one loop. Hyperlinks are
+rendered from a URL template reversed once per render.
+
+Serializers that cannot be compiled exactly (method fields, nested or
+related serializers, custom ``to_representation``, nullable joins, ...)
+compile to None, and callers use the normal DRF path.
+"""
+import functools
+import re
+from types import SimpleNamespace
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import NoReverseMatch
+from rest_framework import serializers
+from rest_framework.relations import Hyperlink
+from rest_framework.relations import HyperlinkedIdentityField
+
+from keycloak_with_multiple_roles.users.timing import SERIALIZER
+from keycloak_with_multiple_roles.users.timing import current
+from keycloak_with_multiple_roles.users.timing import timed
+
+# Fields whose to_representation returns database values unchanged
+IDENTITY_FIELDS = (
+  serializers.CharField,
+  serializers.EmailField,
+  serializers.SlugField,
+  serializers.IntegerField,
+  serializers.BooleanField,
+  serializers.ReadOnlyField,
+)
+CONVERTED_FIELDS = (
+  serializers.UUIDField,
+  serializers.DateTimeField,
+  serializers.DateField,
+  serializers.TimeField,
+  serializers.FloatField,
+  serializers.DecimalField,
+  serializers.ChoiceField,
+  serializers.URLField,
+)
+
+# Lookup values made of these characters are substituted into the URL
+# template: they match UserViewSet's lookup pattern [^/]+ and are the
+# characters reverse() leaves unquoted (RFC 3986 pchar). Anything else
+# goes through reverse() like DRF does
+TEMPLATE_SAFE_LOOKUP = re.compile(r"[-A-Za-z0-9_.~!$&'()*+,;=:@]+")
+LOOKUP_SENTINEL = "Compiled-Lookup_0"
+
+
+class UrlTemplate:
+  """ Hyperlinks of one HyperlinkedIdentityField for the current request """
+
+  def __init__(self, field, request, format):
+    self.field = field
+    self.request = request
+    # Same format choice as HyperlinkedRelatedField.to_representation
+    self.format = field.format if format and field.format and field.format != format else format
+    try:
+      url = self.reverse(LOOKUP_SENTINEL)
+    except NoReverseMatch:
+      # The pattern rejects plain words, e.g. <int:pk>; reverse every row
+      url = None
+    self.prefix, self.suffix = url.split(LOOKUP_SENTINEL, 1) if url else (None, None)
+
+  def reverse(self, value):
+    row = SimpleNamespace(**{self.field.lookup_field: value})
+    return self.field.get_url(row, self.field.view_name, self.request, self.format)
+
+  def __call__(self, value):
+    if self.prefix is not None and TEMPLATE_SAFE_LOOKUP.fullmatch(str(value)):
+      return Hyperlink(f"{self.prefix}{value}{self.suffix}", None)
+    try:
+      return Hyperlink(self.reverse(value), None)
+    except NoReverseMatch:
+      msg = (
+        f'Could not resolve URL for hyperlinked relationship using view name "{self.field.view_name}". '
+        "You may have failed to include the related model in your API, or incorrectly "
+        "configured the `lookup_field` attribute on this field."
+      )
+      if value in ("", None):
+        value_string = {"": "the empty string", None: "None"}[value]
+        msg += (
+          " WARNING: The value of the field on the model instance was "
+          f"{value_string}, which may be why it didn't match any entries in your URL conf."
+        )
+      raise ImproperlyConfigured(msg) from None
+
+
+class CompiledSerializer:
+  """
+    Read path of a serializer compiled to ``values()`` rows.
+
+    ``steps`` are ``(name, column, converter)`` in field order. A None
+    converter copies the column as is; a HyperlinkedIdentityField converter
+    is turned into a UrlTemplate for each render.
+  """
+
+  def __init__(self, serializer_class, steps):
+    self.serializer_class = serializer_class
+    self.steps = steps
+    self.links = {name for name, _, convert in steps if isinstance(convert, HyperlinkedIdentityField)}
+    self.columns = tuple(dict.fromkeys(column for _, column, _ in steps))
+
+  def values(self, queryset, *extra):
+    """ ``queryset`` as rows holding every column the serializer reads, plus ``extra`` """
+    return queryset.values(*dict.fromkeys(self.columns + extra))
+
+  def render(self, rows, context):
+    """ Render ``values()`` rows exactly as ``serializer_class(many=True).data`` would """
+    if current() is None:
+      return self._render(rows, context)
+    with timed(SERIALIZER):
+      return self._render(rows, context)
+
+  def _render(self, rows, context):
+    request = context.get("request")
+    if self.links:
+      assert request is not None, (
+        f"{self.serializer_class.__name__} renders hyperlinks and needs the request in its context."
+      )
+    # (name, column, converter, whether None is converted too)
+    steps = [
+      (name, column, UrlTemplate(convert, request, context.get("format")), True)
+      if name in self.links else (name, column, convert, False)
+      for name, column, convert in self.steps
+    ]
+    data = []
+    for row in rows:
+      item = {}
+      for name, column, convert, convert_none in steps:
+        value = row[column]
+        item[name] = value if convert is None or (value is None and not convert_none) else convert(value)
+      data.append(item)
+    return serializers.ReturnList(data, serializer=None)
+
+
+def _column(model, source_attrs):
+  """
+    ``values()`` column for a dotted source, or None.
+
+    Every hop must be a non-null forward relation: DRF skips the field when
+    an intermediate object is missing, which a joined None cannot express.
+  """
+  if not source_attrs:
+    return None
+  opts = model._meta
+  for position, attr in enumerate(source_attrs):
+    if attr == "pk":
+      attr = opts.pk.name
+    try:
+      field = opts.get_field(attr)
+    except FieldDoesNotExist:
+      return None
+    if position == len(source_attrs) - 1:
+      return "__".join(source_attrs) if field.concrete and not field.is_relation else None
+    if not (field.many_to_one or field.one_to_one) or not field.concrete or field.null:
+      return None
+    opts = field.related_model._meta
+  return None
+
+
+@functools.cache
+def compile_serializer(serializer_class):
+  """
+    Compile a ModelSerializer class for read-only list rendering.
+
+    Returns:
+      CompiledSerializer: The compiled serializer, or None when any field
+      needs DRF's generic path.
+  """
+  if not issubclass(serializer_class, serializers.ModelSerializer):
+    return None
+  if serializer_class.to_representation is not serializers.Serializer.to_representation:
+    return None
+  model = serializer_class.Meta.model
+  steps = []
+  for field in serializer_class()._readable_fields:
+    if type(field) is HyperlinkedIdentityField:
+      column = _column(model, [field.lookup_field])
+      if column is None:
+        return None
+      steps.append((field.field_name, column, field))
+      continue
+    column = _column(model, field.source_attrs)
+    if column is None:
+      return None
+    if type(field) in IDENTITY_FIELDS:
+      steps.append((field.field_name, column, None))
+    elif type(field) in CONVERTED_FIELDS:
+      steps.append((field.field_name, column, field.to_representation))
+    else:
+      return None
+  return CompiledSerializer(serializer_class, steps)
@@ -0,0 +1,57 @@
+"""
+Conditional GET support for the users API.
+
+Views derive an ETag and a Last-Modified date from the versions
+(``updated_at`` and counters) of the rows a response is built from, and
+answer ``304 Not Modified`` before serializing anything when the client's
+copy is still current.
+"""
+import hashlib
+
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.utils.http import quote_etag
+
+
+def make_etag(*parts):
+  """ Strong ETag for a response built from ``parts``, e.g. row versions """
+  return quote_etag(hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest())
+
+
+def latest(*timestamps):
+  """ Most recent of the given datetimes, ignoring None """
+  timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+  return max(timestamps) if timestamps else None
+
+
+def set_validators(response, etag, last_modified=None):
+  """ Add ETag/Last-Modified, and make clients revalidate instead of reusing """
+  response["ETag"] = etag
+  if last_modified is not None:
+    response["Last-Modified"] = http_date(last_modified.timestamp())
+  # Responses are per user: private, and always revalidated with the validators
+  patch_cache_control(response, private=True, no_cache=True)
+  return response
+
+
+def not_modified(request, etag, last_modified=None):
+  """
+    ``304 Not Modified`` when If-None-Match/If-Modified-Since match.
+
+    Returns:
+      HttpResponse: The 304 response carrying the validators, or None when
+      the full response has to be built.
+  """
+  if request.method not in ("GET", "HEAD"):
+    return None
+  # The 304 copies its validators from this response
+  validators = set_validators(HttpResponse(), etag, last_modified)
+  response = get_conditional_response(
+    request,
+    etag=etag,
+    last_modified=int(last_modified.timestamp()) if last_modified is not None else None,
+    response=validators,
+  )
+  return None if response is validators else response
@@ -0,0 +1,32 @@
+"""
+Translation of domain exceptions raised below the API into DRF's.
+"""
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework import status
+from rest_framework.views import exception_handler as drf_exception_handler
+
+from keycloak_with_multiple_roles.users.hashing import PasswordHashingUnavailable
+
+
+class PasswordHashingBusy(exceptions.APIException):
+  status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+  default_detail = _("Too many sign-in requests right now, please retry shortly.")
+  default_code = "password_hashing_unavailable"
+
+  def __init__(self, detail=None, code=None, wait=None):
+    super().__init__(detail, code)
+    # Read by DRF's exception handler and AsyncAPIView for Retry-After
+    self.wait = wait
+
+
+def as_api_exception(exc):
+  """ The APIException answering ``exc``, or ``exc`` itself """
+  if isinstance(exc, PasswordHashingUnavailable):
+    return PasswordHashingBusy(wait=exc.wait)
+  return exc
+
+
+def exception_handler(exc, context):
+  """ REST_FRAMEWORK's EXCEPTION_HANDLER: DRF's, after as_api_exception """
+  return drf_exception_handler(as_api_exception(exc), context)
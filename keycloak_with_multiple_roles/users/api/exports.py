@@ -0,0 +1,173 @@
+"""
+Constant-memory roster exports for the users API.
+
+Rows are read with ``values()`` and ``iterator(chunk_size=...)`` (a
+server-side cursor on PostgreSQL) and encoded one at a time, so the export
+never holds more than one chunk in memory and skips the serializer layer.
+
+Under ASGI a sync iterator would be drained into a list before the first
+byte is sent, so ``astream_export`` reads with ``aiterator()`` instead and
+hands over one encoded chunk at a time.
+"""
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.models import User
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = {
+  "ndjson": "application/x-ndjson",
+  "csv": "text/csv",
+}
+
+
+def user_rows(params):
+  queryset = User.objects.order_by("pk")
+  if params.get("user_type"):
+    queryset = queryset.filter(user_type=params["user_type"])
+  return queryset.values(
+    "id", "uuid", "username", "email", "name", "user_type", "is_active", "date_joined",
+  )
+
+
+def parent_rows(params):
+  queryset = Parent.objects.order_by("pk")
+  return queryset.values(
+    "user_id",
+    "family_code",
+    "phone_number",
+    "address",
+    "student_count",
+    "created_at",
+    username=F("user__username"),
+    email=F("user__email"),
+    name=F("user__name"),
+  )
+
+
+def student_rows(params):
+  queryset = Student.objects.order_by("pk")
+  for name in ("grade", "class_name"):
+    if params.get(name):
+      queryset = queryset.filter(**{name: params[name]})
+  queryset = queryset.annotate(
+    parent_family_code=F("parent_id"),
+    parent_username=F("parent__user__username"),
+    parent_email=F("parent__user__email"),
+    parent_name=F("parent__user__name"),
+  )
+  return queryset.values(
+    "student_code",
+    "grade",
+    "class_name",
+    "parent_family_code",
+    "created_at",
+    "parent_username",
+    "parent_email",
+    "parent_name",
+    user_id=F("student_link_id"),
+    username=F("student_link__username"),
+    email=F("student_link__email"),
+    name=F("student_link__name"),
+  )
+
+
+EXPORT_RESOURCES = {
+  "users": user_rows,
+  "parents": parent_rows,
+  "students": student_rows,
+}
+
+
+class _Echo:
+  """ File-like object handing back what csv.writer writes """
+
+  def write(self, value):
+    return value
+
+
+class NdjsonEncoder:
+  """ One JSON object per line """
+
+  def __init__(self, queryset):
+    self.encoder = DjangoJSONEncoder()
+
+  def header(self):
+    return None
+
+  def line(self, row):
+    return self.encoder.encode(row) + "\n"
+
+
+class CsvEncoder:
+  """ A header of the selected columns, then one CSV record per row """
+
+  def __init__(self, queryset):
+    self.writer = csv.writer(_Echo())
+    self.columns = list(queryset.query.values_select) + list(queryset.query.annotation_select)
+
+  def header(self):
+    return self.writer.writerow(self.columns)
+
+  def line(self, row):
+    return self.writer.writerow([row[column] for column in self.columns])
+
+
+EXPORT_ENCODERS = {
+  "ndjson": NdjsonEncoder,
+  "csv": CsvEncoder,
+}
+
+
+def _prepare(resource, export_format, params):
+  queryset = EXPORT_RESOURCES[resource](params)
+  return queryset, EXPORT_ENCODERS[export_format](queryset)
+
+
+def stream_export(resource, export_format, params):
+  """
+    Return an iterator of encoded lines for ``resource`` in ``export_format``.
+
+    Raises:
+      KeyError: Unknown resource or format.
+  """
+  queryset, encoder = _prepare(resource, export_format, params)
+
+  def lines():
+    header = encoder.header()
+    if header is not None:
+      yield header
+    for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+      yield encoder.line(row)
+
+  return lines()
+
+
+def astream_export(resource, export_format, params):
+  """
+    Async stream_export for ASGI, yielding the lines of EXPORT_CHUNK_SIZE
+    rows at a time.
+
+    Raises:
+      KeyError: Unknown resource or format.
+  """
+  queryset, encoder = _prepare(resource, export_format, params)
+
+  async def chunks():
+    lines = []
+    header = encoder.header()
+    if header is not None:
+      lines.append(header)
+    async for row in queryset.aiterator(chunk_size=EXPORT_CHUNK_SIZE):
+      lines.append(encoder.line(row))
+      if len(lines) >= EXPORT_CHUNK_SIZE:
+        yield "".join(lines)
+        lines = []
+    if lines:
+      yield "".join(lines)
+
+  return chunks()
@@ -0,0 +1,90 @@
+"""
+Per-request batch loaders used by the users API serializers.
+"""
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import prefetch_students
+
+PARENT_LOADER_KEY = "parent_loader"
+
+
+class ParentLoader:
+  """
+    DataLoader-style resolver for family code -> Parent.
+
+    Codes are collected with ``prime`` while a page is rendered and resolved
+    together with a single ``IN`` query on the first ``load``. Every result,
+    including misses, is memoized so each parent is fetched at most once.
+    Parents that arrived through ``select_related`` are seeded with
+    ``prime_parents``; their students are fetched in one batch the first
+    time a ``load(..., students=True)`` needs them.
+  """
+
+  def __init__(self):
+    self._cache = {}
+    self._pending = set()
+
+  def prime(self, family_codes):
+    """ Queue family codes to be resolved with the next batch """
+    self._pending.update(code for code in family_codes if code and code not in self._cache)
+
+  def prime_parents(self, parents):
+    """ Seed the loader with parents that are already loaded """
+    for parent in parents:
+      cached = self._cache.get(parent.family_code)
+      # Keep a copy that already carries its students
+      if cached is None or not cached.students_loaded():
+        self._cache[parent.family_code] = parent
+      self._pending.discard(parent.family_code)
+
+  def load(self, family_code, students=False):
+    """
+      Resolve a family code.
+
+      Args:
+        family_code: The parent's family code.
+        students: Whether the parent's students must be loaded too.
+
+      Returns:
+        Parent: Parent object or None if not found.
+    """
+    if not family_code:
+      return None
+    if family_code not in self._cache:
+      self._pending.add(family_code)
+      self._dispatch()
+    parent = self._cache[family_code]
+    if students and parent is not None and not parent.students_loaded():
+      prefetch_students([
+        cached for cached in self._cache.values()
+        if cached is not None and not cached.students_loaded()
+      ])
+    return parent
+
+  def _dispatch(self):
+    codes, self._pending = self._pending, set()
+    parents = (
+      Parent.objects.filter(family_code__in=codes)
+      .select_related("user")
+      .with_students()
+    )
+    found = {parent.family_code: parent for parent in parents}
+    for code in codes:
+      self._cache[code] = found.get(code)
+
+
+def get_parent_loader(context):
+  """
+    Return the ParentLoader shared by everything rendered for this request.
+
+    The loader lives on the request when there is one, so separate
+    serializers used by the same view share it; otherwise it is kept in the
+    serializer context.
+  """
+  request = context.get("request")
+  if request is not None:
+    loader = getattr(request, PARENT_LOADER_KEY, None)
+    if loader is None:
+      loader = ParentLoader()
+      setattr(request, PARENT_LOADER_KEY, loader)
+    return loader
+  return context.setdefault(PARENT_LOADER_KEY, ParentLoader())
@@ -0,0 +1,153 @@
+"""
+Pagination classes for the users API.
+"""
+import base64
+import json
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from django.db import connections
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class StandardResultSetPagination(PageNumberPagination):
+  page_size = 10
+  page_size_query_param = 'page-size'
+  max_page_size = 100
+
+
+def estimated_count(queryset):
+  """
+    Approximate row count of a queryset from planner statistics.
+
+    Uses the row estimate of EXPLAIN on PostgreSQL, which costs no table
+    scan. Other databases fall back to an exact COUNT(*).
+  """
+  connection = connections[queryset.db]
+  if connection.vendor != "postgresql":
+    return queryset.count()
+  sql, params = queryset.order_by().values("pk").query.sql_with_params()
+  with connection.cursor() as cursor:
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+    plan = cursor.fetchone()[0]
+  if isinstance(plan, str):
+    plan = json.loads(plan)
+  return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class KeysetPagination(BasePagination):
+  """
+    Cursor pagination on a unique ordering key, e.g. (date_joined, id).
+
+    Each page is fetched with a ``WHERE (date_joined, id) < cursor`` style
+    filter instead of an OFFSET, so deep pages cost the same as the first
+    one when a matching index exists. No total is computed unless the
+    client asks for ``?count=estimated``.
+  """
+
+  ordering = ("-date_joined", "-id")
+  page_size = 10
+  page_size_query_param = 'page-size'
+  max_page_size = 100
+  cursor_query_param = "cursor"
+  count_query_param = "count"
+  invalid_cursor_message = _("Invalid cursor")
+
+  def paginate_queryset(self, queryset, request, view=None):
+    self.request = request
+    self.model = queryset.model
+    self.page_size = self.get_page_size(request)
+    queryset = queryset.order_by(*self.ordering)
+
+    self.count = None
+    if request.query_params.get(self.count_query_param) == "estimated":
+      self.count = estimated_count(queryset)
+
+    position = self.decode_cursor(request, queryset.model)
+    if position is not None:
+      queryset = queryset.filter(self.get_keyset_filter(position))
+
+    rows = list(queryset[:self.page_size + 1])
+    self.page = rows[:self.page_size]
+    self.has_next = len(rows) > self.page_size
+    return self.page
+
+  def get_page_size(self, request):
+    try:
+      size = int(request.query_params[self.page_size_query_param])
+    except (KeyError, ValueError):
+      return self.page_size
+    return min(max(size, 1), self.max_page_size)
+
+  def get_keyset_filter(self, position):
+    """
+      Build ``(f1, f2, ...) < (v1, v2, ...)`` as OR-ed Q objects.
+
+      Comparison direction follows each field's ordering. The OR is ANDed
+      with ``f1 <= v1``: databases cannot use the OR alone as a range on the
+      (f1, f2, ...) index and would scan it from the first row, so deep
+      pages would get slower and slower.
+    """
+    keyset = Q()
+    equal = {}
+    for ordering, value in zip(self.ordering, position, strict=True):
+      name = ordering.lstrip("-")
+      lookup = "lt" if ordering.startswith("-") else "gt"
+      keyset |= Q(**equal, **{f"{name}__{lookup}": value})
+      equal[name] = value
+    leading = self.ordering[0]
+    bound = "lte" if leading.startswith("-") else "gte"
+    return Q(**{f"{leading.lstrip('-')}__{bound}": position[0]}) & keyset
+
+  def encode_cursor(self, instance):
+    if isinstance(instance, dict):
+      # A row of a values() queryset, e.g. from api.compiled
+      instance = SimpleNamespace(**instance)
+    opts = self.model._meta
+    values = [opts.get_field(ordering.lstrip("-")).value_to_string(instance) for ordering in self.ordering]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+  def decode_cursor(self, request, model):
+    encoded = request.query_params.get(self.cursor_query_param)
+    if not encoded:
+      return None
+    try:
+      values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+      return [
+        model._meta.get_field(ordering.lstrip("-")).to_python(value)
+        for ordering, value in zip(self.ordering, values, strict=True)
+      ]
+    except Exception:  # noqa: BLE001
+      raise NotFound(self.invalid_cursor_message) from None
+
+  def get_next_link(self):
+    if not self.has_next:
+      return None
+    url = self.request.build_absolute_uri()
+    return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+  def get_paginated_response(self, data):
+    response = OrderedDict([("next", self.get_next_link())])
+    if self.count is not None:
+      response["count"] = self.count
+      response["count_is_estimate"] = True
+    response["results"] = data
+    return Response(response)
+
+  def get_paginated_response_schema(self, schema):
+    return {
+      "type": "object",
+      "required": ["results"],
+      "properties": {
+        "next": {"type": "string", "nullable": True, "format": "uri"},
+        "count": {"type": "integer", "description": "Approximate total, only with ?count=estimated"},
+        "count_is_estimate": {"type": "boolean"},
+        "results": schema,
+      },
+    }
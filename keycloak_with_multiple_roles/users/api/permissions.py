@@ -0,0 +1,26 @@
+"""
+DRF permissions on user roles.
+
+Roles are read from ``User.role_mask``, which comes with the user row the
+authentication class loaded (or cached with the token), so checking them
+costs no query.
+"""
+from rest_framework.permissions import BasePermission
+
+
+class HasRole(BasePermission):
+  """
+    Allows users holding any of ``roles``.
+
+    Subclass and set ``roles``, or use ``HasRole.of("parent", "admin")``.
+  """
+
+  roles = ()
+
+  @classmethod
+  def of(cls, *roles):
+    return type(f"HasRole[{','.join(roles)}]", (cls,), {"roles": roles})
+
+  def has_permission(self, request, view):
+    user = request.user
+    return bool(user and user.is_authenticated and user.has_any_role(*self.roles))
@@ -1,13 +1,23 @@
 
+from django.db import models
 from rest_framework import serializers
 
 from keycloak_with_multiple_roles.users.models import User, Parent, Student
+from keycloak_with_multiple_roles.users.timing import TimedDataMixin
+from .loaders import get_parent_loader
+from .throttling import FamilyCodeField, check_family_code
 
-class UserSerializer(serializers.ModelSerializer[User]):
+MAX_BULK_LINKS = 1000
+
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+  """ ListSerializer whose rendering is reported to users.timing """
+
+class UserSerializer(TimedDataMixin, serializers.ModelSerializer[User]):
   """ Basic User serializer with essestial fields only"""
 
   class Meta:
     model = User
+    list_serializer_class = TimedListSerializer
     fields = [
       "id",
       "username",
@@ -25,11 +35,12 @@ class UserSerializer(serializers.ModelSerializer[User]):
       "date_joined": {"read_only":True},
     }
 
-class UserMininmalSerializer(serializers.ModelSerializer[User]):
+class UserMininmalSerializer(TimedDataMixin, serializers.ModelSerializer[User]):
   """ Minimal User serializer for nested representation """
 
   class Meta:
     model = User
+    list_serializer_class = TimedListSerializer
     fields = ["id", "uuid", "username", "email", "name", "user_type"]
     read_only_fields = fields
 
@@ -60,7 +71,22 @@ class UserCreateSerializer(serializers.ModelSerializer[User]):
       user.save()
       return user
 
-class StudentMinimalSerializer(serializers.ModelSerializer):
+class StudentListSerializer(TimedListSerializer):
+  """ List serializer that batches parent lookups for a whole page of students """
+
+  def to_representation(self, data):
+    iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+    students = list(iterable)
+    loader = get_parent_loader(self.context)
+    # Parents joined with select_related("parent") need no lookup of their own
+    loader.prime_parents(
+      student.parent for student in students
+      if student.parent_id and Student.parent.is_cached(student)
+    )
+    loader.prime(student.parent_id for student in students)
+    return super().to_representation(students)
+
+class StudentMinimalSerializer(TimedDataMixin, serializers.ModelSerializer):
   """ Minimal student serializer for nested serialization"""
 
   student_email = serializers.EmailField(source="student_link.email", read_only=True)
@@ -71,12 +97,13 @@ class StudentMinimalSerializer(serializers.ModelSerializer):
   class Meta:
     model = Student
     fields = ["uuid","student_code","student_email", "student_name", "student_username","grade", "class_name","is_linked"]
+    list_serializer_class = StudentListSerializer
 
-  def get_is_linkedin(self, obj):
+  def get_is_linked(self, obj):
     """ check if student is linked to parent """
     return obj.is_linked_to_parent()
 
-class StudentSerializer(serializers.ModelSerializer):
+class StudentSerializer(TimedDataMixin, serializers.ModelSerializer):
   """ Full student serializer with all fields"""
 
   #Nested user information
@@ -108,27 +135,39 @@ class StudentSerializer(serializers.ModelSerializer):
       "updated_at"
    ]
     read_only_fields = ["uuid", "student_code", "created_at", "updated_at"]
+    list_serializer_class = StudentListSerializer
+
+  @staticmethod
+  def setup_eager_loading(queryset):
+    """ Join users and parents, so a page of students is one query """
+    return queryset.select_related("student_link", "parent__user")
+
+  def _load_parent(self, obj, students=False):
+    """ Resolve the student's parent through the per-request loader """
+    if not students and Student.parent.is_cached(obj):
+      return obj.parent
+    return get_parent_loader(self.context).load(obj.parent_id, students=students)
 
   def get_parent(self, obj):
     """ Get parent information """
-    parent = obj.get_parent()
+    parent = self._load_parent(obj)
     if parent:
 
       return {
         "uuid": str(parent.uuid),
         "family_code": parent.family_code,
-        "email": parent.email,
-        "name": parent.username
+        "email": parent.user.email,
+        "name": parent.user.name
       }
     return None
 
   def get_parent_info(self, obj):
     """ Get parent information """
-    parent = obj.get_parent()
+    parent = self._load_parent(obj, students=True)
     if parent:
       #Use ParentSerializer to avoid circular imports
       from keycloak_with_multiple_roles.users.api.serializers import ParentSerializer
-      return ParentSerializer(parent).data
+      return ParentSerializer(parent, context=self.context).data
     return None
 
   def get_is_linked(self, obj):
@@ -145,7 +184,7 @@ class StudentCreateSerializer(serializers.ModelSerializer):
   password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
 
   #student fields
-  parent_family_code = serializers.CharField(required=True)
+  parent_family_code = FamilyCodeField(source="parent", required=True)
 
   class Meta:
     model = Student
@@ -195,6 +234,11 @@ class StudentCreateSerializer(serializers.ModelSerializer):
 class StudentUpdateSerializer(serializers.ModelSerializer):
   """ Serializer for updating student profile """
 
+  parent_family_code = FamilyCodeField(
+    source="parent", required=False, allow_null=True,
+    error_messages={"does_not_exist": "Invalid family code. Parent not found."},
+  )
+
   class Meta:
     model = Student
     fields = [
@@ -203,13 +247,6 @@ class StudentUpdateSerializer(serializers.ModelSerializer):
       "class_name"
     ]
 
-  def validate_parent_family_code(self, value):
-    """ Validate that family code exist if provided """
-    if value:
-      if not Parent.objects.filter(family_code=value).exists():
-        raise serializers.ValidationError("Invalid family code. Parent not found.")
-      return value
-
 class StudentLinkToParentSerializer(serializers.ModelSerializer):
   """ Serializer for linking a student ot a parent via a family code"""
 
@@ -217,42 +254,57 @@ class StudentLinkToParentSerializer(serializers.ModelSerializer):
 
   def validate_family_code(self, value):
     """ Validate that family code exists """
+    check_family_code(self.context, value)
     if not Parent.objects.filter(family_code=value).exists():
       raise serializers.ValidationError("Invalid family code. Parent not found.")
     return value
 
-class ParentMinimalSerializer(serializers.ModelSerializer):
+class StudentLinkSerializer(serializers.Serializer):
+  """ One (student_code, family_code) pair of a bulk link; no family_code unlinks """
+
+  student_code = serializers.CharField(max_length=10)
+  family_code = serializers.CharField(max_length=10, allow_null=True, required=False, default=None)
+
+class BulkStudentLinkSerializer(serializers.Serializer):
+  """ Body of StudentLinksView; codes are checked in bulk by users.links """
+
+  links = StudentLinkSerializer(many=True, allow_empty=False, max_length=MAX_BULK_LINKS)
+
+class ParentMinimalSerializer(TimedDataMixin, serializers.ModelSerializer):
   """ Minimal parent serializer for nested serialization"""
 
-  parent_email = serializers.EmailField(source="parent_link.email", read_only=True)
-  parent_name = serializers.CharField(source="parent_link.name", read_only=True)
-  parent_username = serializers.CharField(source="parent_link.username", read_only=True)
-  students_count = serializers.SerializerMethodField()
+  parent_email = serializers.EmailField(source="user.email", read_only=True)
+  parent_name = serializers.CharField(source="user.name", read_only=True)
+  parent_username = serializers.CharField(source="user.username", read_only=True)
+  students_count = serializers.IntegerField(source="student_count", read_only=True)
 
   class Meta:
     model = Parent
+    list_serializer_class = TimedListSerializer
     fields = ["uuid", "family_code", "parent_email", "parent_name", "parent_username", "students_count","phone_number"]
     read_only_fields = fields
 
-  def get_students_count(self, obj):
-    """ Get number of students linked to parent """
-    return obj.get_students_count()
+  @staticmethod
+  def setup_eager_loading(queryset):
+    """ Load users for a page of parents up front """
+    return queryset.select_related("user")
 
-class ParentSerializer(serializers.ModelSerializer):
+class ParentSerializer(TimedDataMixin, serializers.ModelSerializer):
   """ full parent serializer with all fields """
 
   # Nested user information
-  user = UserMininmalSerializer(source='parent_link', read_only=True)
+  user = UserMininmalSerializer(read_only=True)
 
   #User ID for reference
-  user_id = serializers.IntegerField(source='parent_link.id', read_only=True)
+  user_id = serializers.IntegerField(source='user.id', read_only=True)
 
   # Students information
   students = StudentMinimalSerializer(source='get_all_students', many=True, read_only=True)
-  student_count = serializers.SerializerMethodField()
+  student_count = serializers.IntegerField(read_only=True)
 
   class Meta:
     model = Parent
+    list_serializer_class = TimedListSerializer
     fields = [
       "uuid",
       "family_code",
@@ -262,13 +314,19 @@ class ParentSerializer(serializers.ModelSerializer):
       "address",
       "student_count",
       "created_at",
-      "updated_at"
+      "updated_at",
       "students",
     ]
 
-  def get_student_count(self, obj):
-    """ Get number of students linked to parent """
-    return obj.get_students_count()
+  @staticmethod
+  def setup_eager_loading(queryset):
+    """ Load users and students for a page of parents up front """
+    return queryset.select_related("user").with_students()
+
+  def to_representation(self, instance):
+    # Students rendered below belong to this parent; no need to look it up again
+    get_parent_loader(self.context).prime_parents([instance])
+    return super().to_representation(instance)
 
 class ParentCreatSerializer(serializers.ModelSerializer):
   """ Serializer for creating a new parent """
@@ -326,19 +384,20 @@ class ParentUpdateSerializer(serializers.ModelSerializer):
       "address"
     ]
 
-class ParentDetailSerializer(serializers.ModelSerializer):
+class ParentDetailSerializer(TimedDataMixin, serializers.ModelSerializer):
   # Nested user information
-  user = UserMininmalSerializer(source='parent_link', read_only=True)
+  user = UserMininmalSerializer(read_only=True)
 
   #Full student details
   students = StudentSerializer(source='get_all_students', many=True, read_only=True)
-  student_count = serializers.SerializerMethodField()
+  student_count = serializers.IntegerField(read_only=True)
 
   # Statistics
   unlinked_students_count = serializers.SerializerMethodField()
 
   class Meta:
     model = Parent
+    list_serializer_class = TimedListSerializer
     fields = [
       "uuid",
       "family_code",
@@ -353,10 +412,18 @@ class ParentDetailSerializer(serializers.ModelSerializer):
     ]
     read_only_fields = fields
 
-  def get_student_count(self, obj):
-    """ Get number of students linked to parent """
-    return obj.get_students_count()
+  @staticmethod
+  def setup_eager_loading(queryset):
+    """ Load users and students for a page of parents up front """
+    return queryset.select_related("user").with_students()
+
+  def to_representation(self, instance):
+    # Students rendered below belong to this parent; no need to look it up again
+    get_parent_loader(self.context).prime_parents([instance])
+    return super().to_representation(instance)
 
   def get_unlinked_students_count(self, obj):
-    """ Get number of students linked to parent """
-    return obj.unlinked_students_count()
+    """ Get number of students not linked to any parent yet, counted once per render """
+    if "unlinked_students_count" not in self.context:
+      self.context["unlinked_students_count"] = Student.objects.unlinked_students().count()
+    return self.context["unlinked_students_count"]
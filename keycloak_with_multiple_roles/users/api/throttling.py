@@ -0,0 +1,55 @@
+"""
+DRF throttles and fields backed by the token buckets of ``users.ratelimit``.
+"""
+from rest_framework import serializers
+from rest_framework.throttling import BaseThrottle
+
+from keycloak_with_multiple_roles.users import ratelimit
+from keycloak_with_multiple_roles.users.models import Parent
+
+
+class TokenBucketThrottle(BaseThrottle):
+  """ Throttle taking one token from each bucket named by ``get_checks`` """
+
+  def get_checks(self, request, view):
+    """ ``(rule, identity)`` pairs of the request; empty identities are skipped """
+    raise NotImplementedError
+
+  def allow_request(self, request, view):
+    self.wait_seconds = 0.0
+    if ratelimit.enabled():
+      self.wait_seconds = ratelimit.get_limiter().hit(*self.get_checks(request, view))
+    return not self.wait_seconds
+
+  def wait(self):
+    return self.wait_seconds
+
+
+class LoginRateThrottle(TokenBucketThrottle):
+  """ Login attempts per username, whichever addresses they come from """
+
+  def get_checks(self, request, view):
+    username = request.data.get("username")
+    return [("login:username", username if isinstance(username, str) else None)]
+
+
+def check_family_code(context, family_code):
+  """ Take a family-code lookup token for the code and the client IP, or raise Throttled """
+  request = context.get("request")
+  ratelimit.check(
+    ("family_code:code", family_code),
+    ("family_code:ip", ratelimit.client_ip(request) if request is not None else None),
+  )
+
+
+class FamilyCodeField(serializers.SlugRelatedField):
+  """ Parent looked up by family code, rate limited before the query """
+
+  def __init__(self, **kwargs):
+    kwargs.setdefault("slug_field", "family_code")
+    kwargs.setdefault("queryset", Parent.objects.all())
+    super().__init__(**kwargs)
+
+  def to_internal_value(self, data):
+    check_family_code(self.context, data)
+    return super().to_internal_value(data)
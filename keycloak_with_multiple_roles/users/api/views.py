@@ -1,146 +1,292 @@
+from collections import Counter
+from datetime import datetime
 from re import search
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from rest_framework import status, viewsets
-from rest_framework.authtoken.models import Token
-from rest_framework.response import Response
+from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework.pagination import PageNumberPagination
-from django.contrib.auth import login, authenticate, logout
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from django.contrib.auth import alogin, alogout
+from django.contrib.auth.signals import user_logged_in
 
 
-from keycloak_with_multiple_roles.users.models import User, Parent, Student
+from keycloak_with_multiple_roles.users import profile_cache
+from keycloak_with_multiple_roles.users.backends import aauthenticate
+from keycloak_with_multiple_roles.users.links import ERROR, LINKED, UNCHANGED, UNLINKED, link_students
+from keycloak_with_multiple_roles.users.models import AuthToken, User, Parent, Student
+from .async_views import AsyncAPIView
+from .compiled import compile_serializer
+from .conditional import latest, make_etag, not_modified, set_validators
+from .exports import EXPORT_FORMATS, EXPORT_RESOURCES, astream_export, stream_export
+from .pagination import KeysetPagination, StandardResultSetPagination
+from .permissions import HasRole
 from .serializers import (
+  BulkStudentLinkSerializer,
   UserSerializer,
   UserCreateSerializer, ParentSerializer, StudentLinkToParentSerializer, StudentSerializer
 )
+from .throttling import LoginRateThrottle
 
-# Pagination
-class StandardResultSetPagination(PageNumberPagination):
-  page_size = 10
-  page_size_query_param = 'page-size'
-  max_page_size = 100
+async def build_login_profile(user):
+  """
+    Profile summary returned by LoginView: the user's family as a parent,
+    else their student profile. Roles are read from role_mask, so users
+    holding several roles (e.g. admin and parent) get theirs.
+  """
+  if user.has_role('parent'):
+    parent = await Parent.objects.filter(user=user).afirst()
+    if parent is not None:
+      return {
+        "family_code": parent.family_code,
+        "student_count": parent.student_count,
+      }
+  if user.has_role('student'):
+    student = await Student.objects.filter(student_link=user).afirst()
+    if student is not None:
+      return {
+        "student_code": student.student_code,
+        "is_linked": student.is_linked_to_parent(),
+      }
+  return None
 
-class LoginView(APIView):
+FAMILY_VERSION_FIELDS = (
+  "family_code", "updated_at", "student_count", "user_updated_at",
+  "students_updated_at", "student_users_updated_at",
+)
+
+async def build_profile_version(user):
+  """
+    Versions of the rows MeView's profile is built from, see
+    ParentQuerySet.with_versions. Much cheaper than build_me_profile.
+  """
+  version = []
+  if user.has_role('parent'):
+    family = await Parent.objects.filter(user=user).with_versions().values_list(*FAMILY_VERSION_FIELDS).afirst()
+    version.append(family)
+  if user.has_role('student'):
+    student = await Student.objects.filter(student_link=user).values_list("updated_at", "parent_id").afirst()
+    family = None
+    if student is not None and student[1]:
+      family = await Parent.objects.filter(family_code=student[1]).with_versions().values_list(
+        *FAMILY_VERSION_FIELDS,
+      ).afirst()
+    version += [student, family]
+  return version or None
+
+def profile_validators(request, user, version):
+  """ ETag and Last-Modified of a MeView response """
+  etag = make_etag(
+    user.pk, user.updated_at, request.build_absolute_uri("/"), profile_cache.PROFILE_CACHE_VERSION, version,
+  )
+  timestamps = [value for row in version or () if row for value in row if isinstance(value, datetime)]
+  return etag, latest(user.updated_at, *timestamps)
+
+def build_me_profile(user, context):
+  """ Full profile returned by MeView, picked by role like build_login_profile """
+  if user.has_role('parent'):
+    parent = ParentSerializer.setup_eager_loading(Parent.objects).filter(user=user).first()
+    if parent is not None:
+      return ParentSerializer(parent, context=context).data
+  if user.has_role('student'):
+    student = StudentSerializer.setup_eager_loading(Student.objects).filter(student_link=user).first()
+    if student is not None:
+      return StudentSerializer(student, context=context).data
+  return None
+
+class LoginView(AsyncAPIView):
   """
     Minimal login view for local authentication
-    Replace with keycloak authentication
+    Keycloak clients skip it and send their access token as a Bearer token,
+    see KeycloakJWTAuthentication
 
     POST /api/auth/login
-    Body: {username: "user@example.com", password: ""}
+    Body: {username: "user@example.com", password: "", session: true}
+
+    ``session: false`` logs in for the token only: no session is created
+    or stored. API_LOGIN_SESSION = False makes that the only mode.
 
+    Rate limited per client IP by RateLimitMiddleware and per username by
+    LoginRateThrottle.
   """
-  permission_classes = [AllowAny]
 
-  def post(self, request):
+  throttle_classes = [LoginRateThrottle]
+
+  async def post(self, request):
     username = request.data.get('username')
     password = request.data.get('password')
 
     if not username or not password:
-      return Response({
+      return JsonResponse({
         "error":"Username and password are required"
     }, status= status.HTTP_400_BAD_REQUEST)
 
-    # Authenticate user
-    user = User.objects.filter(username= username, password=password)
+    # Authenticate user on the async ORM, not Django's shared sync thread;
+    # password hashing runs on the bounded pool of users.hashing and
+    # answers 503 when it is saturated
+    user = await aauthenticate(request, username=username, password=password)
 
     if user is None:
-      return Response({
+      return JsonResponse({
         "error":"Invalid username or password"
       }, status= status.HTTP_401_UNAUTHORIZED)
 
-    #Login user (creates session)
-    login(request, user)
+    if self.wants_session(request):
+      #Login user (creates session)
+      await alogin(request, user)
+    else:
+      # Token-only login: no session write, but still a login (last_login, ...)
+      request.user = user
+      await user_logged_in.asend(sender=user.__class__, request=request, user=user)
 
-    # get or create token for API access
-    token, created = Token.objects.get_or_create(user=user)
+    # The user's API token, a new one when it has expired
+    token = await AuthToken.objects.aissue(user)
 
     # Get user profiles based on user_type
-    profile_data = None
-    if user.user_type == 'parent':
-      try:
-        parent = Parent.objects.get(parent_link=user)
-        profile_data = {
-          "family_code": parent.family_code,
-          "student_count": parent.get_student_count(),
-        }
-      except Parent.DoesNotExist:
-        pass
-    elif user.user_type == 'student':
-      try:
-        student = Student.objects.get(student_link=user)
-        profile_data = {
-          "student_code": student.student_code,
-          "is_linked": student.is_linked_to_parent(),
-        }
-      except Student.DoesNotExist:
-        pass
-
-    return Response({
+    profile_data = await profile_cache.aget_or_build(
+      profile_cache.LOGIN_PROFILE, user.id, lambda: build_login_profile(user),
+    )
+
+    return JsonResponse({
       'message': 'Login successful',
       'token': token.key,
+      'token_expires_at': token.expires_at,
       'user': {
         'id': user.id,
         'email': user.email,
         'username': user.username,
         'user_type': user.user_type,
+        'roles': user.role_names,
       },
       "profile": profile_data
     },status= status.HTTP_200_OK)
 
-class LogoutView(APIView):
+  def wants_session(self, request):
+    if not getattr(settings, "API_LOGIN_SESSION", True):
+      return False
+    return request.data.get("session", True) not in (False, "false", "0")
+
+class ObtainExpiringAuthToken(ObtainAuthToken):
+  """
+  DRF's obtain_auth_token, issuing expiring AuthTokens
+
+  POST /api/auth-token/
+  Body: {username: "", password: ""}
+  """
+
+  def post(self, request, *args, **kwargs):
+    serializer = self.get_serializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    token = AuthToken.objects.issue(serializer.validated_data["user"])
+    return Response({"token": token.key, "expires_at": token.expires_at})
+
+class LogoutView(AsyncAPIView):
   """
   Logout view - invalidates token and session
 
   POST /api/auth/logout
   """
 
-  permission_classes = [IsAuthenticated]
+  require_authentication = True
 
-  def post(self, request):
+  async def post(self, request):
     # Delete token
-    try:
-      request.user.auth_token.delete()
-    except:
-      pass
+    await AuthToken.objects.filter(user_id=request.user.pk).adelete()
 
-    logout(request)
+    await alogout(request)
 
-    return Response(
+    return JsonResponse(
       {"message": "Logout successful"},
       status=status.HTTP_200_OK
     )
 
-class MeView(APIView):
+class MeView(AsyncAPIView):
   """
   Get current authenticated user's information
 
   GET /api/auth/me
   """
 
-  permission_classes = [IsAuthenticated]
+  require_authentication = True
 
-  def get(self, request):
+  async def get(self, request):
     user = request.user
-    user_data = UserSerializer(user).data
+    # Answer revalidations from the row versions alone, before any serializer runs.
+    # They are read fresh, never cached, so the ETag follows every change
+    version = await build_profile_version(user)
+    etag, last_modified = profile_validators(request, user, version)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+      return response
+
+    context = {"request": request}
+    user_data = UserSerializer(user, context=context).data
+    user_data['roles'] = user.role_names
+
+    # Add profile information based on user_type; building it on a miss
+    # walks nested serializers, so it runs in a worker thread
+    user_data['profile'] = await profile_cache.aget_or_build(
+      profile_cache.ME_PROFILE, user.id, sync_to_async(lambda: build_me_profile(user, context)),
+    )
+
+    return set_validators(JsonResponse(user_data, status=status.HTTP_200_OK), etag, last_modified)
+
+class ExportView(APIView):
+  """
+  Stream users, parents or students as NDJSON or CSV in constant memory
+
+  GET /users/export/<users|parents|students>.<ndjson|csv>
+  Filters: ?user_type= (users), ?grade= and ?class_name= (students)
+  Users holding the admin role only.
+  """
+
+  permission_classes = [HasRole.of("admin")]
+
+  def get(self, request, resource, export_format):
+    if resource not in EXPORT_RESOURCES or export_format not in EXPORT_FORMATS:
+      raise Http404
+
+    # Under ASGI the response must be fed by an async iterator to stream
+    stream = astream_export if isinstance(request._request, ASGIRequest) else stream_export
+    response = StreamingHttpResponse(
+      stream(resource, export_format, request.query_params),
+      content_type=EXPORT_FORMATS[export_format],
+    )
+    response["Content-Disposition"] = f'attachment; filename="{resource}.{export_format}"'
+    return response
+
+class StudentLinksView(APIView):
+  """
+  Link or unlink many students in one request
 
-    # Add profile information based on user_type
+  POST /users/students/links
+  Body: {links: [{student_code: "STU12345", family_code: "A8K9Z"}, ...]}
+  A null or missing family_code unlinks the student. Every pair gets a
+  result with status linked, unlinked, unchanged or error.
+  Users holding the admin role only.
+  """
 
-    if user.user_type == 'parent':
-      try:
-        parent = Parent.objects.get(parent_link=user)
-        user_data['profile'] = ParentSerializer(parent).data
-      except Parent.DoesNotExist:
-        user_data['profile'] = None
-    elif user.user_type == 'student':
-      try:
-        student = Student.objects.get(student_link=user)
-        user_data['profile'] = StudentSerializer(student).data
-      except Student.DoesNotExist:
-        user_data['profile'] = None
+  permission_classes = [HasRole.of("admin")]
 
-    return Response(user_data, status=status.HTTP_200_OK)
+  def post(self, request):
+    serializer = BulkStudentLinkSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    results = link_students([
+      (link["student_code"], link["family_code"]) for link in serializer.validated_data["links"]
+    ])
+    summary = Counter(result["status"] for result in results)
+    return Response(
+      {
+        "results": results,
+        "summary": {status_: summary[status_] for status_ in (LINKED, UNLINKED, UNCHANGED, ERROR)},
+      },
+      status=status.HTTP_200_OK,
+    )
 
 class UserViewSet(viewsets.ModelViewSet):
   """
@@ -148,6 +294,49 @@ class UserViewSet(viewsets.ModelViewSet):
   """
   queryset = User.objects.all()
   serializer_class = UserSerializer
+  lookup_field = "username"
+  # Usernames may contain dots (e.g. email style, Keycloak preferred_username);
+  # the router's default pattern rejects them
+  lookup_value_regex = "[^/]+"
   permission_classes = [IsAuthenticated]
   pagination_class = StandardResultSetPagination
 
+  @property
+  def paginator(self):
+    """
+    Page-number pagination by default; keyset pagination on
+    (date_joined, id) with ?pagination=cursor or when following a cursor.
+    """
+    if not hasattr(self, '_paginator'):
+      params = getattr(self.request, 'query_params', {})
+      if 'cursor' in params or params.get('pagination') == 'cursor':
+        self._paginator = KeysetPagination()
+      else:
+        self._paginator = self.pagination_class()
+    return self._paginator
+
+  def retrieve(self, request, *args, **kwargs):
+    """ Single user; conditional GETs are answered from ``updated_at`` """
+    instance = self.get_object()
+    etag = make_etag(
+      instance.pk, instance.updated_at, request.build_absolute_uri("/"), request.accepted_media_type,
+    )
+    response = not_modified(request, etag, instance.updated_at)
+    if response is not None:
+      return response
+    serializer = self.get_serializer(instance)
+    return set_validators(Response(serializer.data), etag, instance.updated_at)
+
+  def list(self, request, *args, **kwargs):
+    """ Render pages from values() rows when the serializer compiles, see api.compiled """
+    compiled = compile_serializer(self.get_serializer_class())
+    if compiled is None:
+      return super().list(request, *args, **kwargs)
+    # Keyset pagination reads its ordering columns from the rows
+    ordering = [name.lstrip("-") for name in getattr(self.paginator, "ordering", ())]
+    rows = compiled.values(self.filter_queryset(self.get_queryset()), *ordering)
+    page = self.paginate_queryset(rows)
+    if page is not None:
+      return self.get_paginated_response(compiled.render(page, self.get_serializer_context()))
+    return Response(compiled.render(rows, self.get_serializer_context()))
+
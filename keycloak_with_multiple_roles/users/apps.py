@@ -1,5 +1,3 @@
-import contextlib
-
 from django.apps import AppConfig
 from django.utils.translation import gettext_lazy as _
 
@@ -9,5 +7,8 @@ class UsersConfig(AppConfig):
     verbose_name = _("Users")
 
     def ready(self):
-        with contextlib.suppress(ImportError):
-            import keycloak_with_multiple_roles.users.signals  # noqa: F401, PLC0415
+        # Not optional: the handlers keep counts, token and profile caches,
+        # permission versions and role masks correct
+        import keycloak_with_multiple_roles.users.signals  # noqa: F401, PLC0415
+        # Installs the query timer on new database connections
+        import keycloak_with_multiple_roles.users.timing  # noqa: F401, PLC0415
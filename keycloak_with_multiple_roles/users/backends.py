@@ -0,0 +1,144 @@
+"""
+Authentication backend caching resolved permissions.
+
+ModelBackend resolves a user's permissions with two join queries (user
+permissions, group permissions) and keeps them on the user instance only,
+so every request, admin page and ``has_perm`` check of a new instance pays
+them again. CachedModelBackend stores both sets in the shared cache under
+a global permission version. Any change to group memberships, user or
+group permissions, groups or permissions bumps the version (see signals),
+which retires every cached set at once.
+
+``aauthenticate`` replaces Django's, which runs every login on the single
+thread-sensitive executor: CachedModelBackend checks passwords on the async
+ORM and the users.hashing pool, so one slow login does not stall the other
+async views.
+"""
+import inspect
+import re
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth import load_backend
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.signals import user_login_failed
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.views.decorators.debug import sensitive_variables
+
+from keycloak_with_multiple_roles.users import hashing
+
+PERMISSION_VERSION_KEY = "perms:version"
+DEFAULT_TIMEOUT = 3600
+# Credentials masked in user_login_failed, like django.contrib.auth does
+SENSITIVE_CREDENTIALS = re.compile("api|token|key|secret|password|signature", re.IGNORECASE)
+CLEANSED_SUBSTITUTE = "********************"
+
+
+def permission_version():
+  """ Current permission version, created when missing """
+  version = cache.get(PERMISSION_VERSION_KEY)
+  if version is None:
+    # Seeded from the clock, so a version lost to eviction is not reused
+    cache.add(PERMISSION_VERSION_KEY, time.time_ns() // 1000, timeout=None)
+    version = cache.get(PERMISSION_VERSION_KEY)
+  return version
+
+
+def bump_permission_version():
+  """ Retire every cached permission set once the transaction commits """
+  def bump():
+    try:
+      cache.incr(PERMISSION_VERSION_KEY)
+    except ValueError:
+      permission_version()
+  transaction.on_commit(bump)
+
+
+def permission_cache_key(user_obj, version):
+  # Superusers hold every permission, so the flag is part of the key
+  return f"perms:v{version}:{user_obj.pk}:{int(user_obj.is_superuser)}"
+
+
+class CachedModelBackend(ModelBackend):
+  """ ModelBackend whose user and group permission sets come from the shared cache """
+
+  def get_user_permissions(self, user_obj, obj=None):
+    if user_obj.is_active and not user_obj.is_anonymous and obj is None:
+      self._load_permissions(user_obj)
+    return super().get_user_permissions(user_obj, obj)
+
+  def get_group_permissions(self, user_obj, obj=None):
+    if user_obj.is_active and not user_obj.is_anonymous and obj is None:
+      self._load_permissions(user_obj)
+    return super().get_group_permissions(user_obj, obj)
+
+  def _load_permissions(self, user_obj):
+    """ Put both permission sets on ``user_obj``, where ModelBackend looks first """
+    if hasattr(user_obj, "_user_perm_cache") and hasattr(user_obj, "_group_perm_cache"):
+      return
+    key = permission_cache_key(user_obj, permission_version())
+    cached = cache.get(key)
+    if cached is None:
+      cached = (
+        self._get_permissions(user_obj, None, "user"),
+        self._get_permissions(user_obj, None, "group"),
+      )
+      cache.set(key, cached, getattr(settings, "PERMISSION_CACHE_TIMEOUT", DEFAULT_TIMEOUT))
+    user_obj._user_perm_cache, user_obj._group_perm_cache = cached
+
+  async def aauthenticate(self, request, username=None, password=None, **kwargs):
+    """ ModelBackend.authenticate on the async ORM; hashing awaits the users.hashing pool """
+    user_model = get_user_model()
+    if username is None:
+      username = kwargs.get(user_model.USERNAME_FIELD)
+    if username is None or password is None:
+      return None
+    try:
+      user = await user_model._default_manager.aget(**{user_model.USERNAME_FIELD: username})
+    except user_model.DoesNotExist:
+      # Hash once anyway, so unknown usernames take as long as wrong passwords
+      await hashing.amake_password(password)
+      return None
+    if await user.acheck_password(password) and self.user_can_authenticate(user):
+      return user
+    return None
+
+
+@sensitive_variables("credentials")
+async def aauthenticate(request=None, **credentials):
+  """
+    django.contrib.auth.authenticate for async views.
+
+    Backends with an ``aauthenticate`` method run on the event loop; others
+    run in a worker thread of their own rather than the shared sync thread.
+  """
+  for backend_path in settings.AUTHENTICATION_BACKENDS:
+    backend = load_backend(backend_path)
+    try:
+      inspect.signature(backend.authenticate).bind(request, **credentials)
+    except TypeError:
+      # Does not accept these credentials
+      continue
+    method = getattr(backend, "aauthenticate", None) or sync_to_async(backend.authenticate, thread_sensitive=False)
+    try:
+      user = await method(request, **credentials)
+    except PermissionDenied:
+      break
+    if user is None:
+      continue
+    user.backend = backend_path
+    return user
+
+  await user_login_failed.asend(
+    sender="django.contrib.auth",
+    credentials={
+      key: CLEANSED_SUBSTITUTE if SENSITIVE_CREDENTIALS.search(key) else value
+      for key, value in credentials.items()
+    },
+    request=request,
+  )
+  return None
@@ -0,0 +1,243 @@
+"""
+Performance benchmarks for the users API hot paths.
+
+Run with ``manage.py benchmark_api``. Every run seeds its own parents and
+students inside a transaction that is rolled back afterwards, so it works
+against SQLite or a local PostgreSQL without leaving data behind.
+"""
+import json
+import statistics
+import time
+from dataclasses import asdict
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import connection
+from django.db import transaction
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users import profile_cache
+from keycloak_with_multiple_roles.users.api.authentication import local_tokens
+from keycloak_with_multiple_roles.users.api.authentication import token_cache_key
+from keycloak_with_multiple_roles.users.api.serializers import ParentDetailSerializer
+from keycloak_with_multiple_roles.users.api.serializers import StudentSerializer
+from keycloak_with_multiple_roles.users.importers import UserImporter
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.models import User
+
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+BENCHMARK_PASSWORD = "benchmark-password"  # noqa: S105
+USERNAME_PREFIX = "bench-"
+
+
+@dataclass
+class Measurement:
+  name: str
+  median_ms: float
+  p95_ms: float
+  queries: int
+  # INSERT/UPDATE/DELETE statements among the queries
+  writes: int = 0
+
+
+def baseline_path(vendor=None):
+  return BASELINE_DIR / f"{vendor or connection.vendor}.json"
+
+
+def seed(parents, students_per_parent):
+  """
+    Create ``parents`` parents with ``students_per_parent`` students each.
+
+    Returns:
+      dict: A parent and a student that can log in, with API tokens.
+  """
+  def rows():
+    for number in range(parents):
+      parent = f"{USERNAME_PREFIX}parent-{number}"
+      yield number, {"user_type": "parent", "username": parent, "email": f"{parent}@example.com", "name": parent}
+      for index in range(students_per_parent):
+        student = f"{USERNAME_PREFIX}student-{number}-{index}"
+        yield number, {
+          "user_type": "student",
+          "username": student,
+          "email": f"{student}@example.com",
+          "name": student,
+          "parent_username": parent,
+          "grade": str(index % 12 + 1),
+          "class_name": f"class-{number % 10}",
+        }
+
+  # Seeded users get unusable passwords; only the two login users are hashed
+  with UserImporter(hash_workers=0) as importer:
+    result = importer.import_chunk(list(rows()))
+  if result.errors:
+    msg = f"Seeding failed: {result.errors[:5]}"
+    raise RuntimeError(msg)
+
+  parent = User.objects.get(username=f"{USERNAME_PREFIX}parent-0")
+  student = User.objects.get(username=f"{USERNAME_PREFIX}student-0-0")
+  User.objects.filter(pk__in=[parent.pk, student.pk]).update(password=make_password(BENCHMARK_PASSWORD))
+  return {
+    "parent": parent,
+    "student": student,
+    "parent_token": AuthToken.objects.issue(parent).key,
+    "student_token": AuthToken.objects.issue(student).key,
+  }
+
+
+def forget_cached_state(users, tokens):
+  """ Drop cache entries written for seeded rows, which are rolled back """
+  keys = [profile_cache.profile_cache_key(kind, user.pk) for user in users for kind in profile_cache.PROFILE_KINDS]
+  keys += [token_cache_key(token) for token in tokens]
+  cache.delete_many(keys)
+  local_tokens.clear()
+
+
+def build_scenarios(seeded):
+  """ Name -> zero-argument callable exercising one hot path """
+  login_client = APIClient()
+  parent_client = APIClient()
+  parent_client.credentials(HTTP_AUTHORIZATION=f"Token {seeded['parent_token']}")
+  student_client = APIClient()
+  student_client.credentials(HTTP_AUTHORIZATION=f"Token {seeded['student_token']}")
+
+  def request(client, method, url, **kwargs):
+    def run():
+      response = getattr(client, method)(url, **kwargs)
+      if response.status_code >= 400:  # noqa: PLR2004
+        msg = f"{method.upper()} {url} returned {response.status_code}"
+        raise RuntimeError(msg)
+    return run
+
+  def revalidate(client, url):
+    etag = {}
+    def run():
+      # The warm-up call fetches the ETag the measured calls revalidate
+      if "value" not in etag:
+        etag["value"] = client.get(url)["ETag"]
+      response = client.get(url, HTTP_IF_NONE_MATCH=etag["value"])
+      if response.status_code != 304:  # noqa: PLR2004
+        msg = f"GET {url} with If-None-Match returned {response.status_code}"
+        raise RuntimeError(msg)
+    return run
+
+  def render_parent_details():
+    parents = ParentDetailSerializer.setup_eager_loading(Parent.objects.all())[:20]
+    return ParentDetailSerializer(parents, many=True).data
+
+  def render_students():
+    students = StudentSerializer.setup_eager_loading(Student.objects)[:50]
+    return StudentSerializer(students, many=True).data
+
+  login = {"username": seeded["parent"].username, "password": BENCHMARK_PASSWORD}
+  return {
+    "login": request(login_client, "post", "/users/auth/login", data=login, format="json"),
+    "login_token_only": request(
+      APIClient(), "post", "/users/auth/login", data={**login, "session": False}, format="json",
+    ),
+    "me_parent": request(parent_client, "get", "/users/auth/me"),
+    "me_student": request(student_client, "get", "/users/auth/me"),
+    "me_not_modified": revalidate(parent_client, "/users/auth/me"),
+    "user_list": request(parent_client, "get", "/api/users/?page=5"),
+    "user_list_cursor": request(parent_client, "get", "/api/users/?pagination=cursor"),
+    "user_retrieve": request(parent_client, "get", f"/api/users/{seeded['student'].username}/"),
+    "parent_detail_render": render_parent_details,
+    "student_render": render_students,
+  }
+
+
+def is_write(sql):
+  return sql.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE")
+
+
+def measure(name, scenario, repeat):
+  """ Time ``scenario`` ``repeat`` times after one warm-up call """
+  scenario()
+  timings = []
+  queries = writes = 0
+  for _ in range(repeat):
+    with CaptureQueriesContext(connection) as captured:
+      started = time.perf_counter()
+      scenario()
+      timings.append((time.perf_counter() - started) * 1000)
+    queries = max(queries, len(captured))
+    writes = max(writes, sum(is_write(query["sql"]) for query in captured.captured_queries))
+  timings.sort()
+  return Measurement(
+    name=name,
+    median_ms=statistics.median(timings),
+    p95_ms=timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    queries=queries,
+    writes=writes,
+  )
+
+
+def run(*, parents=200, students_per_parent=3, repeat=20, only=None):
+  """
+    Seed data, run every scenario and roll everything back.
+
+    Returns:
+      list[Measurement]
+  """
+  results = []
+  # Server-Timing sampling is switched off so its logging does not skew results,
+  # and rate limiting so repeated logins are not throttled
+  overrides = {
+    "ALLOWED_HOSTS": [*settings.ALLOWED_HOSTS, "testserver"],
+    "SERVER_TIMING_SAMPLE_RATE": 0,
+    "RATE_LIMIT_ENABLED": False,
+  }
+  with override_settings(**overrides), transaction.atomic():
+    seeded = seed(parents, students_per_parent)
+    try:
+      for name, scenario in build_scenarios(seeded).items():
+        if only and name not in only:
+          continue
+        results.append(measure(name, scenario, repeat))
+    finally:
+      seeded_users = User.objects.filter(username__startswith=USERNAME_PREFIX)
+      forget_cached_state(seeded_users, [seeded["parent_token"], seeded["student_token"]])
+      transaction.set_rollback(True)
+  return results
+
+
+def load_baseline(path):
+  if not path.exists():
+    return None
+  return json.loads(path.read_text())
+
+
+def save_baseline(path, results, meta):
+  path.parent.mkdir(parents=True, exist_ok=True)
+  data = {"meta": meta, "scenarios": {result.name: asdict(result) for result in results}}
+  path.write_text(json.dumps(data, indent=2, sort_keys=True) + "\n")
+
+
+def compare(results, baseline, tolerance):
+  """
+    List regressions against a stored baseline.
+
+    Any extra query or write is a regression; latency regresses when the median
+    exceeds the baseline by more than ``tolerance`` (a fraction).
+  """
+  regressions = []
+  for result in results:
+    expected = baseline["scenarios"].get(result.name)
+    if expected is None:
+      continue
+    if result.queries > expected["queries"]:
+      regressions.append(f"{result.name}: {result.queries} queries (baseline {expected['queries']})")
+    if result.writes > expected.get("writes", result.writes):
+      regressions.append(f"{result.name}: {result.writes} writes (baseline {expected['writes']})")
+    if result.median_ms > expected["median_ms"] * (1 + tolerance):
+      regressions.append(
+        f"{result.name}: median {result.median_ms:.2f}ms (baseline {expected['median_ms']:.2f}ms)",
+      )
+  return regressions
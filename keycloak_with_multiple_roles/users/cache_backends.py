@@ -0,0 +1,54 @@
+"""
+Cache backends reporting their calls to ``users.timing``.
+
+Drop-in replacements for the stock backends; they only add work for
+requests sampled by ServerTimingMiddleware.
+"""
+from django.core.cache.backends.locmem import LocMemCache
+from django_redis.cache import RedisCache
+
+from keycloak_with_multiple_roles.users import timing
+
+TIMED_METHODS = (
+  "add",
+  "get",
+  "set",
+  "touch",
+  "delete",
+  "get_many",
+  "get_or_set",
+  "has_key",
+  "incr",
+  "decr",
+  "set_many",
+  "delete_many",
+  "clear",
+)
+
+
+def _timed_method(name):
+  def method(self, *args, **kwargs):
+    call = getattr(super(TimedCacheMixin, self), name)
+    if timing.current() is None:
+      return call(*args, **kwargs)
+    with timing.timed(timing.CACHE):
+      return call(*args, **kwargs)
+
+  method.__name__ = name
+  return method
+
+
+class TimedCacheMixin:
+  """ Times the public cache API; calls nested inside another (e.g. get_or_set) count once """
+
+
+for _name in TIMED_METHODS:
+  setattr(TimedCacheMixin, _name, _timed_method(_name))
+
+
+class TimedLocMemCache(TimedCacheMixin, LocMemCache):
+  pass
+
+
+class TimedRedisCache(TimedCacheMixin, RedisCache):
+  pass
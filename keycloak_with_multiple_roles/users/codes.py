@@ -0,0 +1,287 @@
+"""
+Block allocator for generated family and student codes.
+
+Codes are not drawn at random any more. Each code space keeps a counter
+per width in ``CodeSequence``; a process reserves a block of indexes with a
+single locked update and maps every index through a keyed permutation of
+the space, so codes never repeat and cannot be predicted without the key
+(CODE_PERMUTATION_KEY, or SECRET_KEY). Handing out a code from a reserved
+block needs no database round trip.
+"""
+import hashlib
+import string
+import threading
+from collections import deque
+from dataclasses import dataclass
+
+from django.apps import apps
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+
+from keycloak_with_multiple_roles.users.models import CodeSequence
+
+# Rounds of the Feistel network shuffling indexes, see CodeSpace.permute
+FEISTEL_ROUNDS = 6
+
+DEFAULT_BLOCK_SIZE = 100
+
+
+class CodeSpaceExhaustedError(Exception):
+  """ Raised when a code space cannot be widened any further """
+
+
+@dataclass(frozen=True)
+class CodeSpace:
+  """ Shape of a generated code: prefix + ``length`` symbols of ``alphabet`` """
+
+  name: str
+  prefix: str
+  alphabet: str
+  length: int
+  max_length: int
+  model: str
+  field: str
+
+  def capacity(self, length):
+    """ Number of distinct codes with ``length`` symbols """
+    return len(self.alphabet) ** length
+
+  def permute(self, index, length, key):
+    """
+      Keyed bijection of ``[0, capacity)``.
+
+      A balanced Feistel network with keyed BLAKE2b rounds permutes the
+      smallest even-bit domain covering the space; results outside the
+      space are permuted again (cycle walking) until they fall inside.
+    """
+    capacity = self.capacity(length)
+    half_bits = ((capacity - 1).bit_length() + 1) // 2
+    mask = (1 << half_bits) - 1
+    value = index
+    while True:
+      left, right = value >> half_bits, value & mask
+      for round_ in range(FEISTEL_ROUNDS):
+        digest = hashlib.blake2b(
+          f"{self.name}:{length}:{round_}:{right}".encode(), key=key, digest_size=8,
+        ).digest()
+        left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+      value = (left << half_bits) | right
+      if value < capacity:
+        return value
+
+  def encode(self, index, length, key=None):
+    """ Map a sequence index to its (shuffled) code """
+    base = len(self.alphabet)
+    value = self.permute(index, length, key or permutation_key())
+    symbols = []
+    for _ in range(length):
+      value, digit = divmod(value, base)
+      symbols.append(self.alphabet[digit])
+    return self.prefix + "".join(reversed(symbols))
+
+  def get_model(self):
+    return apps.get_model(self.model)
+
+
+def permutation_key():
+  """
+    Key of the code permutation. Changing it reshuffles codes issued from
+    then on; codes already stored are skipped, see CodeAllocator._drop_taken.
+  """
+  secret = getattr(settings, "CODE_PERMUTATION_KEY", "") or settings.SECRET_KEY
+  return hashlib.sha256(f"users.codes:{secret}".encode()).digest()
+
+
+CODE_SPACES = {
+  "family": CodeSpace(
+    name="family",
+    prefix="",
+    alphabet=string.ascii_uppercase + string.digits,
+    length=5,
+    max_length=10,
+    model="users.Parent",
+    field="family_code",
+  ),
+  "student": CodeSpace(
+    name="student",
+    prefix="STU",
+    alphabet=string.digits,
+    length=5,
+    max_length=7,
+    model="users.Student",
+    field="student_code",
+  ),
+}
+
+
+class CodeAllocator:
+  """
+    Hands out codes from blocks reserved in ``CodeSequence``.
+
+    Spare codes of a block are kept in an in-process pool. When a block is
+    reserved inside an outer transaction the spare codes are only pooled once
+    that transaction commits, so a rolled back reservation is never reused.
+  """
+
+  def __init__(self, block_size=None):
+    self.block_size = block_size
+    self._lock = threading.Lock()
+    self._pools = {}
+
+  def get_block_size(self):
+    if self.block_size is not None:
+      return self.block_size
+    return getattr(settings, "CODE_ALLOCATOR_BLOCK_SIZE", DEFAULT_BLOCK_SIZE)
+
+  def allocate(self, name):
+    """ Allocate a single code from the ``name`` space """
+    return self.allocate_many(name, 1)[0]
+
+  def allocate_many(self, name, count):
+    """
+      Allocate ``count`` unique codes from the ``name`` space.
+
+      Returns:
+        list: Codes in allocation order.
+    """
+    space = CODE_SPACES[name]
+    codes = self._take_pooled(name, count)
+    while len(codes) < count:
+      needed = count - len(codes)
+      reserved = self._reserve(space, max(self.get_block_size(), needed))
+      codes.extend(reserved[:needed])
+      self._release(name, reserved[needed:])
+    return codes
+
+  def widen(self, name):
+    """
+      Start handing out codes one symbol longer.
+
+      Codes already issued keep their width, so old and new codes coexist.
+
+      Returns:
+        CodeSequence: The sequence row for the new width.
+    """
+    space = CODE_SPACES[name]
+    with transaction.atomic():
+      current = self._lock_active_sequence(space)
+      sequence = self._widen_locked(space, current)
+    self.clear_pool(name)
+    return sequence
+
+  def usage(self, name):
+    """
+      Report how full the ``name`` code space is, per width.
+
+      ``issued`` counts reserved indexes, including codes still pooled.
+    """
+    space = CODE_SPACES[name]
+    sequences = list(CodeSequence.objects.filter(name=name).order_by("length"))
+    if not sequences:
+      sequences = [CodeSequence(name=name, length=space.length)]
+    report = []
+    for sequence in sequences:
+      capacity = space.capacity(sequence.length)
+      report.append({
+        "name": name,
+        "length": sequence.length,
+        "issued": sequence.next_index,
+        "capacity": capacity,
+        "fill": sequence.next_index / capacity,
+        "active": sequence is sequences[-1],
+      })
+    return report
+
+  def clear_pool(self, name=None):
+    """ Drop pooled codes, e.g. after widening a space """
+    with self._lock:
+      if name is None:
+        self._pools.clear()
+      else:
+        self._pools.pop(name, None)
+
+  def _take_pooled(self, name, count):
+    with self._lock:
+      pool = self._pools.get(name)
+      codes = []
+      while pool and len(codes) < count:
+        codes.append(pool.popleft())
+      return codes
+
+  def _release(self, name, codes):
+    if not codes:
+      return
+
+    def extend_pool():
+      with self._lock:
+        self._pools.setdefault(name, deque()).extend(codes)
+
+    # Outside a transaction this runs immediately
+    transaction.on_commit(extend_pool)
+
+  def _reserve(self, space, size):
+    """ Reserve up to ``size`` indexes and return their free codes """
+    with transaction.atomic():
+      sequence = self._lock_active_sequence(space)
+      if sequence.next_index >= space.capacity(sequence.length):
+        sequence = self._widen_locked(space, sequence)
+      start = sequence.next_index
+      stop = min(start + size, space.capacity(sequence.length))
+      sequence.next_index = stop
+      sequence.save(update_fields=["next_index", "updated_at"])
+
+    key = permutation_key()
+    codes = [space.encode(index, sequence.length, key) for index in range(start, stop)]
+    return self._drop_taken(space, codes)
+
+  def _lock_active_sequence(self, space):
+    queryset = CodeSequence.objects.select_for_update().filter(name=space.name)
+    sequence = queryset.order_by("-length").first()
+    if sequence is None:
+      self._create_sequence(space, space.length)
+      sequence = queryset.order_by("-length").first()
+    return sequence
+
+  def _widen_locked(self, space, sequence):
+    length = sequence.length + 1
+    if length > space.max_length:
+      msg = f"The {space.name} code space is exhausted at length {sequence.length}."
+      raise CodeSpaceExhaustedError(msg)
+    self._create_sequence(space, length)
+    return CodeSequence.objects.select_for_update().get(name=space.name, length=length)
+
+  def _create_sequence(self, space, length):
+    # Another process may create the same row concurrently
+    try:
+      with transaction.atomic():
+        CodeSequence.objects.get_or_create(name=space.name, length=length)
+    except IntegrityError:
+      pass
+
+  def _drop_taken(self, space, codes):
+    """
+      Filter out codes already stored, e.g. legacy random codes.
+
+      One query per block rather than one per insert.
+    """
+    if not codes:
+      return codes
+    manager = space.get_model()._default_manager
+    taken = set(
+      manager.filter(**{f"{space.field}__in": codes}).values_list(space.field, flat=True),
+    )
+    return [code for code in codes if code not in taken]
+
+
+allocator = CodeAllocator()
+
+
+def allocate_code(name):
+  """ Allocate one code from the shared allocator """
+  return allocator.allocate(name)
+
+
+def allocate_codes(name, count):
+  """ Allocate ``count`` codes from the shared allocator """
+  return allocator.allocate_many(name, count)
@@ -0,0 +1,272 @@
+"""
+Family events pushed to websocket clients through Redis pub/sub.
+
+Model signals publish an event once the transaction commits, e.g. when a
+student links to or unlinks from a family, or a profile changes. Each
+worker process keeps a single Redis subscription (``FamilyEventHub``) and
+fans messages out to the websocket connections it serves, so an event
+reaches every connected family member whichever worker handles them.
+
+Channels:
+  family:<family_code>  Events of a family, for the parent and linked students.
+  user:<user_id>        Events of one user, e.g. their own student being linked.
+"""
+import asyncio
+import json
+import logging
+import threading
+import uuid
+import weakref
+from collections import defaultdict
+from collections import deque
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+
+logger = logging.getLogger(__name__)
+
+STUDENT_LINKED = "student.linked"
+STUDENT_UNLINKED = "student.unlinked"
+STUDENT_UPDATED = "student.updated"
+PARENT_UPDATED = "parent.updated"
+USER_UPDATED = "user.updated"
+
+DEFAULT_CHANNEL_PREFIX = "events:"
+DEFAULT_QUEUE_SIZE = 100
+SEEN_EVENT_IDS = 32
+RECONNECT_DELAY = 1.0
+
+
+def channel_prefix():
+  return getattr(settings, "FAMILY_EVENTS_CHANNEL_PREFIX", DEFAULT_CHANNEL_PREFIX)
+
+
+def family_channel(family_code):
+  return f"{channel_prefix()}family:{family_code}"
+
+
+def user_channel(user_id):
+  return f"{channel_prefix()}user:{user_id}"
+
+
+def events_enabled():
+  return bool(getattr(settings, "FAMILY_EVENTS_REDIS_URL", None))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+  """ Process-wide sync Redis client used for publishing """
+  global _client  # noqa: PLW0603
+  with _client_lock:
+    if _client is None:
+      _client = redis.Redis.from_url(settings.FAMILY_EVENTS_REDIS_URL, socket_timeout=1)
+    return _client
+
+
+def _send(messages):
+  try:
+    with get_client().pipeline(transaction=False) as pipe:
+      for message, channels in messages:
+        for channel in channels:
+          pipe.publish(channel, message)
+      pipe.execute()
+  except redis.RedisError:
+    # Events are a convenience; clients can still fetch /auth/me
+    logger.warning("Could not publish %d event(s)", len(messages), exc_info=True)
+
+
+def publish(event_type, data, *, family_codes=(), user_ids=()):
+  """
+    Publish an event to the given families and users after commit.
+
+    Args:
+      event_type: One of the event type constants.
+      data: JSON-serializable event payload.
+      family_codes: Families to notify; empty values are skipped.
+      user_ids: Users to notify; empty values are skipped.
+  """
+  publish_many([(event_type, data, family_codes, user_ids)])
+
+
+def publish_many(events):
+  """
+    Publish several events after commit, with a single Redis round trip.
+
+    Args:
+      events: ``(event_type, data, family_codes, user_ids)`` tuples, see publish.
+  """
+  if not events_enabled():
+    return
+  messages = []
+  for event_type, data, family_codes, user_ids in events:
+    channels = [family_channel(code) for code in dict.fromkeys(family_codes) if code]
+    channels += [user_channel(user_id) for user_id in dict.fromkeys(user_ids) if user_id]
+    if channels:
+      # The id lets a connection drop copies received on several of its channels
+      message = json.dumps({"id": uuid.uuid4().hex, "type": event_type, **data}, cls=DjangoJSONEncoder)
+      messages.append((message, channels))
+  if messages:
+    transaction.on_commit(lambda: _send(messages))
+
+
+class FamilyEventHub:
+  """
+    One pub/sub connection per process and event loop, shared by all
+    websocket connections. Channels are subscribed in Redis while at least
+    one local queue listens to them.
+  """
+
+  def __init__(self, url):
+    self.url = url
+    self._queues = defaultdict(set)
+    self._lock = asyncio.Lock()
+    self._pubsub = None
+    self._reader = None
+
+  async def subscribe(self, channel, queue):
+    async with self._lock:
+      if self._pubsub is None:
+        self._pubsub = redis.asyncio.Redis.from_url(self.url).pubsub()
+      if not self._queues[channel]:
+        await self._pubsub.subscribe(channel)
+      self._queues[channel].add(queue)
+      if self._reader is None or self._reader.done():
+        self._reader = asyncio.create_task(self._read())
+
+  async def unsubscribe(self, channel, queue):
+    async with self._lock:
+      queues = self._queues.get(channel)
+      if not queues:
+        return
+      queues.discard(queue)
+      if not queues:
+        del self._queues[channel]
+        try:
+          await self._pubsub.unsubscribe(channel)
+        except redis.RedisError:
+          logger.warning("Could not unsubscribe from %s", channel, exc_info=True)
+
+  async def _read(self):
+    while True:
+      try:
+        message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+      except redis.RedisError:
+        logger.warning("Family event subscription lost, reconnecting", exc_info=True)
+        await asyncio.sleep(RECONNECT_DELAY)
+        await self._reconnect()
+        continue
+      if message is not None:
+        self._dispatch(message)
+
+  async def _reconnect(self):
+    async with self._lock:
+      try:
+        await self._pubsub.aclose()
+      except redis.RedisError:
+        pass
+      self._pubsub = redis.asyncio.Redis.from_url(self.url).pubsub()
+      try:
+        if self._queues:
+          await self._pubsub.subscribe(*self._queues)
+      except redis.RedisError:
+        logger.warning("Could not resubscribe to family events", exc_info=True)
+
+  def _dispatch(self, message):
+    channel = message["channel"]
+    if isinstance(channel, bytes):
+      channel = channel.decode()
+    try:
+      event = json.loads(message["data"])
+    except (TypeError, ValueError):
+      return
+    for queue in list(self._queues.get(channel, ())):
+      try:
+        queue.put_nowait(event)
+      except asyncio.QueueFull:
+        # A client that does not keep up loses events rather than memory
+        logger.debug("Dropping event for a slow subscriber of %s", channel)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+  """ FamilyEventHub of the running event loop """
+  loop = asyncio.get_running_loop()
+  hub = _hubs.get(loop)
+  if hub is None:
+    hub = _hubs[loop] = FamilyEventHub(settings.FAMILY_EVENTS_REDIS_URL)
+  return hub
+
+
+async def get_family_code(user):
+  """ The family a user belongs to: their own as a parent, their parent's as a student """
+  if user.has_role("parent"):
+    family_code = await Parent.objects.filter(user_id=user.pk).values_list("family_code", flat=True).afirst()
+    if family_code:
+      return family_code
+  if user.has_role("student"):
+    return await Student.objects.filter(student_link_id=user.pk).values_list("parent_id", flat=True).afirst()
+  return None
+
+
+class FamilySubscription:
+  """
+    Events for one websocket connection: the user's own channel and their
+    family's. A student that is linked or unlinked follows the new family.
+  """
+
+  def __init__(self, user, hub=None):
+    self.user = user
+    self.hub = hub or get_hub()
+    self.queue = asyncio.Queue(maxsize=getattr(settings, "FAMILY_EVENTS_QUEUE_SIZE", DEFAULT_QUEUE_SIZE))
+    self.family_code = None
+    self.channels = set()
+    self._seen = deque(maxlen=SEEN_EVENT_IDS)
+
+  async def open(self):
+    await self._subscribe(user_channel(self.user.pk))
+    await self.set_family(await get_family_code(self.user))
+
+  async def set_family(self, family_code):
+    if family_code == self.family_code:
+      return
+    if self.family_code:
+      await self._unsubscribe(family_channel(self.family_code))
+    self.family_code = family_code
+    if family_code:
+      await self._subscribe(family_channel(family_code))
+
+  async def next_event(self):
+    event = await self.queue.get()
+    while event.get("id") in self._seen:
+      event = await self.queue.get()
+    self._seen.append(event.get("id"))
+    student = event.get("student") or {}
+    if student.get("user_id") == self.user.pk:
+      if event["type"] == STUDENT_LINKED:
+        await self.set_family(event["family_code"])
+      elif event["type"] == STUDENT_UNLINKED and event["family_code"] == self.family_code:
+        await self.set_family(None)
+    return event
+
+  async def close(self):
+    for channel in list(self.channels):
+      await self._unsubscribe(channel)
+
+  async def _subscribe(self, channel):
+    await self.hub.subscribe(channel, self.queue)
+    self.channels.add(channel)
+
+  async def _unsubscribe(self, channel):
+    self.channels.discard(channel)
+    await self.hub.unsubscribe(channel, self.queue)
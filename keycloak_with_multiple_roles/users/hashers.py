@@ -0,0 +1,34 @@
+"""
+Password hashers with costs taken from settings.
+"""
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+def _cost(name, default):
+  """ ``settings.<name>``, or Django's cost when unset """
+  value = getattr(settings, name, None)
+  return default if value is None else value
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+  """
+    Django's Argon2 hasher, tuned with ``PASSWORD_ARGON2_*`` settings.
+
+    Unset settings keep Django's costs, so hashes made by Django's hasher
+    are not upgraded. The algorithm name stays ``argon2``, so existing
+    hashes keep verifying and are upgraded on the next login after a cost
+    change.
+  """
+
+  @property
+  def time_cost(self):
+    return _cost("PASSWORD_ARGON2_TIME_COST", hashers.Argon2PasswordHasher.time_cost)
+
+  @property
+  def memory_cost(self):
+    return _cost("PASSWORD_ARGON2_MEMORY_COST", hashers.Argon2PasswordHasher.memory_cost)
+
+  @property
+  def parallelism(self):
+    return _cost("PASSWORD_ARGON2_PARALLELISM", hashers.Argon2PasswordHasher.parallelism)
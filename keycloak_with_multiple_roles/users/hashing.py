@@ -0,0 +1,260 @@
+"""
+Password hashing on a dedicated, bounded worker pool.
+
+Argon2 costs tens of milliseconds of CPU and ~100 MiB of memory per call.
+Run on request threads, a burst of logins or sign-ups occupies every worker
+and starves the other endpoints. ``User.set_password`` and
+``User.check_password`` hand the work to a ``HashingPool`` instead. It runs
+at most ``PASSWORD_HASHING_WORKERS`` hashes at once, queues up to
+``PASSWORD_HASHING_QUEUE_SIZE`` more and sheds the rest with
+``PasswordHashingUnavailable``. Work that waited in the queue longer than
+``PASSWORD_HASHING_QUEUE_TIMEOUT`` seconds is shed too, since its client
+has most likely given up already.
+
+The exception is a plain one, usable from forms, the admin and commands.
+The API answers it with a 503 (api.exceptions), other views through
+``PasswordHashingUnavailableMiddleware``.
+
+argon2-cffi releases the GIL while hashing, so the workers are threads.
+
+Each hash reports the time it waited for a worker (``hash_wait``) and ran
+(``hash``) as users.timing metrics of its request; ``HashingPool.snapshot``
+is logged whenever work is shed.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.translation import gettext_lazy as _
+
+from keycloak_with_multiple_roles.users import timing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_QUEUE_TIMEOUT = 2.0
+# Seconds clients are asked to wait before retrying a shed request
+RETRY_AFTER = 1
+WAIT_METRIC = "hash_wait"
+HASH_METRIC = "hash"
+
+POOL_SETTINGS = ("PASSWORD_HASHING_WORKERS", "PASSWORD_HASHING_QUEUE_SIZE", "PASSWORD_HASHING_QUEUE_TIMEOUT")
+
+
+class PasswordHashingUnavailable(Exception):
+  """ The pool shed a hash; clients should retry after ``wait`` seconds """
+
+  message = _("Too many sign-in requests right now, please retry shortly.")
+
+  def __init__(self, wait=RETRY_AFTER):
+    super().__init__(str(self.message))
+    self.wait = wait
+
+
+class PasswordHashingUnavailableMiddleware:
+  """ 503 with Retry-After for shed hashes in non-API views: admin, allauth forms, ... """
+
+  sync_capable = True
+  async_capable = True
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+    if iscoroutinefunction(get_response):
+      markcoroutinefunction(self)
+
+  def __call__(self, request):
+    # A coroutine under ASGI, returned as is
+    return self.get_response(request)
+
+  def process_exception(self, request, exception):
+    if not isinstance(exception, PasswordHashingUnavailable):
+      return None
+    response = HttpResponse(str(exception.message), status=503, content_type="text/plain; charset=utf-8")
+    response["Retry-After"] = str(exception.wait)
+    return response
+
+
+class HashingPool:
+  """
+    Thread pool running password hashes with admission control.
+
+    Args:
+      workers: Hashes running at the same time.
+      queue_size: Hashes allowed to wait for a worker; more are rejected.
+      queue_timeout: Seconds a hash may wait for a worker before it is shed.
+  """
+
+  def __init__(self, workers, queue_size, queue_timeout):
+    self.workers = workers
+    self.queue_size = queue_size
+    self.queue_timeout = queue_timeout
+    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hashing")
+    self._slots = threading.BoundedSemaphore(workers + queue_size)
+    self._worker = threading.local()
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.queued = 0
+      self.active = 0
+      self.peak_queued = 0
+      self.completed = 0
+      self.rejected = 0
+      self.expired = 0
+      self.wait_seconds = 0.0
+
+  def snapshot(self):
+    """ Current queue depth and counters, e.g. for metrics or logs """
+    with self._lock:
+      started = self.completed + self.active
+      return {
+        "workers": self.workers,
+        "queue_size": self.queue_size,
+        "queue_depth": self.queued,
+        "peak_queue_depth": self.peak_queued,
+        "active": self.active,
+        "completed": self.completed,
+        "rejected": self.rejected,
+        "expired": self.expired,
+        "mean_wait_ms": self.wait_seconds * 1000 / started if started else 0.0,
+      }
+
+  def submit(self, fn, *args):
+    """
+      Queue ``fn(*args)`` for a worker.
+
+      Returns:
+        Future: The pending result.
+
+      Raises:
+        PasswordHashingUnavailable: The pool and its queue are full.
+    """
+    if getattr(self._worker, "busy", False):
+      # Already on a hashing worker, e.g. a hasher hashing again: waiting
+      # for another worker could deadlock
+      future = Future()
+      future.set_result(fn(*args))
+      return future
+    if not self._slots.acquire(blocking=False):
+      with self._lock:
+        self.rejected += 1
+      logger.warning("Password hashing queue full, shedding request: %s", self.snapshot())
+      raise PasswordHashingUnavailable
+    with self._lock:
+      self.queued += 1
+      self.peak_queued = max(self.peak_queued, self.queued)
+    try:
+      # Worker threads do not see the request's context; hand its timings over
+      return self._executor.submit(self._run, time.monotonic(), timing.current(), fn, args)
+    except BaseException:
+      with self._lock:
+        self.queued -= 1
+      self._slots.release()
+      raise
+
+  def _run(self, enqueued, timings, fn, args):
+    waited = time.monotonic() - enqueued
+    if timings is not None:
+      timings.mark(WAIT_METRIC, waited)
+    try:
+      with self._lock:
+        self.queued -= 1
+        if waited > self.queue_timeout:
+          self.expired += 1
+        else:
+          self.active += 1
+          self.wait_seconds += waited
+      if waited > self.queue_timeout:
+        logger.warning("Password hash waited %.2fs for a worker, shedding request: %s", waited, self.snapshot())
+        raise PasswordHashingUnavailable
+      self._worker.busy = True
+      started = time.monotonic()
+      try:
+        return fn(*args)
+      finally:
+        self._worker.busy = False
+        if timings is not None:
+          timings.mark(HASH_METRIC, time.monotonic() - started)
+        with self._lock:
+          self.active -= 1
+          self.completed += 1
+    finally:
+      self._slots.release()
+
+  def run(self, fn, *args):
+    """ ``fn(*args)`` on a worker, blocking the calling thread until it is done """
+    return self.submit(fn, *args).result()
+
+  async def arun(self, fn, *args):
+    """ ``fn(*args)`` on a worker, without blocking the event loop """
+    return await asyncio.wrap_future(self.submit(fn, *args))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+  """ The process-wide HashingPool, created from settings on first use """
+  global _pool  # noqa: PLW0603
+  if _pool is None:
+    with _pool_lock:
+      if _pool is None:
+        _pool = HashingPool(
+          workers=getattr(settings, "PASSWORD_HASHING_WORKERS", DEFAULT_WORKERS),
+          queue_size=getattr(settings, "PASSWORD_HASHING_QUEUE_SIZE", DEFAULT_QUEUE_SIZE),
+          queue_timeout=getattr(settings, "PASSWORD_HASHING_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT),
+        )
+  return _pool
+
+
+@receiver(setting_changed)
+def reset_pool(*, setting, **kwargs):
+  """ Rebuild the pool on its next use when override_settings changes it """
+  global _pool  # noqa: PLW0603
+  if setting in POOL_SETTINGS:
+    with _pool_lock:
+      pool, _pool = _pool, None
+    if pool is not None:
+      pool._executor.shutdown(wait=False)
+
+
+def make_password(raw_password):
+  """ ``hashers.make_password`` on the hashing pool """
+  if raw_password is None:
+    # Unusable password: a random string, nothing to hash
+    return hashers.make_password(None)
+  return get_pool().run(hashers.make_password, raw_password)
+
+
+async def amake_password(raw_password):
+  if raw_password is None:
+    return hashers.make_password(None)
+  return await get_pool().arun(hashers.make_password, raw_password)
+
+
+def verify_password(raw_password, encoded):
+  """
+    ``hashers.verify_password`` on the hashing pool.
+
+    Returns:
+      tuple[bool, bool]: Whether the password matches, and whether the
+      hash should be upgraded to the preferred hasher or cost.
+  """
+  return get_pool().run(hashers.verify_password, raw_password, encoded)
+
+
+async def averify_password(raw_password, encoded):
+  return await get_pool().arun(hashers.verify_password, raw_password, encoded)
@@ -0,0 +1,277 @@
+"""
+Bulk creation of parents and students from streamed rows.
+
+Used by the ``import_users`` management command. Rows are processed in
+chunks: each chunk is validated with a handful of set-based queries,
+passwords are hashed in a process pool, codes come from the block allocator
+and users/profiles are written with ``bulk_create``.
+"""
+import csv
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from dataclasses import field
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError
+from django.db import transaction
+
+from keycloak_with_multiple_roles.users.codes import allocate_codes
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.models import User
+from keycloak_with_multiple_roles.users.models import UserRole
+
+PROFILE_TYPES = ("parent", "student")
+PARENT_FIELDS = ("phone_number", "address")
+STUDENT_FIELDS = ("grade", "class_name")
+
+
+def read_rows(stream, fmt):
+  """
+    Yield ``(line_number, row)`` pairs from a CSV or JSONL stream.
+
+    Unparseable JSON lines are yielded as ``(line_number, None)``.
+  """
+  if fmt == "csv":
+    reader = csv.DictReader(stream)
+    for row in reader:
+      yield reader.line_num, row
+    return
+  for line_number, line in enumerate(stream, start=1):
+    if not line.strip():
+      continue
+    try:
+      yield line_number, json.loads(line)
+    except json.JSONDecodeError:
+      yield line_number, None
+
+
+def chunked(iterable, size):
+  iterator = iter(iterable)
+  while chunk := list(islice(iterator, size)):
+    yield chunk
+
+
+@dataclass
+class ImportRow:
+  line: int
+  data: dict
+  user: User = None
+
+
+@dataclass
+class ChunkResult:
+  created: int = 0
+  errors: list = field(default_factory=list)
+  seconds: float = 0.0
+
+  @property
+  def rows(self):
+    return self.created + len(self.errors)
+
+
+def _clean(value):
+  return "" if value is None else str(value).strip()
+
+
+class UserImporter:
+  """
+    Create users with their parent/student profiles in bulk.
+
+    Row keys: user_type, username, email, name, password, plus phone_number
+    and address for parents, or grade, class_name and either
+    parent_family_code or parent_username for students.
+  """
+
+  def __init__(self, *, hash_workers=None, batch_size=500):
+    self.hash_workers = hash_workers
+    self.batch_size = batch_size
+    self._executor = None
+
+  def __enter__(self):
+    if self.hash_workers != 0:
+      self._workers = self.hash_workers or os.cpu_count() or 1
+      self._executor = ProcessPoolExecutor(max_workers=self._workers, initializer=django.setup)
+    return self
+
+  def __exit__(self, *exc_info):
+    if self._executor is not None:
+      self._executor.shutdown()
+      self._executor = None
+
+  def import_chunk(self, chunk):
+    """
+      Validate and create one chunk of ``(line_number, row)`` pairs.
+
+      Returns:
+        ChunkResult: Number created and ``(line, reason)`` per bad row.
+    """
+    started = time.perf_counter()
+    result = ChunkResult()
+    rows = self._validate(chunk, result)
+    if rows:
+      self._hash_passwords(rows)
+      try:
+        with transaction.atomic():
+          self._create(rows)
+        result.created += len(rows)
+      except IntegrityError:
+        # Something slipped past validation (e.g. a concurrent insert);
+        # isolate the offending rows instead of dropping the chunk
+        parent_codes = {}
+        for row in sorted(rows, key=lambda row: row.data["user_type"] != "parent"):
+          try:
+            with transaction.atomic():
+              self._create([row], parent_codes)
+            result.created += 1
+          except IntegrityError as exc:
+            result.errors.append((row.line, str(exc)))
+    result.seconds = time.perf_counter() - started
+    return result
+
+  def _validate(self, chunk, result):
+    rows = []
+    for line, data in chunk:
+      if not isinstance(data, dict):
+        result.errors.append((line, "row is not an object"))
+        continue
+      data = {key: _clean(value) for key, value in data.items()}
+      error = self._check_row(data)
+      if error:
+        result.errors.append((line, error))
+      else:
+        rows.append(ImportRow(line, data))
+
+    rows = self._drop_duplicates(rows, "username", result)
+    rows = self._drop_duplicates(rows, "email", result)
+    return self._resolve_family_codes(rows, result)
+
+  def _check_row(self, data):
+    if data.get("user_type") not in PROFILE_TYPES:
+      return f"user_type must be one of {', '.join(PROFILE_TYPES)}"
+    if not data.get("username"):
+      return "username is required"
+    try:
+      validate_email(data.get("email"))
+    except ValidationError:
+      return "a valid email is required"
+    return None
+
+  def _drop_duplicates(self, rows, key, result):
+    """ Reject values repeated in the chunk or already stored, one query per chunk """
+    values = [row.data[key] for row in rows]
+    taken = set(User.objects.filter(**{f"{key}__in": values}).values_list(key, flat=True))
+    kept = []
+    for row in rows:
+      value = row.data[key]
+      if value in taken:
+        result.errors.append((row.line, f"{key} {value!r} already exists"))
+      else:
+        taken.add(value)
+        kept.append(row)
+    return kept
+
+  def _resolve_family_codes(self, rows, result):
+    """ Check family codes and map parent usernames to codes in bulk """
+    students = [row for row in rows if row.data["user_type"] == "student"]
+    codes = {row.data["parent_family_code"] for row in students if row.data.get("parent_family_code")}
+    usernames = {row.data["parent_username"] for row in students if row.data.get("parent_username")}
+    known_codes = set(Parent.objects.filter(family_code__in=codes).values_list("family_code", flat=True))
+    codes_by_username = dict(
+      Parent.objects.filter(user__username__in=usernames).values_list("user__username", "family_code"),
+    )
+    # Parents created in this chunk get their code in _create
+    chunk_parents = {row.data["username"] for row in rows if row.data["user_type"] == "parent"}
+
+    kept = []
+    for row in rows:
+      code = row.data.get("parent_family_code")
+      username = row.data.get("parent_username")
+      if row.data["user_type"] == "student" and code and code not in known_codes:
+        result.errors.append((row.line, f"unknown family code {code!r}"))
+      elif row.data["user_type"] == "student" and username and not code:
+        if username in codes_by_username:
+          row.data["parent_family_code"] = codes_by_username[username]
+          kept.append(row)
+        elif username in chunk_parents:
+          kept.append(row)
+        else:
+          result.errors.append((row.line, f"unknown parent {username!r}"))
+      else:
+        kept.append(row)
+    return kept
+
+  def _hash_passwords(self, rows):
+    passwords = [row.data.get("password") or None for row in rows]
+    if self._executor is None:
+      hashed = [make_password(password) for password in passwords]
+    else:
+      chunksize = max(1, len(passwords) // (self._workers * 4))
+      hashed = list(self._executor.map(make_password, passwords, chunksize=chunksize))
+    for row, password in zip(rows, hashed, strict=True):
+      row.data["password"] = password
+
+  def _create(self, rows, parent_codes=None):
+    """
+      Insert users and profiles for validated rows.
+
+      ``parent_codes`` maps usernames of parents created so far in the
+      chunk to their family code, for students linked by parent_username.
+    """
+    parent_codes = {} if parent_codes is None else parent_codes
+    users = [
+      User(
+        username=row.data["username"],
+        email=row.data["email"],
+        name=row.data.get("name") or None,
+        user_type=row.data["user_type"],
+        role_mask=User.ROLE_BITS[row.data["user_type"]],
+        password=row.data["password"],
+      )
+      for row in rows
+    ]
+    User.objects.bulk_create(users, batch_size=self.batch_size)
+    # bulk_create skips the signals granting user_type as a role
+    UserRole.objects.bulk_create(
+      [UserRole(user=user, role=user.user_type) for user in users], batch_size=self.batch_size,
+    )
+    for row, user in zip(rows, users, strict=True):
+      row.user = user
+
+    parent_rows = [row for row in rows if row.data["user_type"] == "parent"]
+    family_codes = allocate_codes("family", len(parent_rows))
+    parents = [
+      Parent(
+        user=row.user,
+        family_code=code,
+        **{name: row.data.get(name, "") for name in PARENT_FIELDS},
+      )
+      for row, code in zip(parent_rows, family_codes, strict=True)
+    ]
+    Parent.objects.bulk_create(parents, batch_size=self.batch_size)
+    parent_codes.update((parent.user.username, parent.family_code) for parent in parents)
+
+    student_rows = [row for row in rows if row.data["user_type"] == "student"]
+    student_codes = allocate_codes("student", len(student_rows))
+    students = [
+      Student(
+        student_link=row.user,
+        student_code=code,
+        parent_id=(
+          row.data.get("parent_family_code") or parent_codes.get(row.data.get("parent_username")) or None
+        ),
+        **{name: row.data.get(name, "") for name in STUDENT_FIELDS},
+      )
+      for row, code in zip(student_rows, student_codes, strict=True)
+    ]
+    Student.objects.bulk_create(students, batch_size=self.batch_size)
+    # bulk_create skips the signals maintaining Parent.student_count
+    Parent.objects.adjust_student_counts(Counter(student.parent_id for student in students))
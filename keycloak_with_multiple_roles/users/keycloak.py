@@ -0,0 +1,280 @@
+"""
+Local verification of Keycloak-issued access tokens.
+
+Tokens are checked against the realm's JWKS, fetched once and cached in
+process, so no request needs a token introspection round trip to Keycloak.
+When Keycloak cannot be reached the last good key set keeps being used, and
+fetches are retried at most once per ``min_refresh_interval``.
+"""
+import json
+import logging
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+import jwt
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+
+from keycloak_with_multiple_roles.users import roles as user_roles
+from keycloak_with_multiple_roles.users.models import User
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JWKS_CACHE_TTL = 3600
+# Unknown ``kid``s trigger a refetch (key rotation), and failed fetches are
+# retried, at most this often
+DEFAULT_JWKS_MIN_REFRESH_INTERVAL = 30
+DEFAULT_ALGORITHMS = ["RS256"]
+# Keycloak role -> user role; the first match is also the user_type
+DEFAULT_ROLE_MAP = {
+  "admin": "admin",
+  "parent": "parent",
+  "student": "student",
+}
+CONFLICT_MESSAGE = "A local user with this username or email already exists."
+
+
+class KeycloakTokenError(Exception):
+  """ Raised when an access token cannot be verified """
+
+
+class JWKSCache:
+  """
+    Rotation-aware cache of a JSON Web Key Set.
+
+    ``url`` may be an http(s) URL or a local path to a JWKS file, which keeps
+    tests independent of a running Keycloak.
+  """
+
+  def __init__(self, url, ttl=DEFAULT_JWKS_CACHE_TTL, min_refresh_interval=DEFAULT_JWKS_MIN_REFRESH_INTERVAL):
+    self.url = url
+    self.ttl = ttl
+    self.min_refresh_interval = min_refresh_interval
+    # Guards the key set; never held during a fetch
+    self._lock = threading.Lock()
+    # One fetch at a time
+    self._refresh_lock = threading.Lock()
+    self._keys = {}
+    self._fetched_at = None
+    self._attempted_at = None
+
+  def get_key(self, kid):
+    """
+      Return the signing key for ``kid``.
+
+      Refetches the key set when it is stale, or when ``kid`` is unknown,
+      unless a fetch was attempted less than ``min_refresh_interval`` ago.
+    """
+    if self.needs_fetch(kid):
+      self.refresh(kid)
+    with self._lock:
+      try:
+        return self._keys[kid]
+      except KeyError:
+        msg = f"No signing key found for kid {kid!r}."
+        raise KeycloakTokenError(msg) from None
+
+  def needs_fetch(self, kid):
+    with self._lock:
+      return self._needs_fetch(kid, time.monotonic())
+
+  def _needs_fetch(self, kid, now):
+    if self._attempted_at is not None and now - self._attempted_at <= self.min_refresh_interval:
+      return False
+    stale = self._fetched_at is None or now - self._fetched_at > self.ttl
+    return stale or kid not in self._keys
+
+  def refresh(self, kid=None):
+    """
+      Fetch the key set, unless another thread just did.
+
+      A failed fetch is logged and the previous keys are kept.
+    """
+    with self._refresh_lock:
+      now = time.monotonic()
+      with self._lock:
+        if not self._needs_fetch(kid, now):
+          return
+        self._attempted_at = now
+      try:
+        keys = self._fetch()
+      except KeycloakTokenError:
+        logger.warning("Fetching the Keycloak JWKS from %s failed", self.url, exc_info=True)
+        return
+      with self._lock:
+        self._keys = keys
+        self._fetched_at = now
+
+  def clear(self):
+    with self._lock:
+      self._keys = {}
+      self._fetched_at = None
+      self._attempted_at = None
+
+  def _fetch(self):
+    try:
+      if self.url.startswith(("http://", "https://")):
+        with urllib.request.urlopen(self.url, timeout=5) as response:  # noqa: S310
+          data = json.load(response)
+      else:
+        data = json.loads(Path(self.url).read_text())
+      jwk_set = jwt.PyJWKSet.from_dict(data)
+    except (OSError, ValueError, TypeError, KeyError, jwt.PyJWTError) as exc:
+      # Unreachable, timed out, or not a key set
+      msg = f"Could not load the JWKS from {self.url}: {exc}"
+      raise KeycloakTokenError(msg) from exc
+    return {key.key_id: key.key for key in jwk_set.keys}
+
+
+_jwks_cache = None
+_jwks_lock = threading.Lock()
+
+
+def get_jwks_cache():
+  """ Shared JWKSCache for the configured realm """
+  global _jwks_cache  # noqa: PLW0603
+  with _jwks_lock:
+    if _jwks_cache is None or _jwks_cache.url != settings.KEYCLOAK_JWKS_URL:
+      _jwks_cache = JWKSCache(
+        settings.KEYCLOAK_JWKS_URL,
+        ttl=getattr(settings, "KEYCLOAK_JWKS_CACHE_TTL", DEFAULT_JWKS_CACHE_TTL),
+      )
+    return _jwks_cache
+
+
+def decode_access_token(token):
+  """
+    Verify signature, expiry, issuer and audience of a Keycloak access token.
+
+    Returns:
+      dict: The token claims.
+  """
+  try:
+    header = jwt.get_unverified_header(token)
+    key = get_jwks_cache().get_key(header.get("kid"))
+    return jwt.decode(
+      token,
+      key,
+      algorithms=getattr(settings, "KEYCLOAK_ALGORITHMS", DEFAULT_ALGORITHMS),
+      audience=settings.KEYCLOAK_AUDIENCE,
+      issuer=settings.KEYCLOAK_ISSUER,
+      leeway=getattr(settings, "KEYCLOAK_LEEWAY", 0),
+      options={"require": ["exp", "iat", "sub"]},
+    )
+  except jwt.PyJWTError as exc:
+    raise KeycloakTokenError(str(exc)) from exc
+
+
+async def adecode_access_token(token):
+  """ decode_access_token for the event loop: a JWKS fetch runs in a worker thread """
+  try:
+    kid = jwt.get_unverified_header(token).get("kid")
+  except jwt.PyJWTError as exc:
+    raise KeycloakTokenError(str(exc)) from exc
+  jwks = get_jwks_cache()
+  if jwks.needs_fetch(kid):
+    await sync_to_async(jwks.refresh, thread_sensitive=False)(kid)
+  return decode_access_token(token)
+
+
+def get_token_roles(claims):
+  """ Realm roles plus the roles of our client in ``resource_access`` """
+  roles = set(claims.get("realm_access", {}).get("roles", []))
+  client = claims.get("resource_access", {}).get(settings.KEYCLOAK_CLIENT_ID, {})
+  roles.update(client.get("roles", []))
+  return roles
+
+
+def map_user_roles(roles):
+  """ Local roles for a set of Keycloak roles, in KEYCLOAK_ROLE_MAP order """
+  role_map = getattr(settings, "KEYCLOAK_ROLE_MAP", DEFAULT_ROLE_MAP)
+  return list(dict.fromkeys(user_role for role, user_role in role_map.items() if role in roles))
+
+
+def map_user_type(roles):
+  """ Pick User.user_type for a set of Keycloak roles """
+  return next(iter(map_user_roles(roles)), None)
+
+
+def _claim_values(claims):
+  roles = map_user_roles(get_token_roles(claims))
+  values = {
+    "email": claims.get("email") or f"{claims['sub']}@keycloak.invalid",
+    "name": claims.get("name"),
+    "user_type": next(iter(roles), None),
+  }
+  return values, roles
+
+
+def _apply_changes(user, values):
+  """ Copy changed ``values`` onto ``user`` and return the changed field names """
+  changed = [field for field, value in values.items() if getattr(user, field) != value]
+  for field in changed:
+    setattr(user, field, values[field])
+  return changed
+
+
+def _save_changes(user, changed):
+  """ Save the fields synced from the claims; a taken email fails the token """
+  try:
+    # A savepoint, so the conflict leaves the surrounding transaction usable
+    with transaction.atomic():
+      user.save(update_fields=[*changed, "updated_at"])
+  except IntegrityError as exc:
+    raise KeycloakTokenError(CONFLICT_MESSAGE) from exc
+
+
+def get_or_create_user(claims):
+  """
+    Return the local user for verified claims, creating it just in time.
+
+    Users are matched on the token subject. Email, name, user_type and
+    roles are synced from the claims, and only written when they changed;
+    unchanged roles are compared against User.role_mask without a query.
+  """
+  values, roles = _claim_values(claims)
+  user = User.objects.filter(keycloak_id=claims["sub"]).first()
+  if user is None:
+    try:
+      with transaction.atomic():
+        user = User(
+          keycloak_id=claims["sub"],
+          username=claims.get("preferred_username") or claims["sub"],
+          **values,
+        )
+        user.set_unusable_password()
+        user.save()
+        user_roles.set_roles(user, roles)
+    except IntegrityError as exc:
+      # Created by a concurrent request for the same subject
+      user = User.objects.filter(keycloak_id=claims["sub"]).first()
+      if user is None:
+        raise KeycloakTokenError(CONFLICT_MESSAGE) from exc
+    return user
+
+  changed = _apply_changes(user, values)
+  if changed:
+    _save_changes(user, changed)
+  user_roles.set_roles(user, roles)
+  return user
+
+
+async def aget_or_create_user(claims):
+  """ Async get_or_create_user on the async ORM """
+  user = await User.objects.filter(keycloak_id=claims["sub"]).afirst()
+  if user is None:
+    # Creation needs transaction.atomic, which is sync only; it runs once per user
+    return await sync_to_async(get_or_create_user)(claims)
+
+  values, roles = _claim_values(claims)
+  changed = _apply_changes(user, values)
+  if changed:
+    # Rare, and the savepoint is sync only
+    await sync_to_async(_save_changes)(user, changed)
+  if user.role_mask != user_roles.role_mask(roles):
+    await sync_to_async(user_roles.set_roles)(user, roles)
+  return user
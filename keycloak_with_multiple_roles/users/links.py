@@ -0,0 +1,90 @@
+"""
+Bulk linking of students to families by code.
+
+``link_students`` applies many ``(student_code, family_code)`` pairs with a
+fixed number of queries: one to lock the students, one to check the family
+codes and a single ``UPDATE`` for every change. ``Student.save`` is not
+called, so counts, cached profiles and events are updated through
+``signals.family_links_changed``.
+"""
+from django.db import models
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import Value
+from django.db.models import When
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.signals import family_links_changed
+
+LINKED = "linked"
+UNLINKED = "unlinked"
+UNCHANGED = "unchanged"
+ERROR = "error"
+
+
+def link_students(pairs):
+  """
+    Link or unlink many students in one transaction.
+
+    Args:
+      pairs: ``(student_code, family_code)`` tuples; a None family code
+        unlinks the student.
+
+    Returns:
+      list[dict]: One result per pair, in order, with ``student_code``,
+      ``family_code``, ``status`` (linked, unlinked, unchanged or error)
+      and ``error`` for failed pairs.
+  """
+  with transaction.atomic():
+    # Locked in pk order, so concurrent bulk links cannot deadlock each other
+    students = {
+      student.student_code: student
+      for student in Student.objects.select_for_update().filter(
+        student_code__in={student_code for student_code, family_code in pairs},
+      ).order_by("pk")
+    }
+    # Locked too, so no family is deleted before the UPDATE references it
+    families = set(
+      Parent.objects.select_for_update().filter(
+        family_code__in={family_code for student_code, family_code in pairs if family_code},
+      ).order_by("pk").values_list("family_code", flat=True),
+    )
+
+    results = []
+    changes = []
+    seen = set()
+    for student_code, family_code in pairs:
+      result = {"student_code": student_code, "family_code": family_code}
+      results.append(result)
+      student = students.get(student_code)
+      if student_code in seen:
+        result.update(status=ERROR, error=_("Student listed more than once."))
+      elif student is None:
+        result.update(status=ERROR, error=_("Invalid student code. Student not found."))
+      elif family_code and family_code not in families:
+        result.update(status=ERROR, error=_("Invalid family code. Parent not found."))
+      elif student.parent_id == family_code:
+        result.update(status=UNCHANGED)
+      else:
+        result.update(status=LINKED if family_code else UNLINKED)
+        changes.append((student, student.parent_id, family_code))
+      seen.add(student_code)
+
+    if changes:
+      now = timezone.now()
+      Student.objects.filter(pk__in=[student.pk for student, previous, current in changes]).update(
+        parent=Case(
+          *[When(pk=student.pk, then=Value(current)) for student, previous, current in changes],
+          output_field=models.CharField(),
+        ),
+        updated_at=now,
+      )
+      for student, previous, current in changes:
+        student.parent_id = current
+        student.updated_at = now
+        student._loaded_parent_family_code = current
+      family_links_changed(changes)
+  return results
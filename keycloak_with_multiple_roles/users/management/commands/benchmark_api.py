@@ -0,0 +1,70 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from keycloak_with_multiple_roles.users import benchmarks
+
+
+class Command(BaseCommand):
+  help = (
+    "Benchmark the users API hot paths (login, me, user list/retrieve and the "
+    "parent/student serializers) on seeded data, and compare latency, query "
+    "and write counts against a stored baseline. Seeded rows are rolled back."
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument("--parents", type=int, default=200, help="Parents to seed.")
+    parser.add_argument("--students-per-parent", type=int, default=3, help="Students seeded per parent.")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per scenario.")
+    parser.add_argument("--only", nargs="+", metavar="SCENARIO", help="Run only these scenarios.")
+    parser.add_argument(
+      "--baseline",
+      help="Baseline JSON file (default: users/benchmarks/baselines/<database vendor>.json).",
+    )
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline.")
+    parser.add_argument(
+      "--tolerance",
+      type=float,
+      default=0.5,
+      help="Allowed median latency increase over the baseline, as a fraction (default: 0.5).",
+    )
+
+  def handle(self, *args, **options):
+    results = benchmarks.run(
+      parents=options["parents"],
+      students_per_parent=options["students_per_parent"],
+      repeat=options["repeat"],
+      only=options["only"],
+    )
+
+    self.stdout.write(f"{'scenario':<24}{'median ms':>12}{'p95 ms':>12}{'queries':>10}{'writes':>8}")
+    for result in results:
+      self.stdout.write(
+        f"{result.name:<24}{result.median_ms:>12.2f}{result.p95_ms:>12.2f}{result.queries:>10}{result.writes:>8}",
+      )
+
+    path = Path(options["baseline"]) if options["baseline"] else benchmarks.baseline_path()
+    if options["save_baseline"]:
+      meta = {
+        "vendor": connection.vendor,
+        "parents": options["parents"],
+        "students_per_parent": options["students_per_parent"],
+        "repeat": options["repeat"],
+      }
+      benchmarks.save_baseline(path, results, meta)
+      self.stdout.write(self.style.SUCCESS(f"Baseline saved to {path}."))
+      return
+
+    baseline = benchmarks.load_baseline(path)
+    if baseline is None:
+      self.stdout.write(self.style.WARNING(f"No baseline at {path}; run with --save-baseline to create one."))
+      return
+    regressions = benchmarks.compare(results, baseline, options["tolerance"])
+    if regressions:
+      for regression in regressions:
+        self.stderr.write(regression)
+      msg = f"{len(regressions)} regression(s) against {path}."
+      raise CommandError(msg)
+    self.stdout.write(self.style.SUCCESS(f"No regressions against {path}."))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from keycloak_with_multiple_roles.users.codes import CODE_SPACES
+from keycloak_with_multiple_roles.users.codes import CodeSpaceExhaustedError
+from keycloak_with_multiple_roles.users.codes import allocator
+
+
+class Command(BaseCommand):
+  help = "Report how full the family/student code spaces are, optionally widening one."
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      "--widen",
+      choices=sorted(CODE_SPACES),
+      help="Start issuing codes one symbol longer for this space.",
+    )
+
+  def handle(self, *args, **options):
+    if options["widen"]:
+      try:
+        sequence = allocator.widen(options["widen"])
+      except CodeSpaceExhaustedError as exc:
+        raise CommandError(str(exc)) from exc
+      self.stdout.write(self.style.SUCCESS(f"Widened {sequence.name} codes to length {sequence.length}."))
+
+    for name in sorted(CODE_SPACES):
+      for row in allocator.usage(name):
+        marker = "*" if row["active"] else " "
+        self.stdout.write(
+          f"{marker} {row['name']:<8} length={row['length']} "
+          f"issued={row['issued']}/{row['capacity']} ({row['fill']:.2%})",
+        )
@@ -0,0 +1,65 @@
+import sys
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from keycloak_with_multiple_roles.users.importers import UserImporter
+from keycloak_with_multiple_roles.users.importers import chunked
+from keycloak_with_multiple_roles.users.importers import read_rows
+
+
+class Command(BaseCommand):
+  help = (
+    "Stream parents and students from a CSV or JSONL file (or '-' for stdin) "
+    "and create them in bulk. Bad rows are reported and skipped."
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument("path", help="Input file, or '-' to read stdin.")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="Defaults to the file extension.")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows validated and written together.")
+    parser.add_argument("--batch-size", type=int, default=500, help="bulk_create batch size.")
+    parser.add_argument(
+      "--hash-workers",
+      type=int,
+      default=None,
+      help="Processes hashing passwords (default: CPU count, 0 hashes inline).",
+    )
+
+  def handle(self, *args, **options):
+    path = options["path"]
+    fmt = options["format"] or ("csv" if path.endswith(".csv") else "jsonl")
+    if path == "-":
+      stream = sys.stdin
+    else:
+      try:
+        stream = Path(path).open(newline="", encoding="utf-8")  # noqa: SIM115
+      except OSError as exc:
+        raise CommandError(str(exc)) from exc
+
+    created = failed = 0
+    started = time.perf_counter()
+    importer = UserImporter(hash_workers=options["hash_workers"], batch_size=options["batch_size"])
+    try:
+      with importer:
+        for number, chunk in enumerate(chunked(read_rows(stream, fmt), options["chunk_size"]), start=1):
+          result = importer.import_chunk(chunk)
+          created += result.created
+          failed += len(result.errors)
+          for line, reason in result.errors:
+            self.stderr.write(f"line {line}: {reason}")
+          rate = result.rows / result.seconds if result.seconds else 0
+          self.stdout.write(
+            f"chunk {number}: {result.created} created, {len(result.errors)} failed ({rate:.0f} rows/s)",
+          )
+    finally:
+      if stream is not sys.stdin:
+        stream.close()
+
+    elapsed = time.perf_counter() - started
+    rate = (created + failed) / elapsed if elapsed else 0
+    self.stdout.write(
+      self.style.SUCCESS(f"Imported {created} users, {failed} failed in {elapsed:.1f}s ({rate:.0f} rows/s)."),
+    )
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+# Engines reading sessions from the django_session table
+DB_ENGINES = (
+  "django.contrib.sessions.backends.db",
+  "django.contrib.sessions.backends.cached_db",
+)
+
+
+class Command(BaseCommand):
+  help = (
+    "Delete rows from the django_session table in batches: expired sessions, "
+    "or with --all every row, e.g. after moving SESSION_ENGINE to the cache "
+    "or signed cookies. Unlike clearsessions, no single DELETE locks the table "
+    "for long."
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument("--batch-size", type=int, default=1000, help="Sessions deleted per DELETE.")
+    parser.add_argument(
+      "--all",
+      action="store_true",
+      help="Delete every session row. Refused while SESSION_ENGINE still stores sessions in the table.",
+    )
+
+  def handle(self, *args, **options):
+    if options["all"] and settings.SESSION_ENGINE in DB_ENGINES:
+      msg = f"SESSION_ENGINE is {settings.SESSION_ENGINE}; --all would log every user out."
+      raise CommandError(msg)
+
+    sessions = Session.objects.order_by("pk")
+    if not options["all"]:
+      sessions = sessions.filter(expire_date__lt=timezone.now())
+    keys = sessions.values_list("pk", flat=True)
+    deleted = 0
+    while True:
+      batch = list(keys[:options["batch_size"]])
+      if not batch:
+        break
+      deleted += Session.objects.filter(pk__in=batch).delete()[0]
+      self.stdout.write(f"{deleted} sessions deleted")
+    self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} session rows."))
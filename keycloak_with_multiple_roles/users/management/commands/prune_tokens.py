@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from keycloak_with_multiple_roles.users.models import AuthToken
+
+
+class Command(BaseCommand):
+  help = (
+    "Delete expired API tokens in batches, oldest expiry first. Each batch "
+    "is its own short DELETE, so the table is never locked for long; run it "
+    "periodically, e.g. from cron."
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument("--batch-size", type=int, default=1000, help="Tokens deleted per DELETE.")
+    parser.add_argument(
+      "--pause",
+      type=float,
+      default=0.0,
+      help="Seconds to sleep between batches, to leave room for other writes.",
+    )
+
+  def handle(self, *args, **options):
+    # Tokens expiring while the command runs are left for the next run
+    now = timezone.now()
+    keys = AuthToken.objects.filter(expires_at__lte=now).order_by("expires_at").values_list("pk", flat=True)
+    deleted = 0
+    while True:
+      batch = list(keys[:options["batch_size"]])
+      if not batch:
+        break
+      deleted += AuthToken.objects.filter(pk__in=batch, expires_at__lte=now).delete()[0]
+      self.stdout.write(f"{deleted} tokens deleted")
+      if options["pause"]:
+        time.sleep(options["pause"])
+    self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired tokens."))
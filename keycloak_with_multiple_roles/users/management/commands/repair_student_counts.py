@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from keycloak_with_multiple_roles.users.models import Parent
+
+
+class Command(BaseCommand):
+  help = (
+    "Recompute the stored Parent.student_count from the student table in "
+    "batches, e.g. after raw SQL or queryset.update() changed family links."
+  )
+
+  def add_arguments(self, parser):
+    parser.add_argument("--batch-size", type=int, default=1000, help="Parents recounted per UPDATE.")
+
+  def handle(self, *args, **options):
+    pks = Parent.objects.order_by("pk").values_list("pk", flat=True)
+    checked = fixed = 0
+    last = None
+    while True:
+      batch = list((pks if last is None else pks.filter(pk__gt=last))[:options["batch_size"]])
+      if not batch:
+        break
+      fixed += Parent.objects.filter(pk__in=batch).recount_students()
+      checked += len(batch)
+      last = batch[-1]
+      self.stdout.write(f"{checked} parents checked, {fixed} fixed")
+    self.stdout.write(self.style.SUCCESS(f"Recounted {checked} parents, {fixed} had a wrong count."))
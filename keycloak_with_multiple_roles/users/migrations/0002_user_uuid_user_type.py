@@ -0,0 +1,63 @@
+# Generated by Django 5.1.12 on 2026-10-18 13:20
+
+import uuid
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def populate_uuids(apps, schema_editor):
+    """
+    Give every existing user their own UUID. Adding the field with a
+    callable default would evaluate it once and fail the unique constraint.
+    """
+    User = apps.get_model("users", "User")
+    rows = User.objects.filter(uuid=None).order_by("pk")
+    while True:
+        batch = list(rows.only("pk")[:BATCH_SIZE])
+        if not batch:
+            break
+        for user in batch:
+            user.uuid = uuid.uuid4()
+        User.objects.bulk_update(batch, ["uuid"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='user',
+            options={'ordering': ['-date_joined'], 'verbose_name': 'User', 'verbose_name_plural': 'Users'},
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='user_type',
+            field=models.CharField(blank=True, choices=[('parent', 'Parent'), ('student', 'Student'), ('admin', 'Admin')], max_length=10, null=True, verbose_name='User Type'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_uuids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='email',
+            field=models.EmailField(max_length=254, unique=True, verbose_name='email address'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='name',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Name of User'),
+        ),
+    ]
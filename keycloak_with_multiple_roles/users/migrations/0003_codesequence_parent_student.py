@@ -0,0 +1,70 @@
+# Generated by Django 5.1.12 on 2026-10-18 13:21
+
+import django.db.models.deletion
+import keycloak_with_multiple_roles.users.models
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_uuid_user_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('name', models.CharField(max_length=20, verbose_name='Name')),
+                ('length', models.PositiveSmallIntegerField(verbose_name='Length')),
+                ('next_index', models.BigIntegerField(default=0, verbose_name='Next index')),
+            ],
+            options={
+                'verbose_name': 'Code sequence',
+                'verbose_name_plural': 'Code sequences',
+                'constraints': [models.UniqueConstraint(fields=('name', 'length'), name='unique_code_sequence_length')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Parent',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('family_code', models.CharField(default=keycloak_with_multiple_roles.users.models.generate_family_code, editable=False, help_text='Unique family code for parent.', max_length=10, unique=True, verbose_name='Family code')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='parent', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('phone_number', models.CharField(blank=True, max_length=15, verbose_name='Phone Number')),
+                ('address', models.TextField(blank=True, verbose_name='Address')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+            ],
+            options={
+                'verbose_name': 'Parent',
+                'verbose_name_plural': 'Parents',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['family_code'], name='users_paren_family__e3bc78_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Student',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('student_link', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='student_profile', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('parent_family_code', models.CharField(blank=True, help_text='Unique family code for parent', max_length=10, null=True, verbose_name='Parent Family Code')),
+                ('student_code', models.CharField(default=keycloak_with_multiple_roles.users.models.generate_student_code, editable=False, help_text='Auto-generated student code', max_length=10, unique=True, verbose_name='student Code')),
+                ('grade', models.CharField(blank=True, help_text="Student's current grade level", max_length=20, verbose_name='Grade')),
+                ('class_name', models.CharField(blank=True, help_text="Student's current class", max_length=20, verbose_name='Class Name')),
+            ],
+            options={
+                'verbose_name': 'Student',
+                'verbose_name_plural': 'Students',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['parent_family_code'], name='users_stude_parent__7b6bee_idx'), models.Index(fields=['student_code'], name='users_stude_student_5adf85_idx'), models.Index(fields=['grade'], name='users_stude_grade_25ecd0_idx'), models.Index(fields=['class_name'], name='users_stude_class_n_b520aa_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.12 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_codesequence_parent_student'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='keycloak_id',
+            field=models.CharField(blank=True, editable=False, help_text='Subject of the Keycloak account this user was created from.', max_length=255, null=True, unique=True, verbose_name='Keycloak ID'),
+        ),
+    ]
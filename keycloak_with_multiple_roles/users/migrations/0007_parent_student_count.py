@@ -0,0 +1,43 @@
+# Generated by Django 5.1.12 on 2026-10-18 13:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+
+
+def count_students(apps, schema_editor):
+    Parent = apps.get_model("users", "Parent")
+    Student = apps.get_model("users", "Student")
+    students = (
+        Student.objects.filter(parent_family_code=OuterRef("family_code"))
+        .order_by()
+        .values("parent_family_code")
+        .annotate(total=Count("pk"))
+        .values("total")
+    )
+    pks = Parent.objects.order_by("pk").values_list("pk", flat=True)
+    last = None
+    while True:
+        batch = list((pks if last is None else pks.filter(pk__gt=last))[:BATCH_SIZE])
+        if not batch:
+            break
+        Parent.objects.filter(pk__in=batch).update(student_count=Coalesce(Subquery(students), 0))
+        last = batch[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_user_type_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parent',
+            name='student_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Student count'),
+        ),
+        migrations.RunPython(count_students, migrations.RunPython.noop),
+    ]
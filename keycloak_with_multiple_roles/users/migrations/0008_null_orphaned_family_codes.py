@@ -0,0 +1,56 @@
+# Generated by Django 5.1.12 on 2026-10-18 15:10
+
+import sys
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+REPORTED_CODES = 20
+
+
+def null_orphaned_family_codes(apps, schema_editor):
+    """
+    Clear family codes that match no parent, so the column can become a
+    foreign key. Blank codes are cleared too; unlinked is NULL from now on.
+    """
+    Parent = apps.get_model("users", "Parent")
+    Student = apps.get_model("users", "Student")
+    rows = Student.objects.exclude(parent_family_code=None).order_by("pk")
+    orphans = 0
+    codes = set()
+    last = None
+    while True:
+        batch = list(
+            (rows if last is None else rows.filter(pk__gt=last))
+            .values_list("pk", "parent_family_code")[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        known = set(
+            Parent.objects.filter(family_code__in={code for _, code in batch if code})
+            .values_list("family_code", flat=True)
+        )
+        orphaned = [(pk, code) for pk, code in batch if code not in known]
+        if orphaned:
+            Student.objects.filter(pk__in=[pk for pk, _ in orphaned]).update(parent_family_code=None)
+            orphans += len(orphaned)
+            codes.update(code for _, code in orphaned if code)
+        last = batch[-1][0]
+    if orphans:
+        sample = ", ".join(sorted(codes)[:REPORTED_CODES])
+        more = " ..." if len(codes) > REPORTED_CODES else ""
+        sys.stdout.write(
+            f"\n  Unlinked {orphans} student(s) whose family code matched no parent "
+            f"({len(codes)} distinct code(s): {sample}{more})\n"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_parent_student_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(null_orphaned_family_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.12 on 2026-10-18 15:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_null_orphaned_family_codes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='student',
+            name='users_stude_parent__7b6bee_idx',
+        ),
+        # Pin the column name first so the rename below does not touch the table
+        migrations.AlterField(
+            model_name='student',
+            name='parent_family_code',
+            field=models.CharField(blank=True, db_column='parent_family_code', help_text='Unique family code for parent', max_length=10, null=True, verbose_name='Parent Family Code'),
+        ),
+        migrations.RenameField(
+            model_name='student',
+            old_name='parent_family_code',
+            new_name='parent',
+        ),
+        migrations.AlterField(
+            model_name='student',
+            name='parent',
+            field=models.ForeignKey(blank=True, db_column='parent_family_code', help_text='Parent this student is linked to, by family code', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='students', to='users.parent', to_field='family_code', verbose_name='Parent'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.12 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+# Trigram indexes for the admin's icontains searches. The expression matches
+# what PostgreSQL's icontains lookup compares, UPPER(column::text).
+TRIGRAM_INDEXES = [
+    ("users_user_email_trgm_idx", "users_user", "email"),
+    ("users_user_username_trgm_idx", "users_user", "username"),
+    ("users_user_name_trgm_idx", "users_user", "name"),
+    ("users_parent_phone_trgm_idx", "users_parent", "phone_number"),
+]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} "
+            f"USING gin ((UPPER({column}::text)) gin_trgm_ops)"
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name, _, _ in TRIGRAM_INDEXES:
+        schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('users', '0009_student_parent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='parent',
+            index=models.Index(fields=['-created_at', '-user'], name='users_parent_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['-created_at', '-student_link'], name='users_student_created_idx'),
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.1.12 on 2026-10-18 14:03
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+BATCH_SIZE = 1000
+
+
+def copy_drf_tokens(apps, schema_editor):
+    """
+    Carry DRF's tokens over, so signed-in clients keep working. They expire
+    one API_TOKEN_TTL from now unless used, like freshly renewed tokens.
+    """
+    Token = apps.get_model("authtoken", "Token")
+    AuthToken = apps.get_model("users", "AuthToken")
+    expires_at = timezone.now() + timedelta(seconds=getattr(settings, "API_TOKEN_TTL", 14 * 24 * 3600))
+    rows = Token.objects.order_by("pk")
+    last = None
+    while True:
+        batch = list(
+            (rows if last is None else rows.filter(pk__gt=last))
+            .values_list("key", "user_id", "created")[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        AuthToken.objects.bulk_create(
+            [
+                AuthToken(key=key, user_id=user_id, issued_at=created, expires_at=expires_at)
+                for key, user_id, created in batch
+            ],
+            ignore_conflicts=True,
+        )
+        last = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_user_updated_at'),
+        ('authtoken', '0004_alter_tokenproxy_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthToken',
+            fields=[
+                ('key', models.CharField(max_length=40, primary_key=True, serialize=False, verbose_name='Key')),
+                ('issued_at', models.DateTimeField(verbose_name='Issued At')),
+                ('expires_at', models.DateTimeField(verbose_name='Expires At')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='api_token', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'API token',
+                'verbose_name_plural': 'API tokens',
+                'indexes': [models.Index(fields=['expires_at'], name='users_authtoken_expires_idx')],
+            },
+        ),
+        migrations.RunPython(copy_drf_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.1.12 on 2026-10-18 14:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+# User.ROLE_BITS when this migration was written
+ROLE_BITS = {"parent": 1 << 0, "student": 1 << 1, "admin": 1 << 2}
+
+
+def grant_user_types(apps, schema_editor):
+    """
+    Every user holds their user_type as a role, so existing users start
+    with that one role.
+    """
+    User = apps.get_model("users", "User")
+    UserRole = apps.get_model("users", "UserRole")
+    for role, bit in ROLE_BITS.items():
+        User.objects.filter(user_type=role).update(role_mask=bit)
+    rows = User.objects.filter(user_type__in=ROLE_BITS).order_by("pk")
+    last = None
+    while True:
+        batch = list((rows if last is None else rows.filter(pk__gt=last)).values_list("pk", "user_type")[:BATCH_SIZE])
+        if not batch:
+            break
+        UserRole.objects.bulk_create(
+            [UserRole(user_id=user_id, role=role) for user_id, role in batch],
+            ignore_conflicts=True,
+        )
+        last = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0012_auth_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='role_mask',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Roles'),
+        ),
+        migrations.CreateModel(
+            name='UserRole',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Updated At')),
+                ('role', models.CharField(choices=[('parent', 'Parent'), ('student', 'Student'), ('admin', 'Admin')], max_length=10, verbose_name='Role')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='role_memberships', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'User role',
+                'verbose_name_plural': 'User roles',
+                'indexes': [models.Index(fields=['role'], name='users_userrole_role_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'role'), name='users_userrole_user_role_uniq')],
+            },
+        ),
+        migrations.RunPython(grant_user_types, migrations.RunPython.noop),
+    ]
@@ -1,12 +1,25 @@
-import random
-import string
+import binascii
+import os
 import uuid
+from collections import defaultdict
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import OuterRef
+from django.db.models import Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.functions import Greatest
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from keycloak_with_multiple_roles.users import hashing
+
 class TimestampModel(models.Model):
   """ Abstract model with created_at and updated_at fields """
   created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
@@ -15,24 +28,40 @@ class TimestampModel(models.Model):
   class Meta:
     abstract = True
 
+class CodeSequence(TimestampModel):
+  """
+    Reservation counter for one width of a generated code space.
+
+    Each row tracks how many indexes of ``name`` codes with ``length``
+    characters have been handed out in blocks by ``users.codes``.
+    Widening a code space adds a new row; older rows stay valid.
+  """
+
+  name = models.CharField(_("Name"), max_length=20)
+  length = models.PositiveSmallIntegerField(_("Length"))
+  next_index = models.BigIntegerField(_("Next index"), default=0)
+
+  class Meta:
+    verbose_name = _("Code sequence")
+    verbose_name_plural = _("Code sequences")
+    constraints = [
+      models.UniqueConstraint(fields=["name", "length"], name="unique_code_sequence_length"),
+    ]
+
+  def __str__(self):
+    return f"{self.name}[{self.length}] @ {self.next_index}"
+
 #     Utility funcitons
 def generate_family_code():
-  """Generate unique 5-character family code (e.g., 'A8K9Z')"""
-  while True:
-    code = "".join(random.choices(string.ascii_uppercase + string.digits, k=5))
-    # Check if code exists using a late import to avoid circular dependency
-    from keycloak_with_multiple_roles.users.models import Parent
-    if not Parent.objects.filter(family_code=code).exists():
-      return code
+  """Allocate unique family code (e.g., 'A8K9Z') from the reserved block pool"""
+  from keycloak_with_multiple_roles.users.codes import allocate_code
+  return allocate_code("family")
 
 
 def generate_student_code():
-  """Generate unique 8-character student code (e.g., 'STU12345')"""
-  while True:
-    code = "STU" + "".join(random.choices(string.digits, k=5))
-    from keycloak_with_multiple_roles.users.models import Student
-    if not Student.objects.filter(student_code=code).exists():
-      return code
+  """Allocate unique student code (e.g., 'STU12345') from the reserved block pool"""
+  from keycloak_with_multiple_roles.users.codes import allocate_code
+  return allocate_code("student")
 
 class User(AbstractUser):
   """
@@ -44,19 +73,45 @@ class User(AbstractUser):
       ('student', _('Student')),
       ('admin', _('Admin')),
   )
+  # Bit of each role in role_mask. Masks are stored: never renumber a role
+  ROLE_BITS = {
+    "parent": 1 << 0,
+    "student": 1 << 1,
+    "admin": 1 << 2,
+  }
 
   uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
   email = models.EmailField(_('email address'), unique=True)
+  # Primary role, always one of the user's roles; see users.roles
   user_type = models.CharField(_("User Type"), max_length=10, choices=USER_TYPE_CHOICES, null=True, blank=True)
+  # Union of the user's UserRole rows, maintained by users.roles
+  role_mask = models.PositiveSmallIntegerField(_("Roles"), default=0, editable=False)
+  keycloak_id = models.CharField(
+    _("Keycloak ID"),
+    max_length=255,
+    unique=True,
+    null=True,
+    blank=True,
+    editable=False,
+    help_text=_("Subject of the Keycloak account this user was created from."),
+  )
 
   name = models.CharField(_("Name of User"), max_length=255, null=True, blank=True)
   first_name = None
   last_name  = None
 
+  # Row version for ETag/Last-Modified; saves of last_login alone keep it
+  updated_at = models.DateTimeField(_("Updated At"), auto_now=True)
+
   class Meta:
     verbose_name = _("User")
     verbose_name_plural = _("Users")
     ordering = ['-date_joined']
+    indexes = [
+      # Keyset pagination of UserViewSet walks (date_joined, id)
+      models.Index(fields=['-date_joined', '-id'], name='users_user_joined_id_idx'),
+      models.Index(fields=['user_type'], name='users_user_type_idx'),
+    ]
 
   def get_absolute_url(self) -> str:
       """ Get URL for user's detail view."""
@@ -66,6 +121,242 @@ class User(AbstractUser):
   def __str__(self):
     return self.email or self.username
 
+  def has_role(self, role):
+    """ Whether the user holds ``role``, read from role_mask without a query """
+    return bool(self.role_mask & self.ROLE_BITS.get(role, 0))
+
+  def has_any_role(self, *roles):
+    return any(self.has_role(role) for role in roles)
+
+  @property
+  def role_names(self):
+    """ The user's roles, in USER_TYPE_CHOICES order """
+    return [role for role, _label in self.USER_TYPE_CHOICES if self.has_role(role)]
+
+  # Hashing runs on the bounded pool of users.hashing, see there
+  def set_password(self, raw_password):
+    self.password = hashing.make_password(raw_password)
+    self._password = raw_password
+
+  def check_password(self, raw_password):
+    is_correct, must_update = hashing.verify_password(raw_password, self.password)
+    if is_correct and must_update:
+      self.set_password(raw_password)
+      # Hash upgrades are not password changes
+      self._password = None
+      self.save(update_fields=["password"])
+    return is_correct
+
+  async def acheck_password(self, raw_password):
+    is_correct, must_update = await hashing.averify_password(raw_password, self.password)
+    if is_correct and must_update:
+      self.password = await hashing.amake_password(raw_password)
+      await self.asave(update_fields=["password"])
+    return is_correct
+
+class UserRole(TimestampModel):
+  """
+    A role held by a user; a user may hold several.
+
+    Saving or deleting one recomputes User.role_mask (see users.roles), so
+    role checks never query this table.
+  """
+
+  user = models.ForeignKey(
+    User, on_delete=models.CASCADE, related_name="role_memberships", verbose_name=_("User"),
+  )
+  role = models.CharField(_("Role"), max_length=10, choices=User.USER_TYPE_CHOICES)
+
+  class Meta:
+    verbose_name = _("User role")
+    verbose_name_plural = _("User roles")
+    constraints = [
+      models.UniqueConstraint(fields=["user", "role"], name="users_userrole_user_role_uniq"),
+    ]
+    indexes = [
+      # Role members, e.g. every admin
+      models.Index(fields=["role"], name="users_userrole_role_idx"),
+    ]
+
+  def __str__(self):
+    return f"{self.user_id}: {self.role}"
+
+DEFAULT_TOKEN_TTL = 14 * 24 * 3600
+DEFAULT_TOKEN_RENEW_INTERVAL = 3600
+
+def token_ttl():
+  return timedelta(seconds=getattr(settings, "API_TOKEN_TTL", DEFAULT_TOKEN_TTL))
+
+def token_renew_interval():
+  return timedelta(seconds=getattr(settings, "API_TOKEN_RENEW_INTERVAL", DEFAULT_TOKEN_RENEW_INTERVAL))
+
+class AuthTokenManager(models.Manager):
+  """ Issuing and sliding renewal of expiring API tokens """
+
+  def _new(self, now):
+    return {"key": AuthToken.generate_key(), "issued_at": now, "expires_at": now + token_ttl()}
+
+  def issue(self, user):
+    """ The user's token, replaced by a new one when it has expired """
+    now = timezone.now()
+    token, created = self.get_or_create(user=user, defaults=self._new(now))
+    if not created and token.expires_at <= now:
+      self.filter(pk=token.pk).delete()
+      token, created = self.get_or_create(user=user, defaults=self._new(now))
+    return token
+
+  async def aissue(self, user):
+    """ Async issue() on the async ORM """
+    now = timezone.now()
+    token, created = await self.aget_or_create(user=user, defaults=self._new(now))
+    if not created and token.expires_at <= now:
+      await self.filter(pk=token.pk).adelete()
+      token, created = await self.aget_or_create(user=user, defaults=self._new(now))
+    return token
+
+  def renewal_due(self, expires_at, now):
+    """ Whether a token expiring at ``expires_at`` was last renewed over an interval ago """
+    return expires_at - now < token_ttl() - token_renew_interval()
+
+  def _renewal(self, key, now):
+    expires_at = now + token_ttl()
+    # Conditional, so concurrent renewals within an interval write once
+    renewable = self.filter(pk=key, expires_at__lt=expires_at - token_renew_interval())
+    return renewable, expires_at
+
+  def renew(self, key, now):
+    """
+      Slide a token's expiry to ``now`` plus API_TOKEN_TTL.
+
+      Returns:
+        datetime | None: The new expiry, or None when no row was updated:
+        the token was deleted, or renewed concurrently.
+    """
+    renewable, expires_at = self._renewal(key, now)
+    return expires_at if renewable.update(expires_at=expires_at) else None
+
+  async def arenew(self, key, now):
+    renewable, expires_at = self._renewal(key, now)
+    return expires_at if await renewable.aupdate(expires_at=expires_at) else None
+
+class AuthToken(models.Model):
+  """
+    API token expiring API_TOKEN_TTL seconds after its last renewal.
+
+    Replaces DRF's never-expiring authtoken.Token. Tokens in use are
+    renewed at most once per API_TOKEN_RENEW_INTERVAL, and expired ones
+    are removed by the ``prune_tokens`` command.
+  """
+
+  key = models.CharField(_("Key"), max_length=40, primary_key=True)
+  user = models.OneToOneField(
+    User, on_delete=models.CASCADE, related_name="api_token", verbose_name=_("User"),
+  )
+  issued_at = models.DateTimeField(_("Issued At"))
+  expires_at = models.DateTimeField(_("Expires At"))
+
+  objects = AuthTokenManager()
+
+  class Meta:
+    verbose_name = _("API token")
+    verbose_name_plural = _("API tokens")
+    indexes = [
+      # prune_tokens walks expired tokens in expiry order
+      models.Index(fields=['expires_at'], name='users_authtoken_expires_idx'),
+    ]
+
+  def __str__(self):
+    return f"{self.user_id} until {self.expires_at:%Y-%m-%d %H:%M}"
+
+  @classmethod
+  def generate_key(cls):
+    return binascii.hexlify(os.urandom(20)).decode()
+
+  def is_expired(self, now=None):
+    return self.expires_at <= (now or timezone.now())
+
+def students_prefetch():
+  """ Prefetch of ``Parent.students`` with their users """
+  return models.Prefetch("students", queryset=Student.objects.select_related("student_link"))
+
+
+def prefetch_students(parents):
+  """
+    Load the students of many already fetched parents with a single query,
+    where ``Parent.get_all_students`` picks them up.
+  """
+  models.prefetch_related_objects([parent for parent in parents if isinstance(parent, Parent)], students_prefetch())
+
+
+class ParentQuerySet(models.QuerySet):
+  """ QuerySet for Parent with bulk loading of linked students """
+
+  def with_students(self):
+    """ Load linked students for every parent in one extra query """
+    return self.prefetch_related(students_prefetch())
+
+  def adjust_student_counts(self, deltas):
+    """
+      Apply ``{family_code: change}`` to the stored student counts.
+
+      Uses F() expressions, so concurrent links never lose an update, and
+      issues one UPDATE per distinct change rather than per parent.
+    """
+    codes_by_delta = defaultdict(list)
+    for family_code, delta in deltas.items():
+      if family_code and delta:
+        codes_by_delta[delta].append(family_code)
+    for delta, codes in codes_by_delta.items():
+      queryset = self.filter(family_code__in=codes)
+      if delta > 0:
+        queryset.update(student_count=F("student_count") + delta)
+      else:
+        queryset.update(student_count=Greatest(F("student_count") + delta, 0))
+
+  def with_versions(self):
+    """
+      Annotate what a parent's profile was last changed at.
+
+      Adds ``user_updated_at`` and, over the linked students and their
+      users, ``students_updated_at`` and ``student_users_updated_at``.
+      Unlinking or deleting a student changes ``student_count``, which
+      covers the rows that left the family.
+    """
+    students = Student.objects.filter(parent_id=OuterRef("family_code")).order_by().values("parent_id")
+    return self.annotate(
+      user_updated_at=F("user__updated_at"),
+      students_updated_at=Subquery(students.annotate(latest=Max("updated_at")).values("latest")),
+      student_users_updated_at=Subquery(
+        students.annotate(latest=Max("student_link__updated_at")).values("latest"),
+      ),
+    )
+
+  def recount_students(self):
+    """
+      Recompute stored student counts from the student table.
+
+      Returns:
+        int: Number of parents whose count was wrong.
+    """
+    actual = Coalesce(Subquery(counted_students()), 0)
+    return self.exclude(student_count=actual).update(student_count=actual)
+
+
+def counted_students():
+  """ Subquery counting the students of the parent in the outer query """
+  return (
+    Student.objects.filter(parent_id=OuterRef("family_code"))
+    .order_by()
+    .values("parent_id")
+    .annotate(total=Count("pk"))
+    .values("total")
+  )
+
+
+class ParentManager(models.Manager.from_queryset(ParentQuerySet)):
+  """ Custom manager for parent model """
+
+
 class Parent(TimestampModel):
   """
     Parent Model: onetoone relationship with User
@@ -103,31 +394,44 @@ class Parent(TimestampModel):
   phone_number = models.CharField(_("Phone Number"), max_length=15, blank=True)
   address = models.TextField(_("Address"), blank=True)
 
+  # Maintained by the Student signals, see ParentQuerySet.adjust_student_counts;
+  # the repair_student_counts command recomputes it
+  student_count = models.PositiveIntegerField(_("Student count"), default=0, editable=False)
+
   created_at = models.DateTimeField(_("Created At"), auto_now_add=True)
   updated_at = models.DateTimeField(_("Updated At"), auto_now=True)
 
+  objects = ParentManager()
+
   class Meta:
     verbose_name = _("Parent")
     verbose_name_plural = _("Parents")
     ordering = ["-created_at"]
     indexes = [
       models.Index(fields=['family_code']),
+      # Default ordering plus the primary key the admin adds as tie-breaker
+      models.Index(fields=['-created_at', '-user'], name='users_parent_created_idx'),
     ]
 
   def __str__(self):
-    return f"Parent: {self.user.link.email} ({self.family_code})"
+    return f"Parent: {self.user.email} ({self.family_code})"
 
   def get_all_students(self):
     """
       Get all students linked to this parent via family_code
     Returns:
-      Queryset: All students with matching parent_family code
+      Queryset: All students with matching parent_family code, served from
+      the prefetch of ``Parent.objects.with_students()`` when there is one
     """
-    return Student.objects.filter(parent_family_code=self.family_code)
+    return self.students.all()
+
+  def students_loaded(self):
+    """ Whether the students were prefetched, see with_students """
+    return "students" in getattr(self, "_prefetched_objects_cache", {})
 
   def get_students_count(self):
     """ Get total number of students linked to parents """
-    return self.get_all_students().count()
+    return self.student_count
 
   def check_valid_student(self, student_user_id):
     """
@@ -139,7 +443,9 @@ class Parent(TimestampModel):
       Returns:
         bool: True if student belongs to this parent, False otherwise.
     """
-    return self.get_all_students().filter(student_link__id=student_user_id).exists()
+    if self.students_loaded():
+      return any(student.student_link_id == student_user_id for student in self.students.all())
+    return self.students.filter(student_link__id=student_user_id).exists()
 
 class StudentManager(models.Manager):
   """ Custom manager for student model """
@@ -167,20 +473,16 @@ class StudentManager(models.Manager):
 
   def unlinked_students(self):
     """ Get all studnets without parent links """
-    return self.filter(
-      model.Q(parent_family_code__isnull=True) | models.Q(parent_family_code='')
-    )
+    return self.filter(parent__isnull=True)
 
   def linked_students(self):
     """ Get all students with parent links"""
-    return self.exclude(
-      models.Q(parent_family_code__isnull=True) | models.Q(parent_family_code='')
-    )
+    return self.filter(parent__isnull=False)
 
 class Student(TimestampModel):
   """
       Student model - One-to-One relationship with User.
-      Students are linked to parents via parent_family_code.
+      Students are linked to parents via the parent's family code.
       """
 
   uuid = models.UUIDField(
@@ -196,12 +498,18 @@ class Student(TimestampModel):
     primary_key=True
   )
 
-  parent_family_code = models.CharField(
-    _("Parent Family Code"),
-    max_length=10,
+  # Keyed on the family code, so ``parent_id`` is the code itself and the
+  # column keeps its old name
+  parent = models.ForeignKey(
+    Parent,
+    on_delete=models.SET_NULL,
+    to_field="family_code",
+    db_column="parent_family_code",
+    related_name="students",
     blank=True,
     null=True,
-    help_text="Unique family code for parent"
+    verbose_name=_("Parent"),
+    help_text=_("Parent this student is linked to, by family code")
   )
 
   #Auto-generated student code
@@ -236,10 +544,10 @@ class Student(TimestampModel):
     verbose_name_plural = _("Students")
     ordering = ['-created_at']
     indexes = [
-      models.Index(fields=['parent_family_code']),
       models.Index(fields=['student_code']),
       models.Index(fields=['grade']),
-      models.Index(fields=['class_name'])
+      models.Index(fields=['class_name']),
+      models.Index(fields=['-created_at', '-student_link'], name='users_student_created_idx'),
     ]
 
   def __str__(self):
@@ -252,17 +560,11 @@ class Student(TimestampModel):
         Returns:
           Parent: Parent object or None if not found.
     """
-    if not self.parent_family_code:
-      return None
-
-    try:
-      return Parent.objects.get(family_code=self.parent_family_code)
-    except Parent.DoesNotExist:
-      return None
+    return self.parent
 
   def is_linked_to_parent(self):
     """ Check if student is linked to a parent"""
-    return bool(self.parent_family_code and self.get_parent())
+    return self.parent_id is not None
 
   def link_to_parent(self, family_code):
     """
@@ -277,14 +579,14 @@ class Student(TimestampModel):
 
     try:
       parent = Parent.objects.get(family_code=family_code)
-      self.parent_family_code = family_code
-      self.save(update_fields=['parent_family_code', 'updated_at'])
+      self.parent = parent
+      self.save(update_fields=['parent', 'updated_at'])
       return True
     except Parent.DoesNotExist:
       return False
 
   def unlink_from_parent(self):
     """ Remove parent link from this student"""
-    self.parent_family_code = None
-    self.save(update_fields=['parent_family_code','updated_at'])
+    self.parent = None
+    self.save(update_fields=['parent','updated_at'])
 
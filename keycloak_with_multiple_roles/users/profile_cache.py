@@ -0,0 +1,101 @@
+"""
+Cache of the profile summaries built by LoginView and MeView.
+
+Payloads are stored per user id under a versioned key. Bump
+``PROFILE_CACHE_VERSION`` whenever the shape of a cached payload changes so
+old entries are simply never read again. Entries are dropped by the model
+signals in ``users.signals`` whenever the underlying rows change. Hits and
+misses are reported per request as the ``profile`` metric of users.timing.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from keycloak_with_multiple_roles.users import timing
+
+PROFILE_CACHE_VERSION = 1
+DEFAULT_TIMEOUT = 300
+
+# Payload kinds cached per user: LoginView's profile_data and MeView's
+# profile. The row versions MeView's ETag is derived from are read on every
+# request, so a missed invalidation cannot turn into a wrong 304.
+LOGIN_PROFILE = "login"
+ME_PROFILE = "me"
+PROFILE_KINDS = (LOGIN_PROFILE, ME_PROFILE)
+PROFILE_METRIC = "profile"
+
+_MISSING = object()
+
+
+def profile_cache_key(kind, user_id):
+  return f"profile:v{PROFILE_CACHE_VERSION}:{kind}:{user_id}"
+
+
+def get_or_build(kind, user_id, builder):
+  """
+    Return the cached ``kind`` payload for a user, building it on a miss.
+
+    Args:
+      kind: One of PROFILE_KINDS.
+      user_id: ID of the user the payload belongs to.
+      builder: Callable returning the payload; may return None.
+  """
+  key = profile_cache_key(kind, user_id)
+  payload = cache.get(key, _MISSING)
+  if payload is not _MISSING:
+    timing.mark(PROFILE_METRIC, desc="hit")
+    return payload
+
+  started = time.perf_counter()
+  payload = builder()
+  timing.mark(PROFILE_METRIC, time.perf_counter() - started, "miss")
+  cache.set(key, payload, getattr(settings, "PROFILE_CACHE_TIMEOUT", DEFAULT_TIMEOUT))
+  return payload
+
+
+async def aget_or_build(kind, user_id, abuilder):
+  """ Async get_or_build; ``abuilder`` is a coroutine function """
+  key = profile_cache_key(kind, user_id)
+  payload = await cache.aget(key, _MISSING)
+  if payload is not _MISSING:
+    timing.mark(PROFILE_METRIC, desc="hit")
+    return payload
+
+  started = time.perf_counter()
+  payload = await abuilder()
+  timing.mark(PROFILE_METRIC, time.perf_counter() - started, "miss")
+  await cache.aset(key, payload, getattr(settings, "PROFILE_CACHE_TIMEOUT", DEFAULT_TIMEOUT))
+  return payload
+
+
+def invalidate(*user_ids):
+  """
+    Drop every cached profile payload of the given users.
+
+    Runs once the surrounding transaction commits, so a concurrent request
+    cannot cache the old rows again in between.
+  """
+  keys = [profile_cache_key(kind, user_id) for user_id in set(user_ids) if user_id for kind in PROFILE_KINDS]
+  if keys:
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_families(*family_codes):
+  """
+    Drop the cached profiles of every member of the given families.
+
+    A parent's profile lists their students, and a student's embeds their
+    parent (with the parent's user) and their siblings, so a change to any
+    member changes all of them.
+  """
+  from keycloak_with_multiple_roles.users.models import Parent
+  from keycloak_with_multiple_roles.users.models import Student
+
+  codes = {code for code in family_codes if code}
+  if codes:
+    invalidate(
+      *Parent.objects.filter(family_code__in=codes).values_list("user_id", flat=True),
+      *Student.objects.filter(parent_id__in=codes).values_list("student_link_id", flat=True),
+    )
@@ -0,0 +1,289 @@
+"""
+Token-bucket rate limiting for the auth and family-code endpoints.
+
+A rule such as ``"login:username": "10/m"`` gives every identity (a
+username, a client IP, a family code, ...) a bucket of 10 tokens refilled
+at 10 per minute; each request takes one token. Buckets live in Redis and
+are checked and updated by a single Lua script, so concurrent workers never
+race, and a request checking several buckets (e.g. IP and username) takes
+a token from each only when all of them allow it. No database is touched.
+
+When Redis is unreachable the limiter falls back to buckets in process
+memory, which limit per worker rather than globally, and retries Redis
+after ``REDIS_RETRY_INTERVAL`` seconds.
+
+Limits are enforced by ``RateLimitMiddleware`` (per client IP, before
+sessions or authentication are loaded) and by the DRF throttles and
+fields in ``users.api.throttling``.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import cached_property
+
+import redis
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import JsonResponse
+from django.urls import reverse
+from rest_framework import exceptions
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "ratelimit:"
+DEFAULT_REDIS_TIMEOUT = 0.1
+REDIS_RETRY_INTERVAL = 5.0
+DEFAULT_LOCAL_SIZE = 10000
+
+RATE = re.compile(r"(?P<tokens>\d+)/(?P<count>\d*)(?P<unit>[smhd])")
+UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# KEYS: buckets; ARGV: capacity and refill rate (tokens/s) of each bucket.
+# Returns "0" when a token was taken from every bucket, otherwise the
+# seconds until all of them have one (as a string: Lua numbers would be
+# truncated to integers).
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+  local capacity = tonumber(ARGV[2 * i - 1])
+  local rate = tonumber(ARGV[2 * i])
+  local state = redis.call('HMGET', key, 'tokens', 'ts')
+  local available = tonumber(state[1]) or capacity
+  local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+  available = math.min(capacity, available + elapsed * rate)
+  if available < 1 then
+    wait = math.max(wait, (1 - available) / rate)
+  end
+  tokens[i] = available
+end
+for i, key in ipairs(KEYS) do
+  local capacity = tonumber(ARGV[2 * i - 1])
+  local rate = tonumber(ARGV[2 * i])
+  if wait == 0 then
+    tokens[i] = tokens[i] - 1
+  end
+  redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+  redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000))
+end
+return tostring(wait)
+"""
+
+
+def parse_rate(rate):
+  """
+    Parse ``"<tokens>/<period>"``, e.g. ``"10/m"`` or ``"100/15m"``.
+
+    Returns:
+      tuple[int, float]: Bucket capacity and refill rate in tokens per second.
+  """
+  match = RATE.fullmatch(rate.replace(" ", ""))
+  if match is None:
+    raise ImproperlyConfigured(f"Invalid rate limit {rate!r}, expected e.g. '10/m'.")
+  tokens = int(match["tokens"])
+  seconds = int(match["count"] or 1) * UNIT_SECONDS[match["unit"]]
+  return tokens, tokens / seconds
+
+
+def bucket_key(rule, identity):
+  """ Redis key of a bucket; identities are hashed to keep usernames out of Redis """
+  digest = hashlib.blake2b(str(identity).lower().encode(), digest_size=12).hexdigest()
+  return f"{KEY_PREFIX}{rule}:{digest}"
+
+
+class LocalTokenBuckets:
+  """ In-process token buckets, an LRU of at most ``size`` buckets """
+
+  def __init__(self, size=DEFAULT_LOCAL_SIZE):
+    self.size = size
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+  def take(self, buckets):
+    """ Same contract as the Lua script: (key, capacity, rate) tuples in, wait out """
+    now = time.monotonic()
+    with self._lock:
+      available = []
+      for key, capacity, rate in buckets:
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        available.append(min(capacity, tokens + (now - updated) * rate))
+      wait = max(
+        ((1 - tokens) / rate for tokens, (_, _, rate) in zip(available, buckets) if tokens < 1),
+        default=0.0,
+      )
+      for tokens, (key, _, _) in zip(available, buckets):
+        self._buckets[key] = (tokens if wait else tokens - 1, now)
+        self._buckets.move_to_end(key)
+      while len(self._buckets) > self.size:
+        self._buckets.popitem(last=False)
+    return wait
+
+
+class RateLimiter:
+  """
+    Token buckets in Redis, with an in-process fallback.
+
+    Args:
+      rates: ``{rule: "<tokens>/<period>"}``.
+      redis_url: Redis holding the buckets; empty to only use local buckets.
+  """
+
+  def __init__(self, rates, redis_url, timeout=DEFAULT_REDIS_TIMEOUT, local_size=DEFAULT_LOCAL_SIZE):
+    self.rates = {rule: parse_rate(rate) for rule, rate in rates.items()}
+    self.local = LocalTokenBuckets(local_size)
+    self.script = None
+    if redis_url:
+      client = redis.Redis.from_url(redis_url, socket_timeout=timeout, socket_connect_timeout=timeout)
+      self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+    # Monotonic time until which Redis is skipped after a failure
+    self._redis_down_until = 0.0
+
+  def hit(self, *checks):
+    """
+      Take a token for each ``(rule, identity)`` pair.
+
+      Pairs with an unknown rule or an empty identity are ignored.
+
+      Returns:
+        float: 0 when the request is allowed, otherwise the seconds to wait.
+    """
+    buckets = {}
+    for rule, identity in checks:
+      if rule in self.rates and identity:
+        buckets[bucket_key(rule, identity)] = self.rates[rule]
+    if not buckets:
+      return 0.0
+    buckets = [(key, capacity, rate) for key, (capacity, rate) in buckets.items()]
+    if self.script is not None and time.monotonic() >= self._redis_down_until:
+      try:
+        return self._hit_redis(buckets)
+      except redis.RedisError:
+        logger.warning(
+          "Rate limit Redis unavailable, using local buckets for %.0fs", REDIS_RETRY_INTERVAL, exc_info=True,
+        )
+        self._redis_down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+    return self.local.take(buckets)
+
+  def _hit_redis(self, buckets):
+    args = []
+    for _, capacity, rate in buckets:
+      args += [capacity, rate]
+    return float(self.script(keys=[key for key, _, _ in buckets], args=args))
+
+  def check(self, *checks):
+    """ ``hit``, raising DRF's Throttled (429 with Retry-After) when limited """
+    wait = self.hit(*checks)
+    if wait:
+      raise exceptions.Throttled(wait=wait)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+LIMITER_SETTINGS = ("RATE_LIMITS", "RATE_LIMIT_REDIS_URL", "RATE_LIMIT_REDIS_TIMEOUT", "RATE_LIMIT_LOCAL_SIZE")
+
+
+def get_limiter():
+  """ The process-wide RateLimiter, created from settings on first use """
+  global _limiter  # noqa: PLW0603
+  if _limiter is None:
+    with _limiter_lock:
+      if _limiter is None:
+        _limiter = RateLimiter(
+          getattr(settings, "RATE_LIMITS", {}),
+          getattr(settings, "RATE_LIMIT_REDIS_URL", ""),
+          timeout=getattr(settings, "RATE_LIMIT_REDIS_TIMEOUT", DEFAULT_REDIS_TIMEOUT),
+          local_size=getattr(settings, "RATE_LIMIT_LOCAL_SIZE", DEFAULT_LOCAL_SIZE),
+        )
+  return _limiter
+
+
+@receiver(setting_changed)
+def reset_limiter(*, setting, **kwargs):
+  global _limiter  # noqa: PLW0603
+  if setting in LIMITER_SETTINGS:
+    with _limiter_lock:
+      _limiter = None
+
+
+def enabled():
+  return getattr(settings, "RATE_LIMIT_ENABLED", True)
+
+
+def check(*checks):
+  """ Take a token for each ``(rule, identity)`` pair, raising Throttled when limited """
+  if enabled():
+    get_limiter().check(*checks)
+
+
+def client_ip(request):
+  """
+    Client address, honouring REST_FRAMEWORK's NUM_PROXIES like DRF throttles.
+
+    NUM_PROXIES must match the deployment: with it unset, DRF takes the
+    client-controlled X-Forwarded-For header as is.
+  """
+  return BaseThrottle().get_ident(request)
+
+
+class RateLimitMiddleware:
+  """
+    Per-client-IP limits on whole views, checked before the view runs.
+
+    Sits above the session and authentication middleware, so a limited
+    request costs no database query.
+
+    Settings:
+      RATE_LIMIT_VIEWS: ``{url name: rule}``, e.g. ``{"users:login": "auth:ip"}``.
+        Only URLs without arguments are supported.
+  """
+
+  sync_capable = True
+  async_capable = True
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+    self.async_mode = iscoroutinefunction(get_response)
+    if self.async_mode:
+      markcoroutinefunction(self)
+
+  @cached_property
+  def rules(self):
+    # Reversed on first use, once the URLconf can be imported
+    return {reverse(name): rule for name, rule in getattr(settings, "RATE_LIMIT_VIEWS", {}).items()}
+
+  def __call__(self, request):
+    if self.async_mode:
+      return self.__acall__(request)
+    rule = self.rules.get(request.path_info) if enabled() else None
+    if rule is not None:
+      wait = get_limiter().hit((rule, client_ip(request)))
+      if wait:
+        return self.throttled(wait)
+    return self.get_response(request)
+
+  async def __acall__(self, request):
+    rule = self.rules.get(request.path_info) if enabled() else None
+    if rule is not None:
+      # A Redis round trip: keep it off the shared sync thread
+      wait = await sync_to_async(get_limiter().hit, thread_sensitive=False)((rule, client_ip(request)))
+      if wait:
+        return self.throttled(wait)
+    return await self.get_response(request)
+
+  def throttled(self, wait):
+    exc = exceptions.Throttled(wait=wait)
+    response = JsonResponse({"detail": exc.detail}, status=exc.status_code)
+    response["Retry-After"] = str(exc.wait)
+    return response
@@ -0,0 +1,85 @@
+"""
+Role memberships of users.
+
+A user holds any number of the roles in ``User.ROLE_BITS`` through
+UserRole rows. Their union is precomputed into ``User.role_mask``, so
+``user.has_role()`` reads the row already loaded for the request (and
+cached with its token) instead of joining the membership table.
+
+The mask is recomputed whenever a UserRole is saved or deleted, see
+signals. ``user_type`` stays the user's primary role: it is always one of
+their roles (None only without roles), and setting it adds the role.
+"""
+from django.db import transaction
+
+from keycloak_with_multiple_roles.users.models import User
+from keycloak_with_multiple_roles.users.models import UserRole
+
+
+def role_mask(roles):
+  """ Bitmask of role names; unknown roles raise KeyError """
+  mask = 0
+  for role in roles:
+    mask |= User.ROLE_BITS[role]
+  return mask
+
+
+def primary_role(mask):
+  """ First role of ``mask`` in USER_TYPE_CHOICES order, or None """
+  for role, _label in User.USER_TYPE_CHOICES:
+    if mask & User.ROLE_BITS[role]:
+      return role
+  return None
+
+
+def refresh_role_mask(user):
+  """
+    Recompute ``user.role_mask`` from their UserRole rows.
+
+    The user row is locked first, so concurrent role changes of one user
+    are applied one after the other and the last one sees every row. The
+    user is only saved when the mask changed; that save invalidates their
+    cached tokens and profiles like any other user change.
+
+    Returns:
+      bool: Whether the mask changed.
+  """
+  with transaction.atomic():
+    stored = User.objects.select_for_update().filter(pk=user.pk).values_list("role_mask", "user_type").first()
+    if stored is None:
+      # Deleted, e.g. UserRole rows removed by the cascade
+      return False
+    stored_mask, user.user_type = stored
+    mask = role_mask(UserRole.objects.filter(user_id=user.pk).values_list("role", flat=True))
+    user.role_mask = mask
+    if mask == stored_mask:
+      return False
+    update_fields = ["role_mask", "updated_at"]
+    if not (user.user_type and user.has_role(user.user_type)):
+      user.user_type = primary_role(mask)
+      update_fields.append("user_type")
+    user.save(update_fields=update_fields)
+    return True
+
+
+def add_roles(user, *roles):
+  """ Grant ``roles`` to ``user``; roles already held are kept """
+  with transaction.atomic():
+    UserRole.objects.bulk_create([UserRole(user=user, role=role) for role in roles], ignore_conflicts=True)
+    # bulk_create skips the signals recomputing the mask
+    refresh_role_mask(user)
+
+
+def set_roles(user, roles):
+  """
+    Make ``roles`` exactly the roles of ``user``.
+
+    Used to sync roles from Keycloak. Nothing is written when the user
+    already holds exactly these roles.
+  """
+  roles = set(roles)
+  if user.role_mask == role_mask(roles):
+    return
+  with transaction.atomic():
+    add_roles(user, *roles)
+    UserRole.objects.filter(user=user).exclude(role__in=roles).delete()
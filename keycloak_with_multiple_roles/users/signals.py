@@ -0,0 +1,191 @@
+"""
+Model signal handlers for the users app.
+"""
+from collections import Counter
+
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import Permission
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_init
+from django.db.models.signals import post_migrate
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from keycloak_with_multiple_roles.users import events
+from keycloak_with_multiple_roles.users import profile_cache
+from keycloak_with_multiple_roles.users import roles
+from keycloak_with_multiple_roles.users.api.authentication import invalidate_tokens
+from keycloak_with_multiple_roles.users.backends import bump_permission_version
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.models import User
+from keycloak_with_multiple_roles.users.models import UserRole
+
+
+@receiver(post_init, sender=Student)
+def remember_parent_family_code(sender, instance, **kwargs):
+  """ Keep the family code as loaded, to find the previous parent on save """
+  # Read __dict__ directly so a deferred field is not fetched
+  instance._loaded_parent_family_code = instance.__dict__.get("parent_id")
+
+
+def student_event_data(student, family_code):
+  return {
+    "family_code": family_code,
+    "student": {
+      "user_id": student.student_link_id,
+      "student_code": student.student_code,
+      "grade": student.grade,
+      "class_name": student.class_name,
+    },
+  }
+
+
+def family_links_changed(changes):
+  """
+    Keep counts, cached profiles and clients in step with family changes.
+
+    Shared by student_saved and bulk updates (users.links), which bypass
+    the model signals.
+
+    Args:
+      changes: ``(student, previous_code, current_code)`` triples; a code
+        is None when the student was not / is no longer linked.
+  """
+  deltas = Counter()
+  published = []
+  for student, previous, current in changes:
+    deltas[previous] -= 1
+    deltas[current] += 1
+    if previous:
+      published.append((
+        events.STUDENT_UNLINKED, student_event_data(student, previous), [previous], [student.student_link_id],
+      ))
+    if current:
+      published.append((
+        events.STUDENT_LINKED, student_event_data(student, current), [current], [student.student_link_id],
+      ))
+  Parent.objects.adjust_student_counts(deltas)
+  profile_cache.invalidate(*(student.student_link_id for student, _, _ in changes))
+  profile_cache.invalidate_families(*(code for _, previous, current in changes for code in (previous, current)))
+  events.publish_many(published)
+
+
+@receiver(post_save, sender=Student)
+def student_saved(sender, instance, created=False, **kwargs):
+  """ Linking, unlinking or editing a student changes the profiles of its families """
+  previous = None if created else instance._loaded_parent_family_code
+  current = instance.parent_id
+
+  if (previous or None) != (current or None):
+    family_links_changed([(instance, previous or None, current)])
+  else:
+    profile_cache.invalidate(instance.student_link_id)
+    profile_cache.invalidate_families(current)
+    if current and not created:
+      events.publish(events.STUDENT_UPDATED, student_event_data(instance, current), family_codes=[current])
+  instance._loaded_parent_family_code = current
+
+
+@receiver(post_delete, sender=Student)
+def student_deleted(sender, instance, **kwargs):
+  Parent.objects.adjust_student_counts({instance.parent_id: -1})
+  profile_cache.invalidate(instance.student_link_id)
+  profile_cache.invalidate_families(instance.parent_id)
+  events.publish(
+    events.STUDENT_UNLINKED,
+    student_event_data(instance, instance.parent_id),
+    family_codes=[instance.parent_id],
+  )
+
+
+@receiver(post_save, sender=Parent)
+# Before the delete, while on_delete=SET_NULL has not unlinked the students yet
+@receiver(pre_delete, sender=Parent)
+def parent_changed(sender, instance, signal, created=False, **kwargs):
+  """ Students embed their parent's details, so drop theirs as well """
+  profile_cache.invalidate(instance.user_id)
+  profile_cache.invalidate_families(instance.family_code)
+  if signal is post_save and not created:
+    events.publish(
+      events.PARENT_UPDATED,
+      {"family_code": instance.family_code, "user_id": instance.user_id},
+      family_codes=[instance.family_code],
+    )
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created=False, update_fields=None, **kwargs):
+  """ User details are embedded in the profiles of their whole family """
+  if created or (update_fields is not None and set(update_fields) <= {"last_login"}):
+    return
+  # Cached token lookups carry the user row (is_active, role_mask, ...)
+  invalidate_tokens(*AuthToken.objects.filter(user_id=instance.pk).values_list("key", flat=True))
+  profile_cache.invalidate(instance.pk)
+  # Their family as a student, and as a parent
+  family_codes = [
+    *Student.objects.filter(student_link_id=instance.pk).values_list("parent_id", flat=True),
+    *Parent.objects.filter(user_id=instance.pk).values_list("family_code", flat=True),
+  ]
+  profile_cache.invalidate_families(*family_codes)
+  if events.events_enabled():
+    # Only who changed: family members see this too, and refetch what they show
+    events.publish(
+      events.USER_UPDATED,
+      {"user_id": instance.pk},
+      family_codes=family_codes,
+      user_ids=[instance.pk],
+    )
+
+
+@receiver(post_save, sender=User)
+def password_changed(sender, instance, created=False, **kwargs):
+  """ A new password revokes the user's API tokens """
+  # set_password() keeps the raw password in _password until the save
+  # completes; hash upgrades on login clear it first
+  if not created and instance._password is not None:
+    AuthToken.objects.filter(user_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=User)
+def primary_role_granted(sender, instance, **kwargs):
+  """ Setting user_type grants that role """
+  if instance.user_type and not instance.has_role(instance.user_type):
+    roles.add_roles(instance, instance.user_type)
+
+
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def user_role_changed(sender, instance, origin=None, **kwargs):
+  """ Keep User.role_mask the union of the user's roles """
+  # Not for the cascade of a user's own delete
+  if isinstance(origin, User) or getattr(origin, "model", None) is User:
+    return
+  roles.refresh_role_mask(instance.user)
+
+
+@receiver(post_delete, sender=AuthToken)
+def token_deleted(sender, instance, **kwargs):
+  """ Revoke cached lookups, e.g. on LogoutView """
+  # Cached lookups of expired tokens are refused anyway, so prune_tokens
+  # does not queue a cache delete per row
+  if not instance.is_expired(timezone.now()):
+    invalidate_tokens(instance.key)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+# New permissions are bulk created after migrations, for superusers
+@receiver(post_migrate)
+def permissions_changed(sender, action=None, **kwargs):
+  """ Retire the permission sets cached by CachedModelBackend """
+  if action is None or action.startswith("post_"):
+    bump_permission_version()
@@ -0,0 +1,182 @@
+"""
+Tests of expiring API tokens and their LRU -> cache -> database lookup tiers.
+"""
+from datetime import timedelta
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users.api.authentication import CachedTokenAuthentication
+from keycloak_with_multiple_roles.users.api.authentication import local_tokens
+from keycloak_with_multiple_roles.users.api.authentication import token_cache_key
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.models import token_renew_interval
+from keycloak_with_multiple_roles.users.models import token_ttl
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+ME_URL = "/users/auth/me"
+LOGOUT_URL = "/users/auth/logout"
+
+
+@pytest.fixture(autouse=True)
+def _clear_local_tokens():
+  local_tokens.clear()
+  yield
+  local_tokens.clear()
+
+
+@pytest.fixture
+def token():
+  return AuthToken.objects.issue(UserFactory(password="password"))
+
+
+def token_client(token):
+  client = APIClient()
+  client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+  return client
+
+
+def authenticate(key):
+  return CachedTokenAuthentication().authenticate_credentials(key)
+
+
+def aauthenticate(key):
+  return async_to_sync(CachedTokenAuthentication().aauthenticate_credentials)(key)
+
+
+def cached(token):
+  """ Whether the LRU and the shared cache hold a lookup of the token """
+  cache_key = token_cache_key(token.key)
+  return local_tokens.get(cache_key) is not None, cache.get(cache_key) is not None
+
+
+def forget(tier):
+  """ Drop the tiers above ``tier``, so the next lookup is answered there """
+  if tier in ("cache", "db"):
+    local_tokens.clear()
+  if tier == "db":
+    cache.clear()
+
+
+@pytest.mark.parametrize("lookup", [authenticate, aauthenticate])
+def test_lookup_fills_every_tier(token, lookup):
+  user, _token = lookup(token.key)
+
+  assert user == token.user
+  assert cached(token) == (True, True)
+
+
+@pytest.mark.parametrize("lookup", [authenticate, aauthenticate])
+@pytest.mark.parametrize("tier", ["local", "cache", "db"])
+def test_expired_token_is_rejected_at_every_tier(token, monkeypatch, lookup, tier):
+  lookup(token.key)
+  later = token.expires_at + timedelta(seconds=1)
+  monkeypatch.setattr(timezone, "now", lambda: later)
+  forget(tier)
+
+  with pytest.raises(AuthenticationFailed, match="expired"):
+    lookup(token.key)
+
+
+def test_expired_token_is_rejected_over_http(token):
+  AuthToken.objects.filter(pk=token.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+  response = token_client(token).get(ME_URL)
+
+  assert response.status_code == 403
+  assert response.json()["detail"] == "Token has expired."
+
+
+def test_logout_revokes_every_tier(token, django_capture_on_commit_callbacks):
+  client = token_client(token)
+  assert client.get(ME_URL).status_code == 200
+  assert cached(token) == (True, True)
+
+  with django_capture_on_commit_callbacks(execute=True):
+    assert client.post(LOGOUT_URL).status_code == 200
+
+  assert cached(token) == (False, False)
+  assert not AuthToken.objects.filter(pk=token.pk).exists()
+  assert client.get(ME_URL).status_code == 403
+
+
+def test_password_change_revokes_every_tier(token, django_capture_on_commit_callbacks):
+  client = token_client(token)
+  assert client.get(ME_URL).status_code == 200
+
+  with django_capture_on_commit_callbacks(execute=True):
+    token.user.set_password("changed")
+    token.user.save()
+
+  assert cached(token) == (False, False)
+  assert not AuthToken.objects.filter(pk=token.pk).exists()
+  assert client.get(ME_URL).status_code == 403
+
+
+def test_password_upgrade_keeps_tokens(token):
+  user = token.user
+  # Too short a salt, so the hash is upgraded on the next login
+  weak = make_password("password", salt="short")
+  user.password = weak
+  user.save()
+
+  assert user.check_password("password")
+
+  assert user.password != weak
+  assert AuthToken.objects.filter(pk=token.pk).exists()
+
+
+def test_issue_reuses_valid_token(token):
+  assert AuthToken.objects.issue(token.user).key == token.key
+  assert async_to_sync(AuthToken.objects.aissue)(token.user).key == token.key
+
+
+@pytest.mark.parametrize("issue", [AuthToken.objects.issue, async_to_sync(AuthToken.objects.aissue)])
+def test_issue_replaces_expired_token(token, issue):
+  AuthToken.objects.filter(pk=token.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+  issued = issue(token.user)
+
+  assert issued.key != token.key
+  assert not issued.is_expired()
+  assert list(AuthToken.objects.values_list("key", flat=True)) == [issued.key]
+
+
+@pytest.mark.parametrize("renew", [AuthToken.objects.renew, async_to_sync(AuthToken.objects.arenew)])
+def test_renew_writes_once_per_interval(token, renew):
+  now = token.issued_at + token_renew_interval() + timedelta(seconds=1)
+
+  renewed = renew(token.key, now)
+
+  assert renewed == now + token_ttl()
+  assert AuthToken.objects.get(pk=token.pk).expires_at == renewed
+  # Renewed already, e.g. by a concurrent request
+  assert renew(token.key, now) is None
+
+
+@pytest.mark.parametrize("renew", [AuthToken.objects.renew, async_to_sync(AuthToken.objects.arenew)])
+def test_renew_of_deleted_token(token, renew):
+  now = token.issued_at + token_renew_interval() + timedelta(seconds=1)
+  token.delete()
+
+  assert renew(token.key, now) is None
+
+
+def test_deleted_token_is_not_recached_on_renewal(token, monkeypatch):
+  authenticate(token.key)
+  # Deleted by another process, whose cache delete has not arrived yet
+  AuthToken.objects.filter(pk=token.pk).update(key="replaced")
+  later = token.issued_at + token_renew_interval() + timedelta(seconds=1)
+  monkeypatch.setattr(timezone, "now", lambda: later)
+
+  with pytest.raises(AuthenticationFailed, match="Invalid token"):
+    authenticate(token.key)
+
+  assert cached(token) == (False, False)
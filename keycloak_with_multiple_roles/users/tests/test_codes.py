@@ -0,0 +1,131 @@
+"""
+Tests of the block allocator for family and student codes.
+"""
+import pytest
+
+from keycloak_with_multiple_roles.users import codes
+from keycloak_with_multiple_roles.users.codes import CodeAllocator
+from keycloak_with_multiple_roles.users.codes import CodeSpace
+from keycloak_with_multiple_roles.users.codes import CodeSpaceExhaustedError
+from keycloak_with_multiple_roles.users.codes import permutation_key
+from keycloak_with_multiple_roles.users.models import CodeSequence
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+# Two symbols, so widths 2 and 3 hold 4 and 8 codes
+TINY = CodeSpace(
+  name="tiny", prefix="T", alphabet="01", length=2, max_length=3, model="users.Student", field="student_code",
+)
+
+
+@pytest.fixture
+def tiny(monkeypatch):
+  monkeypatch.setitem(codes.CODE_SPACES, "tiny", TINY)
+  return TINY
+
+
+@pytest.mark.parametrize(
+  ("alphabet", "length"),
+  [("0123456789", 2), ("0123456789", 3), ("012", 3), ("01", 1), ("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", 2)],
+)
+def test_permutation_is_a_bijection(alphabet, length):
+  space = CodeSpace("test", "", alphabet, length, length, "users.Student", "student_code")
+  capacity = space.capacity(length)
+
+  permuted = [space.permute(index, length, b"key") for index in range(capacity)]
+
+  assert sorted(permuted) == list(range(capacity))
+
+
+def test_permutation_depends_on_key():
+  space = codes.CODE_SPACES["student"]
+  indexes = range(50)
+
+  first = [space.permute(index, 5, b"one") for index in indexes]
+
+  assert first == [space.permute(index, 5, b"one") for index in indexes]
+  assert first != [space.permute(index, 5, b"two") for index in indexes]
+  # Consecutive indexes do not give consecutive codes
+  assert first != sorted(first)
+
+
+def test_encode_shapes_codes():
+  key = permutation_key()
+
+  family = codes.CODE_SPACES["family"].encode(0, 5, key)
+  student = codes.CODE_SPACES["student"].encode(0, 5, key)
+
+  assert len(family) == 5
+  assert set(family) <= set(codes.CODE_SPACES["family"].alphabet)
+  assert student.startswith("STU")
+  assert student[3:].isdigit()
+  assert len(student) == 8
+
+
+@pytest.mark.django_db
+def test_codes_are_unique_across_blocks_and_allocators(django_capture_on_commit_callbacks):
+  # Two allocators stand for two processes sharing the sequence rows
+  first, second = CodeAllocator(block_size=7), CodeAllocator(block_size=5)
+
+  with django_capture_on_commit_callbacks(execute=True):
+    allocated = first.allocate_many("student", 20)
+    allocated += [second.allocate("student") for _ in range(12)]
+    allocated += [first.allocate("student") for _ in range(9)]
+
+  assert len(allocated) == len(set(allocated)) == 41
+  # Every index reserved is either handed out or still pooled
+  issued = CodeSequence.objects.get(name="student", length=5).next_index
+  pooled = sum(len(pool) for allocator in (first, second) for pool in allocator._pools.values())
+  assert issued == len(allocated) + pooled
+
+
+@pytest.mark.django_db
+def test_spare_codes_are_pooled(django_capture_on_commit_callbacks, django_assert_num_queries):
+  allocator = CodeAllocator(block_size=10)
+  with django_capture_on_commit_callbacks(execute=True):
+    allocator.allocate("student")
+
+  # The rest of the block needs no query
+  with django_assert_num_queries(0):
+    pooled = [allocator.allocate("student") for _ in range(9)]
+
+  assert len(set(pooled)) == 9
+
+
+@pytest.mark.django_db
+def test_rolled_back_block_is_not_pooled(django_capture_on_commit_callbacks):
+  allocator = CodeAllocator(block_size=10)
+
+  # Spare codes wait for the outer transaction, which never commits here
+  with django_capture_on_commit_callbacks(execute=False):
+    allocator.allocate("student")
+
+  assert not allocator._pools
+
+
+@pytest.mark.django_db
+def test_exhausted_block_widens_the_space(tiny):
+  allocator = CodeAllocator(block_size=3)
+
+  allocated = allocator.allocate_many("tiny", 12)
+
+  assert len(set(allocated)) == 12
+  assert sorted(len(code) for code in allocated) == [3] * 4 + [4] * 8
+  assert [(row["length"], row["issued"], row["active"]) for row in allocator.usage("tiny")] == [
+    (2, 4, False), (3, 8, True),
+  ]
+  with pytest.raises(CodeSpaceExhaustedError):
+    allocator.allocate("tiny")
+
+
+@pytest.mark.django_db
+def test_stored_codes_are_skipped(tiny):
+  key = permutation_key()
+  taken = [TINY.encode(index, 2, key) for index in (0, 2)]
+  for code in taken:
+    student = Student.objects.create(student_link=UserFactory())
+    Student.objects.filter(pk=student.pk).update(student_code=code)
+
+  allocated = CodeAllocator(block_size=4).allocate_many("tiny", 2)
+
+  assert allocated == [TINY.encode(index, 2, key) for index in (1, 3)]
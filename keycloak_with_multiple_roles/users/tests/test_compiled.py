@@ -0,0 +1,112 @@
+"""
+The compiled list path must render exactly what DRF renders.
+"""
+import pytest
+from rest_framework.test import APIClient
+from rest_framework.test import APIRequestFactory
+
+from keycloak_with_multiple_roles.users.api import views
+from keycloak_with_multiple_roles.users.api import compiled
+from keycloak_with_multiple_roles.users.api.compiled import compile_serializer
+from keycloak_with_multiple_roles.users.api.serializers import UserSerializer
+from keycloak_with_multiple_roles.users.models import User
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+USERS_URL = "/api/users/"
+
+
+@pytest.fixture
+def client(user):
+  client = APIClient()
+  client.force_authenticate(user)
+  return client
+
+
+@pytest.fixture
+def users(user):
+  return [user, *UserFactory.create_batch(14)]
+
+
+def get_both(client, monkeypatch, url):
+  """ Response of ``url`` rendered compiled, then through DRF """
+  compiled = client.get(url)
+  with monkeypatch.context() as patch:
+    patch.setattr(views, "compile_serializer", lambda serializer_class: None)
+    plain = client.get(url)
+  return compiled, plain
+
+
+def test_user_serializer_compiles():
+  assert compile_serializer(UserSerializer) is not None
+
+
+def test_render_matches_serializer_data(users):
+  request = APIRequestFactory().get(USERS_URL)
+  context = {"request": request}
+  compiled = compile_serializer(UserSerializer)
+  queryset = User.objects.order_by("id")
+
+  data = compiled.render(compiled.values(queryset), context)
+
+  assert data == UserSerializer(queryset, many=True, context=context).data
+
+
+@pytest.mark.parametrize(
+  "query",
+  [
+    "",
+    "?page=2",
+    "?page-size=4&page=3",
+    "?format=json",
+    "?pagination=cursor",
+    "?pagination=cursor&page-size=4&count=estimated",
+  ],
+)
+def test_list_matches_drf(client, monkeypatch, users, query):
+  compiled, plain = get_both(client, monkeypatch, USERS_URL + query)
+
+  assert compiled.status_code == plain.status_code == 200
+  assert compiled.content == plain.content
+
+
+def test_following_cursor_matches_drf(client, monkeypatch, users):
+  first = client.get(USERS_URL + "?pagination=cursor&page-size=4").json()
+
+  compiled, plain = get_both(client, monkeypatch, first["next"])
+
+  assert compiled.status_code == plain.status_code == 200
+  assert compiled.content == plain.content
+
+
+@pytest.mark.parametrize(
+  "username",
+  [
+    "zoë", "josé_núñez", "ana+tag", "bob@home", "x+y@example", "john.doe", "a.b@example.com",
+    "it's;(odd)=~!", "per%cent", "que?ry", "hash#tag", "space d",
+  ],
+)
+def test_usernames_match_drf(client, monkeypatch, users, username):
+  UserFactory(username=username)
+
+  compiled, plain = get_both(client, monkeypatch, USERS_URL + "?page-size=100")
+
+  assert compiled.status_code == plain.status_code == 200
+  assert compiled.content == plain.content
+  assert username in compiled.content.decode()
+
+
+
+def test_dotted_usernames_use_url_template(client, monkeypatch, users):
+  UserFactory(username="john.doe")
+  UserFactory(username="a.b@example.com")
+  calls = []
+  reverse = compiled.UrlTemplate.reverse
+  monkeypatch.setattr(compiled.UrlTemplate, "reverse", lambda self, value: calls.append(value) or reverse(self, value))
+
+  response = client.get(USERS_URL + "?page-size=100")
+
+  assert response.status_code == 200
+  # Only the sentinel is reversed, once per render
+  assert calls == [compiled.LOOKUP_SENTINEL]
@@ -0,0 +1,122 @@
+"""
+Tests of conditional GETs (ETag/304) on MeView and UserViewSet.retrieve.
+"""
+import pytest
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+ME_URL = "/users/auth/me"
+USERS_URL = "/api/users/"
+
+
+def token_client(user):
+  client = APIClient()
+  client.credentials(HTTP_AUTHORIZATION=f"Token {AuthToken.objects.issue(user).key}")
+  return client
+
+
+@pytest.fixture
+def family():
+  """ A parent with one linked student """
+  parent = Parent.objects.create(user=UserFactory(user_type="parent"))
+  student = Student.objects.create(student_link=UserFactory(user_type="student"), parent=parent)
+  return parent, student
+
+
+def revalidate(client, url, etag):
+  return client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+
+@pytest.mark.parametrize("url", [ME_URL, f"{USERS_URL}{{username}}/"])
+def test_current_copy_is_not_modified(url):
+  user = UserFactory()
+  client = token_client(user)
+  url = url.format(username=user.username)
+
+  response = client.get(url)
+  assert response.status_code == 200
+  assert set(response["Cache-Control"].split(", ")) == {"private", "no-cache"}
+  etag = response["ETag"]
+
+  revalidated = revalidate(client, url, etag)
+
+  assert revalidated.status_code == 304
+  assert revalidated.content == b""
+  assert revalidated["ETag"] == etag
+  assert revalidated["Last-Modified"] == response["Last-Modified"]
+  assert client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code == 304
+
+
+@pytest.mark.parametrize("url", [ME_URL, f"{USERS_URL}{{username}}/"])
+def test_changed_user_is_sent_again(url, django_capture_on_commit_callbacks):
+  user = UserFactory()
+  client = token_client(user)
+  url = url.format(username=user.username)
+  etag = client.get(url)["ETag"]
+
+  # Cached token lookups and profiles are dropped on commit
+  with django_capture_on_commit_callbacks(execute=True):
+    user.name = "Renamed"
+    user.save()
+  response = revalidate(client, url, etag)
+
+  assert response.status_code == 200
+  assert response.json()["name"] == "Renamed"
+  assert response["ETag"] != etag
+
+
+def test_retrieve_of_another_user():
+  user, other = UserFactory(), UserFactory()
+  client = token_client(user)
+  url = f"{USERS_URL}{other.username}/"
+  etag = client.get(url)["ETag"]
+
+  assert revalidate(client, url, etag).status_code == 304
+  # Each user has their own validators
+  assert etag != client.get(f"{USERS_URL}{user.username}/")["ETag"]
+
+
+def test_me_follows_family_changes(family, django_capture_on_commit_callbacks):
+  parent, student = family
+  client = token_client(parent.user)
+  etag = client.get(ME_URL)["ETag"]
+
+  with django_capture_on_commit_callbacks(execute=True):
+    student.grade = "7"
+    student.save()
+  response = revalidate(client, ME_URL, etag)
+  assert response.status_code == 200
+  etag = response["ETag"]
+
+  with django_capture_on_commit_callbacks(execute=True):
+    student.student_link.name = "Renamed"
+    student.student_link.save()
+  response = revalidate(client, ME_URL, etag)
+  assert response.status_code == 200
+  etag = response["ETag"]
+
+  # Unlinking leaves no linked row behind, the student count still changes
+  with django_capture_on_commit_callbacks(execute=True):
+    student.parent = None
+    student.save()
+  response = revalidate(client, ME_URL, etag)
+  assert response.status_code == 200
+  assert response.json()["profile"]["student_count"] == 0
+
+
+def test_student_me_follows_their_family(family, django_capture_on_commit_callbacks):
+  parent, student = family
+  client = token_client(student.student_link)
+  etag = client.get(ME_URL)["ETag"]
+
+  with django_capture_on_commit_callbacks(execute=True):
+    parent.user.name = "Renamed"
+    parent.user.save()
+
+  assert revalidate(client, ME_URL, etag).status_code == 200
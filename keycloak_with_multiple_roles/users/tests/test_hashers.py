@@ -0,0 +1,30 @@
+"""
+Tests of the settings-tuned password hashers.
+"""
+from django.contrib.auth import hashers
+
+from keycloak_with_multiple_roles.users.hashers import Argon2PasswordHasher
+
+
+def encode_with_django(password="secret"):
+  return hashers.Argon2PasswordHasher().encode(password, hashers.Argon2PasswordHasher().salt())
+
+
+def test_defaults_keep_djangos_hashes(settings):
+  settings.PASSWORD_ARGON2_TIME_COST = None
+  settings.PASSWORD_ARGON2_MEMORY_COST = None
+  settings.PASSWORD_ARGON2_PARALLELISM = None
+  hasher = Argon2PasswordHasher()
+
+  assert (hasher.time_cost, hasher.memory_cost, hasher.parallelism) == (2, 102400, 8)
+  assert not hasher.must_update(encode_with_django())
+
+
+def test_tuned_costs_upgrade_djangos_hashes(settings):
+  settings.PASSWORD_ARGON2_PARALLELISM = 1
+  hasher = Argon2PasswordHasher()
+  encoded = encode_with_django()
+
+  assert hasher.must_update(encoded)
+  assert hasher.verify("secret", encoded)
+  assert not hasher.must_update(hasher.encode("secret", hasher.salt()))
@@ -0,0 +1,226 @@
+"""
+Tests of Keycloak access token verification, against local keys and a stub
+JWKS file.
+"""
+import json
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users import keycloak
+from keycloak_with_multiple_roles.users.keycloak import KeycloakTokenError
+from keycloak_with_multiple_roles.users.keycloak import decode_access_token
+from keycloak_with_multiple_roles.users.keycloak import get_or_create_user
+from keycloak_with_multiple_roles.users.keycloak import map_user_roles
+from keycloak_with_multiple_roles.users.models import User
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+ISSUER = "https://keycloak.test/realms/school"
+CLIENT_ID = "school-api"
+USERS_URL = "/api/users/"
+ME_URL = "/users/auth/me"
+
+
+class Realm:
+  """ Signing keys of a stub realm, published as a JWKS file """
+
+  def __init__(self, path):
+    self.path = path
+    self.keys = {}
+
+  def add_key(self, kid, *, publish=True):
+    self.keys[kid] = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if publish:
+      self.publish()
+
+  def publish(self):
+    jwks = {"keys": []}
+    for kid, private_key in self.keys.items():
+      jwk = jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+      jwks["keys"].append({**jwk, "kid": kid, "use": "sig", "alg": "RS256"})
+    self.path.write_text(json.dumps(jwks))
+
+  def token(self, kid="key-1", **claims):
+    now = int(time.time())
+    claims = {
+      "iss": ISSUER,
+      "aud": CLIENT_ID,
+      "sub": "subject-1",
+      "iat": now,
+      "exp": now + 300,
+      "preferred_username": "jane.doe",
+      "email": "jane@example.com",
+      "name": "Jane Doe",
+      "realm_access": {"roles": ["parent"]},
+      **claims,
+    }
+    return jwt.encode(claims, self.keys[kid], algorithm="RS256", headers={"kid": kid})
+
+
+class Clock:
+  """ Stand-in for time.monotonic """
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+@pytest.fixture
+def realm(settings, tmp_path):
+  realm = Realm(tmp_path / "jwks.json")
+  realm.add_key("key-1")
+  # A new path, so get_jwks_cache() starts from an empty cache
+  settings.KEYCLOAK_JWKS_URL = str(realm.path)
+  settings.KEYCLOAK_ISSUER = ISSUER
+  settings.KEYCLOAK_AUDIENCE = CLIENT_ID
+  settings.KEYCLOAK_CLIENT_ID = CLIENT_ID
+  return realm
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = Clock()
+  monkeypatch.setattr(keycloak.time, "monotonic", clock)
+  return clock
+
+
+def bearer(token):
+  client = APIClient()
+  client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+  return client
+
+
+def test_valid_token(realm):
+  claims = decode_access_token(realm.token())
+
+  assert claims["sub"] == "subject-1"
+  assert claims["preferred_username"] == "jane.doe"
+
+
+def test_expired_token(realm):
+  token = realm.token(iat=int(time.time()) - 600, exp=int(time.time()) - 60)
+
+  with pytest.raises(KeycloakTokenError, match="expired"):
+    decode_access_token(token)
+
+
+@pytest.mark.parametrize(
+  "claims",
+  [{"aud": "other-client"}, {"iss": "https://keycloak.test/realms/other"}],
+)
+def test_wrong_audience_or_issuer(realm, claims):
+  with pytest.raises(KeycloakTokenError):
+    decode_access_token(realm.token(**claims))
+
+
+def test_token_signed_by_another_key(realm, tmp_path):
+  stranger = Realm(tmp_path / "other.json")
+  stranger.add_key("key-1")
+
+  with pytest.raises(KeycloakTokenError, match="Signature"):
+    decode_access_token(stranger.token())
+
+
+def test_unknown_kid_refetches_jwks(realm, clock):
+  decode_access_token(realm.token())
+  # Keycloak rotates its keys
+  realm.add_key("key-2")
+  clock.now += 31
+
+  assert decode_access_token(realm.token(kid="key-2"))["sub"] == "subject-1"
+  # The old key keeps working until Keycloak drops it
+  assert decode_access_token(realm.token())["sub"] == "subject-1"
+
+
+def test_unknown_kid_refetches_at_most_once_per_interval(realm, clock):
+  decode_access_token(realm.token())
+  realm.add_key("key-2", publish=False)
+  clock.now += 31
+  # Refetched, but not published yet
+  with pytest.raises(KeycloakTokenError, match="No signing key"):
+    decode_access_token(realm.token(kid="key-2"))
+
+  realm.publish()
+  clock.now += 10
+  with pytest.raises(KeycloakTokenError, match="No signing key"):
+    decode_access_token(realm.token(kid="key-2"))
+
+  clock.now += 21
+  assert decode_access_token(realm.token(kid="key-2"))["sub"] == "subject-1"
+
+
+def test_unreachable_jwks_keeps_last_keys(realm, clock):
+  decode_access_token(realm.token())
+  realm.path.write_text("not json")
+  clock.now += 3601
+
+  assert decode_access_token(realm.token())["sub"] == "subject-1"
+
+
+def test_map_user_roles(settings):
+  settings.KEYCLOAK_ROLE_MAP = {"school-admin": "admin", "guardian": "parent", "pupil": "student"}
+
+  assert map_user_roles({"pupil", "guardian", "offline_access"}) == ["parent", "student"]
+  assert map_user_roles({"offline_access"}) == []
+
+
+@pytest.mark.django_db
+def test_realm_and_client_roles_are_synced(realm):
+  claims = decode_access_token(realm.token(
+    realm_access={"roles": ["parent", "offline_access"]},
+    resource_access={CLIENT_ID: {"roles": ["admin"]}, "other": {"roles": ["student"]}},
+  ))
+
+  user = get_or_create_user(claims)
+
+  assert (user.username, user.email, user.keycloak_id) == ("jane.doe", "jane@example.com", "subject-1")
+  assert user.role_names == ["parent", "admin"]
+  assert user.user_type == "admin"
+  assert not user.has_usable_password()
+
+  claims["realm_access"] = {"roles": ["student"]}
+  claims["resource_access"] = {}
+  user = get_or_create_user(claims)
+
+  user.refresh_from_db()
+  assert user.role_names == ["student"]
+  assert set(user.role_memberships.values_list("role", flat=True)) == {"student"}
+  assert user.user_type == "student"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("url", [USERS_URL, ME_URL])
+def test_bearer_authentication(realm, url):
+  response = bearer(realm.token()).get(url)
+
+  assert response.status_code == 200
+  assert User.objects.get(keycloak_id="subject-1").has_role("parent")
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("url", [USERS_URL, ME_URL])
+def test_bearer_authentication_rejects_expired_token(realm, url):
+  response = bearer(realm.token(exp=int(time.time()) - 60)).get(url)
+
+  # 403 rather than 401: SessionAuthentication, listed first, sends no WWW-Authenticate
+  assert response.status_code == 403
+  assert response.json()["detail"] == "Invalid access token."
+  assert not User.objects.filter(keycloak_id="subject-1").exists()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("url", [USERS_URL, ME_URL])
+def test_email_taken_by_another_user_is_rejected(realm, url):
+  bearer(realm.token()).get(url)
+  UserFactory(email="taken@example.com")
+
+  response = bearer(realm.token(email="taken@example.com")).get(url)
+
+  assert response.status_code == 403
+  assert response.json()["detail"] == "Invalid access token."
+  assert User.objects.get(keycloak_id="subject-1").email == "jane@example.com"
@@ -0,0 +1,96 @@
+"""
+Tests of bulk student linking, through users.links and StudentLinksView.
+"""
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users.api.serializers import MAX_BULK_LINKS
+from keycloak_with_multiple_roles.users.links import link_students
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.roles import set_roles
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+LINKS_URL = "/users/students/links"
+
+
+@pytest.fixture
+def admin_client():
+  admin = UserFactory()
+  set_roles(admin, {"admin"})
+  client = APIClient()
+  client.credentials(HTTP_AUTHORIZATION=f"Token {AuthToken.objects.issue(admin).key}")
+  return client
+
+
+def make_parent():
+  return Parent.objects.create(user=UserFactory())
+
+
+def make_student(parent=None):
+  return Student.objects.create(student_link=UserFactory(), parent=parent)
+
+
+def test_per_pair_statuses_and_summary(admin_client):
+  first, second = make_parent(), make_parent()
+  new, moving, staying = make_student(), make_student(first), make_student(first)
+  leaving, stranded = make_student(second), make_student()
+  links = [
+    {"student_code": new.student_code, "family_code": first.family_code},
+    {"student_code": moving.student_code, "family_code": second.family_code},
+    {"student_code": staying.student_code, "family_code": first.family_code},
+    {"student_code": leaving.student_code},
+    {"student_code": moving.student_code, "family_code": first.family_code},
+    {"student_code": "NOPE1", "family_code": first.family_code},
+    {"student_code": stranded.student_code, "family_code": "NOPE1"},
+  ]
+
+  response = admin_client.post(LINKS_URL, {"links": links}, format="json")
+
+  assert response.status_code == 200
+  results = response.json()["results"]
+  assert [result["status"] for result in results] == [
+    "linked", "linked", "unchanged", "unlinked", "error", "error", "error",
+  ]
+  assert [result["student_code"] for result in results] == [link["student_code"] for link in links]
+  assert [result["family_code"] for result in results] == [link.get("family_code") for link in links]
+  assert [result.get("error") for result in results[4:]] == [
+    "Student listed more than once.",
+    "Invalid student code. Student not found.",
+    "Invalid family code. Parent not found.",
+  ]
+  assert response.json()["summary"] == {"linked": 2, "unlinked": 1, "unchanged": 1, "error": 3}
+
+  # Failed pairs do not hold back the others
+  linked = dict(Student.objects.values_list("pk", "parent_id"))
+  assert [linked[student.pk] for student in (new, moving, staying, leaving, stranded)] == [
+    first.family_code, second.family_code, first.family_code, None, None,
+  ]
+  assert [Parent.objects.get(pk=parent.pk).student_count for parent in (first, second)] == [2, 1]
+
+
+@pytest.mark.parametrize(
+  "body",
+  [{}, {"links": []}, {"links": [{"family_code": "A8K9Z"}]}, {"links": [{}] * (MAX_BULK_LINKS + 1)}],
+)
+def test_invalid_body(admin_client, body):
+  response = admin_client.post(LINKS_URL, body, format="json")
+
+  assert response.status_code == 400
+
+
+def test_queries_do_not_grow_with_pairs():
+  parent = make_parent()
+
+  def queries(size):
+    students = [make_student() for _ in range(size)]
+    with CaptureQueriesContext(connection) as captured:
+      link_students([(student.student_code, parent.family_code) for student in students])
+    return len(captured)
+
+  assert queries(2) == queries(6)
@@ -0,0 +1,32 @@
+"""
+Tests of data migrations of the users app.
+"""
+import pytest
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+
+
+def migrate(target):
+  executor = MigrationExecutor(connection)
+  executor.loader.build_graph()
+  executor.migrate([target])
+  return executor.loader.project_state([target]).apps
+
+
+@pytest.mark.django_db(transaction=True)
+def test_uuid_added_to_populated_users_table():
+  before = ("users", "0001_initial")
+  after = ("users", "0002_user_uuid_user_type")
+  latest = MigrationExecutor(connection).loader.graph.leaf_nodes("users")[0]
+  try:
+    User = migrate(before).get_model("users", "User")
+    for number in range(3):
+      User.objects.create(username=f"user{number}", email=f"user{number}@example.com")
+
+    User = migrate(after).get_model("users", "User")
+
+    uuids = list(User.objects.values_list("uuid", flat=True))
+    assert len(uuids) == len(set(uuids)) == 3
+    assert None not in uuids
+  finally:
+    migrate(latest)
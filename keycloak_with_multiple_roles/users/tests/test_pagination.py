@@ -0,0 +1,58 @@
+"""
+Tests of the users API pagination.
+"""
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users.api.pagination import KeysetPagination
+from keycloak_with_multiple_roles.users.models import User
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+USERS_URL = "/api/users/"
+
+
+def test_keyset_filter_bounds_leading_column():
+  position = [timezone.now(), 42]
+
+  sql = str(User.objects.filter(KeysetPagination().get_keyset_filter(position)).query)
+
+  # A plain range on date_joined the index can seek to, ANDed with the keyset OR
+  where = sql.split(" WHERE ", 1)[1]
+  assert where.startswith('("users_user"."date_joined" <= ')
+  assert ' AND ("users_user"."date_joined" < ' in where
+  assert '"users_user"."id" < 42' in where
+
+
+def test_keyset_filter_bound_follows_ordering():
+  pagination = KeysetPagination()
+  pagination.ordering = ("date_joined", "id")
+
+  where = str(User.objects.filter(pagination.get_keyset_filter([timezone.now(), 42])).query).split(" WHERE ", 1)[1]
+
+  assert where.startswith('("users_user"."date_joined" >= ')
+  assert '"users_user"."id" > 42' in where
+
+
+def test_cursor_pages_walk_equal_timestamps_once(user):
+  joined = timezone.now() - timedelta(days=1)
+  users = [user, *UserFactory.create_batch(7)]
+  # Ties on date_joined are broken by id
+  User.objects.filter(pk__in=[other.pk for other in users[1:]]).update(date_joined=joined)
+  client = APIClient()
+  client.force_authenticate(user)
+
+  seen = []
+  url = USERS_URL + "?pagination=cursor&page-size=3"
+  while url:
+    page = client.get(url).json()
+    seen += [item["id"] for item in page["results"]]
+    url = page["next"]
+
+  expected = list(User.objects.order_by("-date_joined", "-id").values_list("id", flat=True))
+  assert seen == expected
+  assert len(seen) == len(set(seen)) == len(users)
@@ -0,0 +1,162 @@
+"""
+Tests of the token-bucket rate limiter and the views it guards.
+"""
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.exceptions import ImproperlyConfigured
+from django.test import AsyncClient
+from rest_framework import exceptions
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users import ratelimit
+
+LOGIN_URL = "/users/auth/login"
+
+
+class Clock:
+  """ Stand-in for time.monotonic """
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = Clock()
+  monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+  return clock
+
+
+@pytest.fixture
+def rates(settings):
+  # Local buckets only; changing the settings resets the process-wide limiter
+  settings.RATE_LIMIT_REDIS_URL = ""
+  settings.RATE_LIMIT_ENABLED = True
+  settings.RATE_LIMITS = {"auth:ip": "3/m", "login:username": "2/m"}
+  return settings.RATE_LIMITS
+
+
+def test_parse_rate():
+  assert ratelimit.parse_rate("10/m") == (10, 10 / 60)
+  assert ratelimit.parse_rate("100/15m") == (100, 100 / 900)
+  with pytest.raises(ImproperlyConfigured):
+    ratelimit.parse_rate("10 per minute")
+
+
+def test_bucket_refills_at_rate(clock):
+  limiter = ratelimit.RateLimiter({"login:username": "2/m"}, "")
+
+  assert limiter.hit(("login:username", "alice")) == 0
+  assert limiter.hit(("login:username", "alice")) == 0
+  # Empty: one token comes back every 30s
+  assert limiter.hit(("login:username", "alice")) == pytest.approx(30)
+
+  clock.now += 15
+  assert limiter.hit(("login:username", "alice")) == pytest.approx(15)
+  clock.now += 15
+  assert limiter.hit(("login:username", "alice")) == 0
+  assert limiter.hit(("login:username", "alice")) == pytest.approx(30)
+
+  # Never refills past its capacity
+  clock.now += 3600
+  assert limiter.hit(("login:username", "alice")) == 0
+  assert limiter.hit(("login:username", "alice")) == 0
+  assert limiter.hit(("login:username", "alice")) > 0
+
+
+def test_identities_and_rules_have_separate_buckets(clock):
+  limiter = ratelimit.RateLimiter({"auth:ip": "1/m", "login:username": "1/m"}, "")
+
+  assert limiter.hit(("login:username", "alice")) == 0
+  assert limiter.hit(("login:username", "alice")) > 0
+  # Usernames are case-insensitive identities
+  assert limiter.hit(("login:username", "ALICE")) > 0
+  assert limiter.hit(("login:username", "bob")) == 0
+  # The same identity under another rule
+  assert limiter.hit(("auth:ip", "alice")) == 0
+
+
+def test_limited_bucket_takes_no_token_from_the_others(clock):
+  limiter = ratelimit.RateLimiter({"auth:ip": "2/m", "login:username": "1/m"}, "")
+  limiter.hit(("login:username", "alice"))
+
+  assert limiter.hit(("auth:ip", "10.0.0.1"), ("login:username", "alice")) > 0
+  # The IP bucket kept both of its tokens
+  assert limiter.hit(("auth:ip", "10.0.0.1")) == 0
+  assert limiter.hit(("auth:ip", "10.0.0.1")) == 0
+  assert limiter.hit(("auth:ip", "10.0.0.1")) > 0
+
+
+def test_unknown_rules_and_empty_identities_are_ignored(clock):
+  limiter = ratelimit.RateLimiter({"login:username": "1/m"}, "")
+
+  for _ in range(3):
+    assert limiter.hit(("login:username", ""), ("login:username", None), ("other", "alice")) == 0
+
+
+def test_check_raises_throttled_with_wait(clock):
+  limiter = ratelimit.RateLimiter({"login:username": "1/m"}, "")
+  limiter.check(("login:username", "alice"))
+
+  with pytest.raises(exceptions.Throttled) as throttled:
+    limiter.check(("login:username", "alice"))
+
+  assert throttled.value.wait == 60
+
+
+@pytest.mark.django_db
+def test_login_limited_per_ip(rates, clock):
+  client = APIClient(REMOTE_ADDR="10.0.0.1")
+
+  statuses = [
+    client.post(LOGIN_URL, {"username": f"user{i}", "password": "wrong"}, format="json").status_code
+    for i in range(4)
+  ]
+
+  assert statuses == [401, 401, 401, 429]
+  response = client.post(LOGIN_URL, {"username": "user9", "password": "wrong"}, format="json")
+  assert response.status_code == 429
+  assert response["Retry-After"] == "20"
+  # Other addresses keep their own bucket
+  other = APIClient(REMOTE_ADDR="10.0.0.2")
+  assert other.post(LOGIN_URL, {"username": "user0", "password": "wrong"}, format="json").status_code == 401
+
+
+@pytest.mark.django_db
+def test_login_limited_per_username(rates, clock):
+  def login(address, username):
+    return APIClient(REMOTE_ADDR=address).post(
+      LOGIN_URL, {"username": username, "password": "wrong"}, format="json",
+    )
+
+  assert login("10.0.0.1", "alice").status_code == 401
+  assert login("10.0.0.2", "alice").status_code == 401
+  # Limited from any address
+  response = login("10.0.0.3", "alice")
+  assert response.status_code == 429
+  assert response["Retry-After"] == "30"
+  assert login("10.0.0.3", "bob").status_code == 401
+
+
+@pytest.mark.django_db
+def test_disabled_limits_nothing(rates, settings, clock):
+  settings.RATE_LIMIT_ENABLED = False
+  client = APIClient(REMOTE_ADDR="10.0.0.1")
+
+  for _ in range(5):
+    assert client.post(LOGIN_URL, {"username": "alice", "password": "wrong"}, format="json").status_code == 401
+
+
+@pytest.mark.django_db
+def test_login_limited_per_ip_under_asgi(rates, clock):
+  client = AsyncClient()
+
+  async def login(username):
+    return await client.post(LOGIN_URL, {"username": username, "password": "wrong"}, content_type="application/json")
+
+  statuses = [async_to_sync(login)(f"user{i}").status_code for i in range(4)]
+
+  assert statuses == [401, 401, 401, 429]
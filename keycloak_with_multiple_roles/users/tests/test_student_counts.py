@@ -0,0 +1,118 @@
+"""
+Tests of the stored Parent.student_count, kept in step by the Student signals.
+"""
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+
+def make_parent():
+  return Parent.objects.create(user=UserFactory())
+
+
+def make_student(parent=None):
+  return Student.objects.create(student_link=UserFactory(), parent=parent)
+
+
+def counts(*parents):
+  """ Stored counts, checked against the student table """
+  stored = [Parent.objects.get(pk=parent.pk).student_count for parent in parents]
+  assert stored == [Student.objects.filter(parent=parent).count() for parent in parents]
+  return stored
+
+
+def test_created_linked():
+  parent = make_parent()
+
+  make_student(parent)
+  make_student(parent)
+  make_student()
+
+  assert counts(parent) == [2]
+
+
+def test_link_unlink_relink():
+  first, second = make_parent(), make_parent()
+  student = make_student()
+
+  student.parent = first
+  student.save()
+  assert counts(first, second) == [1, 0]
+
+  student.parent = second
+  student.save()
+  assert counts(first, second) == [0, 1]
+
+  student.parent = None
+  student.save()
+  assert counts(first, second) == [0, 0]
+
+  student.parent = first
+  student.save()
+  assert counts(first, second) == [1, 0]
+
+
+def test_saves_without_link_change_keep_count():
+  parent = make_parent()
+  student = make_student(parent)
+
+  student.grade = "5"
+  student.save()
+  Student.objects.get(pk=student.pk).save()
+
+  assert counts(parent) == [1]
+
+
+def test_student_deleted():
+  parent = make_parent()
+  linked, unlinked = make_student(parent), make_student()
+  make_student(parent)
+
+  linked.delete()
+  unlinked.delete()
+
+  assert counts(parent) == [1]
+
+
+def test_students_of_deleted_parent_relink():
+  gone, parent = make_parent(), make_parent()
+  student = make_student(gone)
+
+  gone.delete()
+  student = Student.objects.get(pk=student.pk)
+  assert student.parent_id is None
+  student.parent = parent
+  student.save()
+
+  assert counts(parent) == [1]
+
+
+def test_count_never_goes_negative():
+  parent = make_parent()
+  student = make_student(parent)
+  Parent.objects.filter(pk=parent.pk).update(student_count=0)
+
+  student.delete()
+
+  assert Parent.objects.get(pk=parent.pk).student_count == 0
+
+
+def test_repair_student_counts():
+  parent, other = make_parent(), make_parent()
+  make_student(parent)
+  make_student(parent)
+  Parent.objects.filter(pk=parent.pk).update(student_count=7)
+  Parent.objects.filter(pk=other.pk).update(student_count=3)
+
+  out = StringIO()
+  call_command("repair_student_counts", batch_size=1, stdout=out)
+
+  assert counts(parent, other) == [2, 0]
+  assert "Recounted 2 parents, 2 had a wrong count." in out.getvalue()
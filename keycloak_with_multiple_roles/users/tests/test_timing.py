@@ -0,0 +1,82 @@
+"""
+Tests of the per-request timings reported by ServerTimingMiddleware.
+"""
+import pytest
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users.api.authentication import local_tokens
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.timing import RequestTimings
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+USERS_URL = "/api/users/"
+
+
+@pytest.fixture(autouse=True)
+def _server_timing(settings):
+  settings.SERVER_TIMING_SAMPLE_RATE = 1.0
+  settings.SERVER_TIMING_HEADER = True
+
+
+def metrics(response):
+  """ Server-Timing metrics by name, each a dict of its parameters """
+  parsed = {}
+  for metric in response["Server-Timing"].split(", "):
+    name, *params = metric.split(";")
+    parsed[name] = dict(param.split("=", 1) for param in params)
+  return parsed
+
+
+def test_marks_add_up_and_keep_last_description():
+  timings = RequestTimings()
+
+  timings.mark("token", 0.002, "cache")
+  timings.mark("token", 0.001, "local")
+  timings.mark("profile", desc="hit")
+
+  entry = timings.as_dict(5.0)
+  assert (entry["token"], entry["token_ms"], entry["profile"]) == ("local", 3.0, "hit")
+  assert "profile_ms" not in entry
+  assert 'token;dur=3.00;desc="local"' in timings.header(5.0)
+  assert 'profile;desc="hit"' in timings.header(5.0)
+
+
+@pytest.mark.django_db
+def test_token_tier_reported():
+  user = UserFactory()
+  key = AuthToken.objects.issue(user).key
+  client = APIClient()
+  client.credentials(HTTP_AUTHORIZATION=f"Token {key}")
+
+  tiers = []
+  for _ in range(2):
+    tiers.append(metrics(client.get(USERS_URL))["token"]["desc"])
+  local_tokens.clear()
+  tiers.append(metrics(client.get(USERS_URL))["token"]["desc"])
+
+  assert tiers == ['"db"', '"local"', '"cache"']
+
+
+@pytest.mark.django_db
+def test_profile_cache_hits_reported():
+  user = UserFactory()
+  client = APIClient()
+  client.credentials(HTTP_AUTHORIZATION=f"Token {AuthToken.objects.issue(user).key}")
+
+  first, second = (metrics(client.get("/users/auth/me"))["profile"] for _ in range(2))
+
+  assert first["desc"] == '"miss"'
+  assert "dur" in first
+  assert second == {"desc": '"hit"'}
+
+
+@pytest.mark.django_db
+def test_password_hashing_reported():
+  user = UserFactory(password="password")
+
+  response = APIClient().post("/users/auth/login", {"username": user.username, "password": "password"}, format="json")
+
+  assert response.status_code == 200
+  parsed = metrics(response)
+  assert float(parsed["hash"]["dur"]) > 0
+  assert float(parsed["hash_wait"]["dur"]) >= 0
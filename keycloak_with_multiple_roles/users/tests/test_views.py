@@ -0,0 +1,114 @@
+"""
+Tests of the users API views.
+"""
+import pytest
+from rest_framework.test import APIClient
+
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.roles import set_roles
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+USERS_URL = "/api/users/"
+ME_URL = "/users/auth/me"
+LOGIN_URL = "/users/auth/login"
+DOTTED_USERNAMES = ["john.doe", "a.b@example.com", "x+y.z"]
+
+
+def token_client(user):
+  """ Client authenticated with a real API token, which AsyncAPIView also honours """
+  client = APIClient()
+  client.credentials(HTTP_AUTHORIZATION=f"Token {AuthToken.objects.issue(user).key}")
+  return client
+
+
+@pytest.mark.parametrize("username", DOTTED_USERNAMES)
+def test_list_renders_dotted_username(username):
+  user = UserFactory(username=username)
+
+  response = token_client(user).get(USERS_URL)
+
+  assert response.status_code == 200
+  [item] = response.json()["results"]
+  assert item["url"] == f"http://testserver{USERS_URL}{username}/"
+
+
+@pytest.mark.parametrize("username", DOTTED_USERNAMES)
+def test_detail_renders_dotted_username(username):
+  user = UserFactory(username=username)
+
+  response = token_client(user).get(f"{USERS_URL}{username}/")
+
+  assert response.status_code == 200
+  assert response.json()["username"] == username
+  assert response.json()["url"] == f"http://testserver{USERS_URL}{username}/"
+
+
+@pytest.mark.parametrize("username", DOTTED_USERNAMES)
+def test_me_renders_dotted_username(username):
+  user = UserFactory(username=username)
+
+  response = token_client(user).get(ME_URL)
+
+  assert response.status_code == 200
+  assert response.json()["username"] == username
+  assert response.json()["url"] == f"http://testserver{USERS_URL}{username}/"
+
+
+def login(username, password="password"):
+  return APIClient().post(LOGIN_URL, {"username": username, "password": password}, format="json")
+
+
+@pytest.fixture
+def admin_parent():
+  """ A parent who is an admin too, with admin as primary role """
+  user = UserFactory(password="password", user_type="admin")
+  set_roles(user, {"admin", "parent"})
+  Parent.objects.create(user=user)
+  return user
+
+
+def test_profiles_follow_every_role(admin_parent):
+  parent = Parent.objects.get(user=admin_parent)
+  assert admin_parent.user_type == "admin"
+
+  response = login(admin_parent.username)
+
+  assert response.status_code == 200
+  assert response.json()["user"]["roles"] == ["parent", "admin"]
+  assert response.json()["profile"] == {"family_code": parent.family_code, "student_count": 0}
+  me = token_client(admin_parent).get(ME_URL).json()
+  assert me["profile"]["family_code"] == parent.family_code
+
+
+def test_student_profile_without_parent_row():
+  user = UserFactory(password="password")
+  set_roles(user, {"parent", "student"})
+  student = Student.objects.create(student_link=user)
+
+  assert login(user.username).json()["profile"] == {"student_code": student.student_code, "is_linked": False}
+  assert token_client(user).get(ME_URL).json()["profile"]["student_code"] == student.student_code
+
+
+def test_no_profile_without_family_roles():
+  user = UserFactory(password="password")
+  set_roles(user, {"admin"})
+
+  assert login(user.username).json()["profile"] is None
+  assert token_client(user).get(ME_URL).json()["profile"] is None
+
+
+@pytest.mark.parametrize(
+  ("method", "url"),
+  [("get", "/users/export/users.ndjson"), ("post", "/users/students/links")],
+)
+def test_admin_views_need_admin_role(method, url):
+  staff = UserFactory(is_staff=True)
+  admin = UserFactory()
+  set_roles(admin, {"admin"})
+
+  assert getattr(token_client(staff), method)(url, {"links": []}, format="json").status_code == 403
+  assert getattr(token_client(admin), method)(url, {"links": []}, format="json").status_code != 403
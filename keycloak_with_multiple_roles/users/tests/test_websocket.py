@@ -0,0 +1,85 @@
+"""
+Tests of the family events websocket and the events it is sent.
+"""
+import asyncio
+import json
+
+import pytest
+from asgiref.sync import async_to_sync
+
+from config.websocket import INTERNAL_ERROR_CLOSE_CODE
+from config.websocket import UNAUTHORIZED_CLOSE_CODE
+from config.websocket import websocket_application
+from keycloak_with_multiple_roles.users import events
+from keycloak_with_multiple_roles.users.models import AuthToken
+from keycloak_with_multiple_roles.users.models import Parent
+from keycloak_with_multiple_roles.users.models import Student
+from keycloak_with_multiple_roles.users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def published(settings, monkeypatch):
+  """ Events handed to Redis, as ``(event, channels)`` """
+  settings.FAMILY_EVENTS_REDIS_URL = "redis://127.0.0.1:1/0"
+  sent = []
+  monkeypatch.setattr(
+    events, "_send", lambda messages: sent.extend((json.loads(message), channels) for message, channels in messages),
+  )
+  return sent
+
+
+def connect(query_string):
+  """ Run a handshake against websocket_application; the messages it sends """
+  incoming = [{"type": "websocket.connect"}, {"type": "websocket.disconnect"}]
+  sent = []
+
+  async def receive():
+    await asyncio.sleep(0)
+    return incoming.pop(0)
+
+  async def send(message):
+    sent.append(message)
+
+  scope = {"type": "websocket", "headers": [], "query_string": query_string.encode()}
+  async_to_sync(websocket_application)(scope, receive, send)
+  return sent
+
+
+def test_unauthenticated_socket_is_rejected():
+  assert connect("token=unknown") == [{"type": "websocket.close", "code": UNAUTHORIZED_CLOSE_CODE}]
+
+
+def test_socket_without_events_is_accepted(settings):
+  settings.FAMILY_EVENTS_REDIS_URL = None
+  token = AuthToken.objects.issue(UserFactory())
+
+  assert connect(f"token={token.key}") == [{"type": "websocket.accept"}]
+
+
+def test_redis_outage_closes_socket(settings):
+  # Nothing listens on port 1
+  settings.FAMILY_EVENTS_REDIS_URL = "redis://127.0.0.1:1/0"
+  token = AuthToken.objects.issue(UserFactory())
+
+  assert connect(f"token={token.key}") == [
+    {"type": "websocket.accept"},
+    {"type": "websocket.close", "code": INTERNAL_ERROR_CLOSE_CODE},
+  ]
+
+
+def test_user_updated_sends_only_the_user_id(published, django_capture_on_commit_callbacks):
+  parent = Parent.objects.create(user=UserFactory(user_type="parent"))
+  student = Student.objects.create(student_link=UserFactory(user_type="student"), parent=parent)
+  user = student.student_link
+  published.clear()
+
+  with django_capture_on_commit_callbacks(execute=True):
+    user.name = "Renamed"
+    user.save()
+
+  [(event, channels)] = [item for item in published if item[0]["type"] == events.USER_UPDATED]
+  assert set(event) == {"id", "type", "user_id"}
+  assert event["user_id"] == user.pk
+  assert sorted(channels) == sorted([events.family_channel(parent.family_code), events.user_channel(user.pk)])
@@ -0,0 +1,215 @@
+"""
+Per-request breakdown of where time goes: SQL, cache and serializers.
+
+``ServerTimingMiddleware`` installs a ``RequestTimings`` collector for a
+sample of requests. Queries are timed by an execute wrapper added to every
+database connection as it opens, which also covers the threads running the
+async ORM. Cache calls are timed by the backends in ``users.cache_backends``
+and serializer rendering by ``TimedDataMixin``. Single steps, such as the
+token cache tier that answered or the wait for a password hashing worker,
+are reported with ``mark``. The totals are returned in a ``Server-Timing``
+header and logged as one JSON line per request.
+
+Unsampled requests never see a collector, so instrumented code only pays
+for a context variable lookup.
+"""
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+DB = "db"
+CACHE = "cache"
+SERIALIZER = "serializer"
+KINDS = (DB, CACHE, SERIALIZER)
+
+DEFAULT_SAMPLE_RATE = 1.0
+
+_current = ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+  """ Call counts and accumulated seconds per kind for one request """
+
+  def __init__(self):
+    self.started = time.perf_counter()
+    self.counts = dict.fromkeys(KINDS, 0)
+    self.seconds = dict.fromkeys(KINDS, 0.0)
+    # Kinds currently being timed, so nested calls are not counted twice
+    self.active = set()
+    # name -> (seconds or None, description), see mark()
+    self.marks = {}
+
+  def record(self, kind, seconds):
+    self.counts[kind] += 1
+    self.seconds[kind] += seconds
+
+  def mark(self, name, seconds=None, desc=None):
+    total, _ = self.marks.get(name, (None, None))
+    if seconds is not None:
+      total = (total or 0.0) + seconds
+    self.marks[name] = (total, desc)
+
+  def total_ms(self):
+    return (time.perf_counter() - self.started) * 1000
+
+  def header(self, total_ms):
+    """ Value of the Server-Timing header """
+    metrics = [
+      f'{kind};dur={self.seconds[kind] * 1000:.2f};desc="{self.counts[kind]} calls"'
+      for kind in KINDS
+    ]
+    for name, (seconds, desc) in self.marks.items():
+      metric = name if seconds is None else f"{name};dur={seconds * 1000:.2f}"
+      metrics.append(metric if desc is None else f'{metric};desc="{desc}"')
+    metrics.append(f"total;dur={total_ms:.2f}")
+    return ", ".join(metrics)
+
+  def as_dict(self, total_ms):
+    entry = {"total_ms": round(total_ms, 2)}
+    for kind in KINDS:
+      entry[f"{kind}_count"] = self.counts[kind]
+      entry[f"{kind}_ms"] = round(self.seconds[kind] * 1000, 2)
+    for name, (seconds, desc) in self.marks.items():
+      if seconds is not None:
+        entry[f"{name}_ms"] = round(seconds * 1000, 2)
+      if desc is not None:
+        entry[name] = desc
+    return entry
+
+
+def current():
+  """ The collector of the request being handled, or None when not sampled """
+  return _current.get()
+
+
+def mark(name, seconds=None, desc=None):
+  """
+    Report a step of the current request under ``name``: its duration,
+    added up over calls, and a short description such as "hit" or "miss".
+  """
+  timings = _current.get()
+  if timings is not None:
+    timings.mark(name, seconds, desc)
+
+
+@contextmanager
+def timed(kind):
+  """ Add the time spent in the block to the current request's ``kind`` """
+  timings = _current.get()
+  if timings is None or kind in timings.active:
+    yield
+    return
+  timings.active.add(kind)
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    timings.active.discard(kind)
+    timings.record(kind, time.perf_counter() - started)
+
+
+def _time_query(execute, sql, params, many, context):
+  if _current.get() is None:
+    return execute(sql, params, many, context)
+  with timed(DB):
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+  if _time_query not in connection.execute_wrappers:
+    connection.execute_wrappers.append(_time_query)
+
+
+class TimedDataMixin:
+  """ Serializer mixin timing ``.data``, i.e. the to_representation pass """
+
+  @property
+  def data(self):
+    if _current.get() is None:
+      return super().data
+    with timed(SERIALIZER):
+      return super().data
+
+
+class ServerTimingMiddleware:
+  """
+    Time DB, cache and serializer work of sampled requests.
+
+    Works in both sync and async middleware chains.
+
+    Settings:
+      SERVER_TIMING_SAMPLE_RATE: Fraction of requests instrumented (0 disables).
+      SERVER_TIMING_HEADER: Add the Server-Timing header to sampled responses.
+        Off by default: the timings would be public.
+      SERVER_TIMING_LOG: Log one JSON line per sampled request.
+  """
+
+  sync_capable = True
+  async_capable = True
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+    self.async_mode = iscoroutinefunction(get_response)
+    if self.async_mode:
+      markcoroutinefunction(self)
+
+  def __call__(self, request):
+    if self.async_mode:
+      return self.__acall__(request)
+    if not self.sampled():
+      return self.get_response(request)
+
+    timings = RequestTimings()
+    token = _current.set(timings)
+    try:
+      response = self.get_response(request)
+    finally:
+      _current.reset(token)
+    return self.finish(request, response, timings)
+
+  async def __acall__(self, request):
+    if not self.sampled():
+      return await self.get_response(request)
+
+    timings = RequestTimings()
+    token = _current.set(timings)
+    try:
+      response = await self.get_response(request)
+    finally:
+      _current.reset(token)
+    return self.finish(request, response, timings)
+
+  def sampled(self):
+    rate = getattr(settings, "SERVER_TIMING_SAMPLE_RATE", DEFAULT_SAMPLE_RATE)
+    return rate >= 1 or (rate > 0 and random.random() < rate)  # noqa: S311
+
+  def finish(self, request, response, timings):
+    total_ms = timings.total_ms()
+    if getattr(settings, "SERVER_TIMING_HEADER", False):
+      value = timings.header(total_ms)
+      if response.has_header("Server-Timing"):
+        value = f"{response['Server-Timing']}, {value}"
+      response["Server-Timing"] = value
+    if getattr(settings, "SERVER_TIMING_LOG", True):
+      match = request.resolver_match
+      entry = {
+        "method": request.method,
+        "path": request.path,
+        "view": match.view_name if match else None,
+        "status": response.status_code,
+        **timings.as_dict(total_ms),
+      }
+      logger.info(json.dumps(entry))
+    return response
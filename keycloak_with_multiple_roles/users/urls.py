@@ -1,6 +1,8 @@
 from django.urls import path
 from keycloak_with_multiple_roles.users.api.views import (
   UserViewSet,
+  ExportView,
+  StudentLinksView,
   LoginView,
   LogoutView,
   MeView,
@@ -14,8 +16,19 @@ auth_patterns = [
   path("auth/me", MeView.as_view(), name="me"),
 ]
 
+# roster exports
+export_patterns = [
+  path("export/<str:resource>.<str:export_format>", ExportView.as_view(), name="export"),
+]
+
+# family links
+student_patterns = [
+  path("students/links", StudentLinksView.as_view(), name="student-links"),
+]
 
 urlpatterns = [
-  *auth_patterns
+  *auth_patterns,
+  *export_patterns,
+  *student_patterns,
   # user_patterns
 ]